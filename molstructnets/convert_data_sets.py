@@ -0,0 +1,27 @@
+import argparse
+
+from util import initialization
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Converts data set, target and partition files into a memory mapped'
+                                                 ' layout (contiguous and uncompressed with fixed width SMILES), so'
+                                                 ' that all processes share one copy in the page cache')
+    parser.add_argument('files', type=str, nargs='+', help='Paths to the HDF5 files')
+    return parser.parse_args()
+
+
+args = get_arguments()
+initialization.initialize(args)
+
+from util import hdf5_util, logger, file_util
+
+for path in args.files:
+    if not file_util.file_exists(path):
+        logger.log('File ' + path + ' does not exist.', logger.LogLevel.ERROR)
+        continue
+    rewritten = hdf5_util.make_contiguous(path)
+    if len(rewritten) > 0:
+        logger.log('Converted ' + ', '.join(rewritten) + ' in ' + path)
+    else:
+        logger.log(path + ' is already memory mapped')
@@ -0,0 +1,181 @@
+import json
+import os
+import subprocess
+import time
+
+import psutil
+
+from util import file_util, memory_budget
+
+
+class Job:
+
+    # One run of an experiment (with one seed). key identifies the experiment for its duration estimates, name the
+    # run in log file names. attempts counts the runs that have been started so far.
+
+    def __init__(self, experiment_index, arguments, key, name, estimate=None):
+        self.experiment_index = experiment_index
+        self.name = name
+        self.arguments = arguments
+        self.key = key
+        self.estimate = estimate
+        self.attempts = 0
+        self.return_code = None
+        self.duration = None
+        self._process = None
+        self._log_file = None
+        self._cores = None
+        self._card = None
+        self._start_time = None
+
+
+class Scheduler:
+
+    # Runs jobs as child processes, as many at once as the cores and memory of the host allow. Every job gets
+    # experiment_cpus cores of its own, the child is pinned to them so its process pools use exactly these cores.
+    # experiment_memory bytes are reserved for every running job. The job with the longest estimated duration is
+    # started first (jobs without an estimate before all others), so long experiments do not end up running alone at
+    # the end of the batch. If a job does not fit, it is started anyway when nothing else is running. With cards every
+    # job gets a GPU of its own (passed as --card), as TensorFlow reserves the memory of the GPU it uses, so at most one
+    # job runs per card.
+
+    def __init__(self, experiment_cpus=None, experiment_memory=None, total_memory=None, log_folder=None, cards=None):
+        if hasattr(os, 'sched_getaffinity'):
+            self._free_cores = sorted(os.sched_getaffinity(0))
+        else:
+            self._free_cores = list(range(os.cpu_count()))
+        if experiment_cpus is None:
+            experiment_cpus = len(self._free_cores)
+        self._experiment_cpus = max(1, min(experiment_cpus, len(self._free_cores)))
+        self._experiment_memory = experiment_memory
+        if total_memory is None and experiment_memory is not None:
+            total_memory = max(0, psutil.virtual_memory().available - memory_budget.buffer)
+        self._free_memory = total_memory
+        self._log_folder = log_folder
+        self._free_cards = None
+        if cards is not None:
+            self._free_cards = list(cards)
+        self._queued = list()
+        self._running = list()
+
+    def submit(self, job):
+        self._queued.append(job)
+        self._queued.sort(key=lambda job_: -job_.estimate if job_.estimate is not None else -float('inf'))
+
+    def number_running(self):
+        return len(self._running)
+
+    def is_done(self):
+        return len(self._queued) == 0 and len(self._running) == 0
+
+    def start_jobs(self):
+        # Starts queued jobs as long as they fit and returns the started ones
+        started = list()
+        while len(self._queued) > 0 and self._fits():
+            job = self._queued.pop(0)
+            self._start(job)
+            started.append(job)
+        return started
+
+    def wait(self, interval=1):
+        # Blocks until at least one running job has finished and returns the finished jobs
+        while True:
+            finished = list()
+            for job in self._running:
+                if job._process.poll() is not None:
+                    finished.append(job)
+            if len(finished) > 0 or len(self._running) == 0:
+                break
+            time.sleep(interval)
+        for job in finished:
+            self._finish(job)
+        return finished
+
+    def close(self):
+        for job in list(self._running):
+            job._process.kill()
+            job._process.wait()
+            self._finish(job)
+
+    def _fits(self):
+        if len(self._running) == 0:
+            return True
+        if len(self._free_cores) < self._experiment_cpus:
+            return False
+        if self._experiment_memory is not None and self._free_memory < self._experiment_memory:
+            return False
+        if self._free_cards is not None and len(self._free_cards) == 0:
+            return False
+        return True
+
+    def _start(self, job):
+        job._cores = self._free_cores[:self._experiment_cpus]
+        self._free_cores = self._free_cores[self._experiment_cpus:]
+        if self._experiment_memory is not None:
+            self._free_memory -= self._experiment_memory
+        arguments = job.arguments
+        if self._free_cards is not None:
+            job._card = self._free_cards.pop(0)
+            arguments = arguments + ['--card', str(job._card)]
+        job.attempts += 1
+        output = None
+        if self._log_folder is not None:
+            file_util.make_folders(self._log_folder, including_this=True)
+            log_path = file_util.resolve_subpath(self._log_folder, job.name + '_' + str(job.attempts) + '.log')
+            job._log_file = open(log_path, 'w')
+            output = job._log_file
+        cores = job._cores
+        preexec_fn = None
+        if hasattr(os, 'sched_setaffinity'):
+            def preexec_fn():
+                os.sched_setaffinity(0, cores)
+        job._start_time = time.time()
+        if output is None:
+            job._process = subprocess.Popen(arguments, preexec_fn=preexec_fn)
+        else:
+            job._process = subprocess.Popen(arguments, stdout=output, stderr=subprocess.STDOUT,
+                                            preexec_fn=preexec_fn)
+        self._running.append(job)
+
+    def _finish(self, job):
+        self._running.remove(job)
+        self._free_cores = sorted(self._free_cores + job._cores)
+        if self._experiment_memory is not None:
+            self._free_memory += self._experiment_memory
+        if job._card is not None:
+            self._free_cards.append(job._card)
+            job._card = None
+        job.return_code = job._process.returncode
+        job.duration = time.time() - job._start_time
+        job._process = None
+        if job._log_file is not None:
+            job._log_file.close()
+            job._log_file = None
+
+
+class DurationEstimates:
+
+    # Durations of past successful runs, stored as JSON with a list of seconds for every experiment key. The estimate
+    # of an experiment is the mean of its runs.
+
+    def __init__(self, path):
+        self._path = file_util.resolve_path(path)
+        self._durations = dict()
+        if file_util.file_exists(self._path):
+            with open(self._path, 'r') as file:
+                self._durations = json.load(file)
+
+    def get(self, key):
+        if key not in self._durations:
+            return None
+        durations = self._durations[key]
+        return sum(durations) / len(durations)
+
+    def add(self, key, duration):
+        if key not in self._durations:
+            self._durations[key] = list()
+        self._durations[key].append(duration)
+
+    def save(self):
+        with open(self._path, 'w') as file:
+            json.dump(self._durations, file)
@@ -13,6 +13,12 @@ def get_arguments():
     parser.add_argument('--seed', type=int, default=None, help='The random seed (will overwrite seed set in experiment'
                                                                ' file)')
     parser.add_argument('--card', type=int, default=None, help='Number of the GPU that is used')
+    parser.add_argument('--memory_budget', type=float, default=None, help='Memory in GB that this process uses for'
+                                                                          ' preprocessed batches (default: half of the'
+                                                                          ' available memory)')
+    parser.add_argument('--host_memory_budget', type=float, default=None, help='Memory in GB that all experiments on'
+                                                                               ' this host together use for'
+                                                                               ' preprocessed batches')
     return parser.parse_args()
 
 
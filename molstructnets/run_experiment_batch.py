@@ -1,10 +1,10 @@
 import argparse
-import subprocess
+import math
 import sys
 import datetime
 
-from experimentbatch import experiment_batch, execution_results
-from util import file_util, logger
+from experimentbatch import experiment_batch, execution_results, scheduler
+from util import file_util, logger, memory_budget
 
 
 def get_arguments():
@@ -13,55 +13,112 @@ def get_arguments():
                                                     'experiment, data set, target, partition. Unused parameters can be '
                                                     'left empty.')
     parser.add_argument('--retries', type=int, default=0, help='Number of retries if an experiment fails')
-    parser.add_argument('--card', type=int, default=None, help='Number of the GPU that is used')
+    parser.add_argument('--card', type=int, nargs='+', default=None, help='Numbers of the GPUs that are used, each'
+                                                                          ' running experiment gets one of them')
+    parser.add_argument('--memory_budget', type=float, default=None, help='Memory in GB that this process uses for'
+                                                                          ' preprocessed batches (default: half of the'
+                                                                          ' available memory)')
+    parser.add_argument('--host_memory_budget', type=float, default=None, help='Memory in GB that all experiments on'
+                                                                               ' this host together use for'
+                                                                               ' preprocessed batches')
+    parser.add_argument('--experiment_cpus', type=int, default=None, help='Number of cores of each experiment, as'
+                                                                          ' many experiments as there are cores for'
+                                                                          ' run at once (default: all cores, one'
+                                                                          ' experiment at a time)')
+    parser.add_argument('--experiment_memory', type=float, default=None, help='Memory in GB that is reserved for'
+                                                                              ' each running experiment (default: no'
+                                                                              ' limit)')
     return parser.parse_args()
 
 
+def submit_experiments(first):
+    # Queues one job per seed for every experiment from first on that has not succeeded yet
+    for i in range(first, len(experiments)):
+        if results.get_status(i) == execution_results.Status.success:
+            continue
+        key = ' '.join(experiments[i].get_execution_arguments())
+        remaining[i] = nr_seeds
+        for j in range(nr_seeds):
+            params = run_experiment + experiments[i].get_execution_arguments()
+            name = 'experiment_' + str(i)
+            if seeds is not None:
+                params += ['--seed', str(seeds[j])]
+                name += '_seed_' + str(seeds[j])
+            params += child_arguments
+            scheduler_.submit(scheduler.Job(i, params, key, name, estimates.get(key)))
+
+
 args = get_arguments()
-result_path = file_util.resolve_path(args.batch_csv[:args.batch_csv.rfind('.')] + '_execution_results.csv')
+batch_name = args.batch_csv[:args.batch_csv.rfind('.')]
+result_path = file_util.resolve_path(batch_name + '_execution_results.csv')
 experiments, seeds = experiment_batch.load_entries_from_csv(args.batch_csv)
 nr_seeds = 1
 if seeds is not None:
     nr_seeds = len(seeds)
 results = execution_results.ExecutionResults(result_path, len(experiments))
+estimates = scheduler.DurationEstimates(batch_name + '_durations.json')
 run_experiment = [sys.executable, sys.argv[0][:sys.argv[0].rfind('/') + 1] + 'run_experiment.py']
+child_arguments = list()
+if args.memory_budget is not None:
+    child_arguments += ['--memory_budget', str(args.memory_budget)]
+elif args.experiment_memory is not None:
+    child_arguments += ['--memory_budget', str(args.experiment_memory * memory_budget.default_fraction)]
+if args.host_memory_budget is not None:
+    child_arguments += ['--host_memory_budget', str(args.host_memory_budget)]
+experiment_memory = None
+if args.experiment_memory is not None:
+    experiment_memory = args.experiment_memory * math.pow(1024, 3)
+# Experiments running side by side write their output into one log file per run
+log_folder = None
+if args.experiment_cpus is not None:
+    log_folder = batch_name + '_logs'
+# Experiments running at the same time never share a GPU
+scheduler_ = scheduler.Scheduler(args.experiment_cpus, experiment_memory, log_folder=log_folder, cards=args.card)
+# Number of seeds of each experiment that still have to succeed
+remaining = dict()
 logger.log('\n')
-i = 0
 start_time = datetime.datetime.now()
 logger.divider()
 logger.log('Starting experiment batch at ' + str(start_time))
-while i < len(experiments):
-    if results.get_status(i) != execution_results.Status.success:
-        successes = 0
-        for j in range(nr_seeds):
-            params = run_experiment + experiments[i].get_execution_arguments()
-            if seeds is not None:
-                params += ['--seed', str(seeds[j])]
-            if args.card is not None:
-                params += ['--card', str(args.card)]
+submit_experiments(0)
+try:
+    while not scheduler_.is_done():
+        for job in scheduler_.start_jobs():
             retry_text = ''
-            for k in range(args.retries + 1):
-                logger.divider('•', nr_lines=2)
-                logger.log(retry_text + ' '.join(params))
-                logger.divider('•', nr_lines=2)
-                logger.log('\n')
-                result = subprocess.call(params)
-                logger.log('\n')
-                if result != 0:
-                    results.set_status(i, execution_results.Status.failed)
-                    retry_text = 'Running for the ' + str(k + 2) + '. time:\n'
-                else:
-                    successes += 1
-                    break
-            if successes == nr_seeds:
-                results.set_status(i, execution_results.Status.success)
+            if job.attempts > 1:
+                retry_text = 'Running for the ' + str(job.attempts) + '. time:\n'
+            logger.divider('•', nr_lines=2)
+            logger.log(retry_text + ' '.join(job.arguments))
+            logger.divider('•', nr_lines=2)
+            logger.log('\n')
+        for job in scheduler_.wait():
+            i = job.experiment_index
+            if job.return_code != 0:
+                logger.log('Failed after ' + str(datetime.timedelta(seconds=round(job.duration))) + ': '
+                           + ' '.join(job.arguments), logger.LogLevel.ERROR)
+                results.set_status(i, execution_results.Status.failed)
+                if job.attempts <= args.retries:
+                    scheduler_.submit(job)
+            else:
+                logger.log('Finished after ' + str(datetime.timedelta(seconds=round(job.duration))) + ': '
+                           + ' '.join(job.arguments))
+                estimates.add(job.key, job.duration)
+                estimates.save()
+                remaining[i] -= 1
+                if remaining[i] == 0:
+                    results.set_status(i, execution_results.Status.success)
             results.save()
-    experiments, seeds = experiment_batch.load_entries_from_csv(args.batch_csv)
-    nr_seeds = 1
-    if seeds is not None:
-        nr_seeds = len(seeds)
-    results.update_number_experiments(len(experiments))
-    i += 1
+        # Experiments appended to the batch file while it is running are run as well
+        number_experiments = len(experiments)
+        experiments, seeds = experiment_batch.load_entries_from_csv(args.batch_csv)
+        nr_seeds = 1
+        if seeds is not None:
+            nr_seeds = len(seeds)
+        results.update_number_experiments(len(experiments))
+        if len(experiments) > number_experiments:
+            submit_experiments(number_experiments)
+finally:
+    scheduler_.close()
 end_time = datetime.datetime.now()
 logger.log('Finished execution of experiment batch at ' + str(end_time))
 logger.log('Duration of experiment batch: ' + str(end_time - start_time))
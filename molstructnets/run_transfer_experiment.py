@@ -10,6 +10,12 @@ def get_arguments():
     parser.add_argument('--seed', type=int, default=None, help='The random seed (will overwrite seed set in experiment'
                                                                ' file)')
     parser.add_argument('--card', type=int, default=None, help='Number of the GPU that is used')
+    parser.add_argument('--memory_budget', type=float, default=None, help='Memory in GB that this process uses for'
+                                                                          ' preprocessed batches (default: half of the'
+                                                                          ' available memory)')
+    parser.add_argument('--host_memory_budget', type=float, default=None, help='Memory in GB that all experiments on'
+                                                                               ' this host together use for'
+                                                                               ' preprocessed batches')
     return parser.parse_args()
 
 
@@ -132,6 +138,10 @@ for i in range(nr_steps):
             global_parameters_list[j][constants.GlobalParameters.feature_id] = global_params[constants.GlobalParameters.feature_id]
             global_parameters_list[j][constants.GlobalParameters.preprocessed_data] = global_params[constants.GlobalParameters.preprocessed_data]
             global_parameters_list[j][constants.GlobalParameters.input_dimensions] = global_params[constants.GlobalParameters.input_dimensions]
+            if constants.GlobalParameters.encoded_symbols in global_params:
+                global_parameters_list[j][constants.GlobalParameters.encoded_symbols] = global_params[constants.GlobalParameters.encoded_symbols]
+            else:
+                global_parameters_list[j].pop(constants.GlobalParameters.encoded_symbols, None)
     elif type_id == training_repository.instance.get_id():
         if len(data_sets_train) != 1:
             raise ValueError('Normal training does not support ' + str(len(data_sets_train)) + ' training data sets.')
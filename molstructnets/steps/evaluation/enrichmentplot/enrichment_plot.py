@@ -2,7 +2,7 @@ import h5py
 import numpy
 
 from steps.evaluation.shared import enrichment
-from util import data_validation, misc, file_util, file_structure, logger, constants, csv_file
+from util import data_validation, misc, file_util, file_structure, logger, constants, csv_file, hdf5_util
 
 
 class EnrichmentPlot:
@@ -62,9 +62,8 @@ class EnrichmentPlot:
             prediction_h5 = h5py.File(file_structure.get_prediction_file(global_parameters), 'r')
             predictions = prediction_h5[file_structure.Predictions.prediction][:]
             prediction_h5.close()
-            target_h5 = h5py.File(file_structure.get_target_file(global_parameters), 'r')
-            classes = target_h5[file_structure.Target.classes][:]
-            target_h5.close()
+            classes = hdf5_util.load_data_set(file_structure.get_target_file(global_parameters),
+                                              file_structure.Target.classes)
             if local_parameters['partition'] == 'train' or local_parameters['partition'] == 'test':
                 partition_h5 = h5py.File(file_structure.get_partition_file(global_parameters), 'r')
                 if local_parameters['partition'] == 'train':
@@ -6,7 +6,7 @@ from keras import models
 
 from steps.preprocessing.shared.tensor2d import tensor_2d_array
 from util import data_validation, file_structure, file_util, logger, progressbar, constants, hdf5_util, misc, \
-    thread_pool
+    thread_pool, hdf5_writer, artifact_cache
 
 
 class LearnedFeatureGenerationTensor2D:
@@ -34,39 +34,52 @@ class LearnedFeatureGenerationTensor2D:
 
     @staticmethod
     def get_result_file(global_parameters, local_parameters):
-        file_name = 'learned_features.h5'
-        return file_util.resolve_subpath(file_structure.get_result_folder(global_parameters), file_name)
+        # The batch size does not change the features
+        inputs = {'data_set': artifact_cache.data_set_digest(global_parameters),
+                  'preprocessed': artifact_cache.file_digest(
+                      global_parameters, global_parameters[constants.GlobalParameters.preprocessed_data]),
+                  'network': artifact_cache.file_digest(global_parameters,
+                                                        file_structure.get_network_file(global_parameters))}
+        return artifact_cache.get_file(global_parameters, 'learned_features', dict(), inputs)
 
     @staticmethod
     def execute(global_parameters, local_parameters):
         model_path = file_structure.get_network_file(global_parameters)
-        global_parameters[constants.GlobalParameters.feature_id] = 'learned_features'
+        # Before the feature id changes the path of the network
         learned_features_path = LearnedFeatureGenerationTensor2D.get_result_file(global_parameters, local_parameters)
+        global_parameters[constants.GlobalParameters.feature_id] = 'learned_features'
         model = models.load_model(model_path)
         feature_layer = model.get_layer('features')
         feature_dimensions = (int(numpy.prod(list(feature_layer.input.shape)[1:])),)
-        if file_util.file_exists(learned_features_path):
-            logger.log('Skipping step: ' + learned_features_path + ' already exists')
-        else:
-            feature_model = models.Model(inputs=model.input, outputs=feature_layer.output)
-            array = tensor_2d_array.load_array(global_parameters)
-            data_queue = queue.Queue(10)
-            temp_learned_features_path = file_util.get_temporary_file_path('learned_features')
-            learned_features_h5 = h5py.File(temp_learned_features_path, 'w')
-            learned_features = hdf5_util.create_dataset(learned_features_h5, file_structure.Preprocessed.preprocessed,
-                                                        (len(array),) + feature_dimensions, dtype='float16',
-                                                        chunks=(1,) + feature_dimensions)
-            logger.log('Generating features')
-            chunks = misc.chunk_by_size(len(array), local_parameters['batch_size'])
-            pool = thread_pool.ThreadPool(1)
-            pool.submit(generate_data, array, chunks, data_queue)
-            with progressbar.ProgressBar(len(array)) as progress:
-                for chunk in chunks:
-                    learned_features[chunk['start']:chunk['end']] = feature_model.predict(data_queue.get())[:]
-                    progress.increment(chunk['size'])
-            array.close()
-            learned_features_h5.close()
-            file_util.move_file(temp_learned_features_path, learned_features_path)
+        # Experiments running at the same time wait for the one that writes the file
+        with file_util.FileLock(learned_features_path):
+            if file_util.file_exists(learned_features_path):
+                logger.log('Skipping step: ' + learned_features_path + ' already exists')
+            else:
+                feature_model = models.Model(inputs=model.input, outputs=feature_layer.output)
+                array = tensor_2d_array.load_array(global_parameters)
+                data_queue = queue.Queue(10)
+                temp_learned_features_path = file_util.get_temporary_file_path('learned_features')
+                learned_features_h5 = h5py.File(temp_learned_features_path, 'w')
+                shape = (len(array),) + feature_dimensions
+                learned_features = hdf5_util.create_dataset(learned_features_h5,
+                                                            file_structure.Preprocessed.preprocessed, shape,
+                                                            dtype='float16',
+                                                            chunks=hdf5_writer.chunk_shape(shape, 'float16'))
+                logger.log('Generating features')
+                chunks = misc.chunk_by_size(len(array), local_parameters['batch_size'])
+                pool = thread_pool.ThreadPool(1)
+                pool.submit(generate_data, array, chunks, data_queue)
+                # Compressing and writing the features happens in the background
+                with hdf5_writer.Hdf5Writer(learned_features) as writer:
+                    with progressbar.ProgressBar(len(array)) as progress:
+                        for chunk in chunks:
+                            writer.write(chunk['start'], feature_model.predict(data_queue.get()).astype('float16'))
+                            progress.increment(chunk['size'])
+                pool.close()
+                array.close()
+                learned_features_h5.close()
+                file_util.move_file(temp_learned_features_path, learned_features_path)
         global_parameters[constants.GlobalParameters.input_dimensions] = feature_dimensions
         global_parameters[constants.GlobalParameters.preprocessed_data] = learned_features_path
         global_parameters[constants.GlobalParameters.feature_files].append(learned_features_path)
@@ -4,8 +4,9 @@ from rdkit import Chem
 
 from steps.featuregeneration.shared import substructure_feature_generator
 from steps.featuregeneration.mossfeaturegeneration import moss_integration
+from steps.preprocessing.shared.moleculestore import molecule_store
 from util import data_validation, misc, file_structure, file_util, logger, process_pool, constants, \
-    hdf5_util, multi_process_progressbar
+    hdf5_util, multi_process_progressbar, artifact_cache
 
 
 class MossFeatureGeneration:
@@ -41,67 +42,76 @@ class MossFeatureGeneration:
 
     @staticmethod
     def get_result_file(global_parameters, local_parameters):
-        file_name = 'moss_features.h5'
-        return file_util.resolve_subpath(file_structure.get_result_folder(global_parameters), file_name)
+        hash_parameters = misc.copy_dict_from_keys(local_parameters, ['min_focus', 'max_complement', 'count'])
+        # The substructures are mined from the training data
+        inputs = {'data_set': artifact_cache.data_set_digest(global_parameters),
+                  'target': artifact_cache.file_digest(global_parameters,
+                                                       file_structure.get_target_file(global_parameters)),
+                  'partition': artifact_cache.file_digest(global_parameters,
+                                                          file_structure.get_partition_file(global_parameters))}
+        return artifact_cache.get_file(global_parameters, 'moss_features', hash_parameters, inputs)
 
     @staticmethod
     def execute(global_parameters, local_parameters):
         global_parameters[constants.GlobalParameters.feature_id] = 'moss_substructures'
         features_path = MossFeatureGeneration.get_result_file(global_parameters, local_parameters)
-        if file_util.file_exists(features_path):
-            logger.log('Skipping step: ' + features_path + ' already exists')
-            features_h5 = h5py.File(features_path, 'r')
-            feature_dimensions = features_h5[file_structure.Preprocessed.preprocessed].shape[1]
-            features_h5.close()
-        else:
-            partition_h5 = h5py.File(file_structure.get_partition_file(global_parameters), 'r')
-            train_indices = numpy.unique(partition_h5[file_structure.Partitions.train][:])
-            partition_h5.close()
-            data_h5 = h5py.File(file_structure.get_data_set_file(global_parameters), 'r')
-            smiles_train_data = numpy.take(data_h5[file_structure.DataSet.smiles][:], train_indices, axis=0)
-            smiles_data = data_h5[file_structure.DataSet.smiles][:]
-            data_h5.close()
-            target_h5 = h5py.File(file_structure.get_target_file(global_parameters), 'r')
-            train_classes = numpy.take(target_h5[file_structure.Target.classes][:], train_indices, axis=0)
-            target_h5.close()
-            substructures_active = moss_integration.calculate_substructures(smiles_train_data, train_classes,
-                                                                     local_parameters['min_focus'],
-                                                                     local_parameters['max_complement'],
-                                                                     True)
-            substructures_inactive = moss_integration.calculate_substructures(smiles_train_data, train_classes,
-                                                                     local_parameters['min_focus'],
-                                                                     local_parameters['max_complement'],
-                                                                     False)
-            substructures = substructures_active + substructures_inactive
-            feature_dimensions = len(substructures)
-            temp_features_path = file_util.get_temporary_file_path('moss_features')
-            chunks = misc.chunk(len(smiles_data), process_pool.default_number_processes)
-            global_parameters[constants.GlobalParameters.input_dimensions] = (len(substructures),)
-            logger.log('Calculating MoSS features')
-            with process_pool.ProcessPool(len(chunks)) as pool:
-                with multi_process_progressbar.MultiProcessProgressbar(len(smiles_data), value_buffer=100) as progress:
-                    for chunk in chunks:
-                        pool.submit(substructure_feature_generator.generate_substructure_features,
-                                    smiles_data[chunk['start']:chunk['end']], substructures,
-                                    progress=progress.get_slave())
-                    results = pool.get_results()
-            if local_parameters['count']:
-                dtype = 'uint16'
+        # Experiments running at the same time wait for the one that writes the file
+        with file_util.FileLock(features_path):
+            if file_util.file_exists(features_path):
+                logger.log('Skipping step: ' + features_path + ' already exists')
+                features_h5 = h5py.File(features_path, 'r')
+                feature_dimensions = features_h5[file_structure.Preprocessed.preprocessed].shape[1]
+                features_h5.close()
             else:
-                dtype = 'uint8'
-            features_h5 = h5py.File(temp_features_path, 'w')
-            features = hdf5_util.create_dataset(features_h5, file_structure.Preprocessed.preprocessed,
-                                                (len(smiles_data), len(substructures)), dtype=dtype,
-                                                chunks=(1, len(substructures)))
-            offset = 0
-            for result in results:
+                partition_h5 = h5py.File(file_structure.get_partition_file(global_parameters), 'r')
+                train_indices = numpy.unique(partition_h5[file_structure.Partitions.train][:])
+                partition_h5.close()
+                smiles_data = hdf5_util.load_data_set(file_structure.get_data_set_file(global_parameters),
+                                                      file_structure.DataSet.smiles)
+                smiles_train_data = numpy.take(smiles_data, train_indices, axis=0)
+                classes = hdf5_util.load_data_set(file_structure.get_target_file(global_parameters),
+                                                  file_structure.Target.classes)
+                train_classes = numpy.take(classes, train_indices, axis=0)
+                substructures_active = moss_integration.calculate_substructures(smiles_train_data, train_classes,
+                                                                         local_parameters['min_focus'],
+                                                                         local_parameters['max_complement'],
+                                                                         True)
+                substructures_inactive = moss_integration.calculate_substructures(smiles_train_data, train_classes,
+                                                                         local_parameters['min_focus'],
+                                                                         local_parameters['max_complement'],
+                                                                         False)
+                substructures = substructures_active + substructures_inactive
+                feature_dimensions = len(substructures)
+                temp_features_path = file_util.get_temporary_file_path('moss_features')
+                molecules = molecule_store.load(global_parameters)
+                chunks = misc.chunk(len(smiles_data), process_pool.default_number_processes)
+                global_parameters[constants.GlobalParameters.input_dimensions] = (len(substructures),)
+                logger.log('Calculating MoSS features')
+                with process_pool.ProcessPool(len(chunks)) as pool:
+                    with multi_process_progressbar.MultiProcessProgressbar(len(smiles_data),
+                                                                           value_buffer=100) as progress:
+                        for chunk in chunks:
+                            pool.submit(substructure_feature_generator.generate_substructure_features,
+                                        smiles_data[chunk['start']:chunk['end']], substructures, molecules,
+                                        chunk['start'], progress=progress.get_slave())
+                        results = pool.get_results()
                 if local_parameters['count']:
-                    features[offset:offset + len(result)] = result[:]
+                    dtype = 'uint16'
                 else:
-                    features[offset:offset + len(result)] = result[:] > 0
-                offset += len(result)
-            features_h5.close()
-            file_util.move_file(temp_features_path, features_path)
+                    dtype = 'uint8'
+                features_h5 = h5py.File(temp_features_path, 'w')
+                features = hdf5_util.create_dataset(features_h5, file_structure.Preprocessed.preprocessed,
+                                                    (len(smiles_data), len(substructures)), dtype=dtype,
+                                                    chunks=(1, len(substructures)))
+                offset = 0
+                for result in results:
+                    if local_parameters['count']:
+                        features[offset:offset + len(result)] = result[:]
+                    else:
+                        features[offset:offset + len(result)] = result[:] > 0
+                    offset += len(result)
+                features_h5.close()
+                file_util.move_file(temp_features_path, features_path)
         global_parameters[constants.GlobalParameters.input_dimensions] = feature_dimensions
         global_parameters[constants.GlobalParameters.preprocessed_data] = features_path
         global_parameters[constants.GlobalParameters.feature_files].append(features_path)
@@ -3,8 +3,9 @@ import numpy
 from rdkit import Chem
 
 from steps.featuregeneration.shared import substructure_feature_generator
+from steps.preprocessing.shared.moleculestore import molecule_store
 from util import data_validation, misc, file_structure, file_util, logger, process_pool, constants, \
-    hdf5_util, multi_process_progressbar
+    hdf5_util, multi_process_progressbar, artifact_cache
 
 
 class SaliencyMapSubstructureFeatureGeneration:
@@ -38,54 +39,61 @@ class SaliencyMapSubstructureFeatureGeneration:
 
     @staticmethod
     def get_result_file(global_parameters, local_parameters):
-        file_name = 'saliency_map_features.h5'
-        return file_util.resolve_subpath(file_structure.get_result_folder(global_parameters), file_name)
+        hash_parameters = misc.copy_dict_from_keys(local_parameters, ['top_n', 'min_score', 'active', 'count'])
+        saliency_map_substructures_path = global_parameters[constants.GlobalParameters.saliency_map_substructures_data]
+        inputs = {'data_set': artifact_cache.data_set_digest(global_parameters),
+                  'substructures': artifact_cache.file_digest(global_parameters, saliency_map_substructures_path)}
+        return artifact_cache.get_file(global_parameters, 'saliency_map_features', hash_parameters, inputs)
 
     @staticmethod
     def execute(global_parameters, local_parameters):
         global_parameters[constants.GlobalParameters.feature_id] = 'saliency_map_substructures'
         features_path = SaliencyMapSubstructureFeatureGeneration.get_result_file(global_parameters, local_parameters)
-        if file_util.file_exists(features_path):
-            logger.log('Skipping step: ' + features_path + ' already exists')
-            features_h5 = h5py.File(features_path, 'r')
-            feature_dimensions = features_h5[file_structure.Preprocessed.preprocessed].shape[1]
-            features_h5.close()
-        else:
-            saliency_map_substructures_path = global_parameters[constants.GlobalParameters.saliency_map_substructures_data]
-            substructures = load_substructures(saliency_map_substructures_path, local_parameters['top_n'],
-                                               local_parameters['min_score'], local_parameters['active'])
-            feature_dimensions = len(substructures)
-            data_h5 = h5py.File(file_structure.get_data_set_file(global_parameters), 'r')
-            smiles_data = data_h5[file_structure.DataSet.smiles][:]
-            data_h5.close()
-            temp_features_path = file_util.get_temporary_file_path('saliency_map_features')
-            chunks = misc.chunk(len(smiles_data), process_pool.default_number_processes)
-            global_parameters[constants.GlobalParameters.input_dimensions] = (len(substructures),)
-            logger.log('Calculating saliency map features')
-            with process_pool.ProcessPool(len(chunks)) as pool:
-                with multi_process_progressbar.MultiProcessProgressbar(len(smiles_data), value_buffer=100) as progress:
-                    for chunk in chunks:
-                        pool.submit(substructure_feature_generator.generate_substructure_features,
-                                    smiles_data[chunk['start']:chunk['end']], substructures,
-                                    progress=progress.get_slave())
-                    results = pool.get_results()
-            if local_parameters['count']:
-                dtype = 'uint16'
+        # Experiments running at the same time wait for the one that writes the file
+        with file_util.FileLock(features_path):
+            if file_util.file_exists(features_path):
+                logger.log('Skipping step: ' + features_path + ' already exists')
+                features_h5 = h5py.File(features_path, 'r')
+                feature_dimensions = features_h5[file_structure.Preprocessed.preprocessed].shape[1]
+                features_h5.close()
             else:
-                dtype = 'uint8'
-            features_h5 = h5py.File(temp_features_path, 'w')
-            features = hdf5_util.create_dataset(features_h5, file_structure.Preprocessed.preprocessed,
-                                                (len(smiles_data), len(substructures)), dtype=dtype,
-                                                chunks=(1, len(substructures)))
-            offset = 0
-            for result in results:
+                saliency_map_substructures_path = \
+                    global_parameters[constants.GlobalParameters.saliency_map_substructures_data]
+                substructures = load_substructures(saliency_map_substructures_path, local_parameters['top_n'],
+                                                   local_parameters['min_score'], local_parameters['active'])
+                feature_dimensions = len(substructures)
+                smiles_data = hdf5_util.load_data_set(file_structure.get_data_set_file(global_parameters),
+                                                      file_structure.DataSet.smiles)
+                temp_features_path = file_util.get_temporary_file_path('saliency_map_features')
+                molecules = molecule_store.load(global_parameters)
+                chunks = misc.chunk(len(smiles_data), process_pool.default_number_processes)
+                global_parameters[constants.GlobalParameters.input_dimensions] = (len(substructures),)
+                logger.log('Calculating saliency map features')
+                with process_pool.ProcessPool(len(chunks)) as pool:
+                    with multi_process_progressbar.MultiProcessProgressbar(len(smiles_data),
+                                                                           value_buffer=100) as progress:
+                        for chunk in chunks:
+                            pool.submit(substructure_feature_generator.generate_substructure_features,
+                                        smiles_data[chunk['start']:chunk['end']], substructures, molecules,
+                                        chunk['start'], progress=progress.get_slave())
+                        results = pool.get_results()
                 if local_parameters['count']:
-                    features[offset:offset + len(result)] = result[:]
+                    dtype = 'uint16'
                 else:
-                    features[offset:offset + len(result)] = result[:] > 0
-                offset += len(result)
-            features_h5.close()
-            file_util.move_file(temp_features_path, features_path)
+                    dtype = 'uint8'
+                features_h5 = h5py.File(temp_features_path, 'w')
+                features = hdf5_util.create_dataset(features_h5, file_structure.Preprocessed.preprocessed,
+                                                    (len(smiles_data), len(substructures)), dtype=dtype,
+                                                    chunks=(1, len(substructures)))
+                offset = 0
+                for result in results:
+                    if local_parameters['count']:
+                        features[offset:offset + len(result)] = result[:]
+                    else:
+                        features[offset:offset + len(result)] = result[:] > 0
+                    offset += len(result)
+                features_h5.close()
+                file_util.move_file(temp_features_path, features_path)
         global_parameters[constants.GlobalParameters.input_dimensions] = feature_dimensions
         global_parameters[constants.GlobalParameters.preprocessed_data] = features_path
         global_parameters[constants.GlobalParameters.feature_files].append(features_path)
@@ -1,12 +1,12 @@
 import numpy
-from rdkit import Chem
 
+from steps.preprocessing.shared.moleculestore import molecule_store
 
-def generate_substructure_features(smiles_data, substructures, progress=None):
+
+def generate_substructure_features(smiles_data, substructures, molecules=None, start=0, progress=None):
     preprocessed = numpy.zeros((len(smiles_data), len(substructures)), dtype='uint16')
     for i in range(len(smiles_data)):
-        smiles = smiles_data[i].decode('utf-8')
-        molecule = Chem.MolFromSmiles(smiles)
+        molecule = molecule_store.get_molecule(smiles_data[i], start + i, molecules)
         for j in range(len(substructures)):
             preprocessed[i, j] = len(molecule.GetSubstructMatches(substructures[j]))
         if progress is not None:
@@ -1,9 +1,11 @@
+import queue
+
 import h5py
 import numpy
 from rdkit import Chem
 
 from steps.preprocessing.shared.tensor2d import tensor_2d_array
-from util import data_validation, file_structure, file_util, progressbar, hdf5_util, logger, buffered_queue, misc
+from util import data_validation, file_structure, file_util, progressbar, hdf5_util, logger, misc, memory_budget
 
 
 class Calculate2DSubstructureLocations:
@@ -49,9 +51,8 @@ class Calculate2DSubstructureLocations:
             else:
                 file_util.remove_file(attention_map_path)
             saliency_map_h5 = h5py.File(temp_saliency_map_path, 'a')
-            data_h5 = h5py.File(file_structure.get_data_set_file(global_parameters), 'r')
-            smiles = data_h5[file_structure.DataSet.smiles][:]
-            data_h5.close()
+            smiles = hdf5_util.load_data_set(file_structure.get_data_set_file(global_parameters),
+                                             file_structure.DataSet.smiles)
             if local_parameters['substructures'] is not None:
                 substructures = local_parameters['substructures']
             else:
@@ -75,18 +76,17 @@ class Calculate2DSubstructureLocations:
 
 
 def write_substructure_locations(preprocessed, substructures, substructure_atoms, progress):
-    size = misc.max_in_memory_chunk_size('uint8', (1, substructure_atoms.shape[1], substructure_atoms.shape[2]),
-                                         use_swap=False)
-    location_queue = buffered_queue.BufferedQueue(1000, 10000)
-    chunks = misc.chunk_by_size(substructure_atoms.shape[0], size)
+    row_bytes = substructure_atoms.shape[1] * substructure_atoms.shape[2]
+    allowance = memory_budget.instance.request('Substructure locations', row_bytes * substructure_atoms.shape[0],
+                                               row_bytes)
+    location_queue = queue.Queue(tensor_2d_array.location_queue_size)
+    chunks = misc.chunk_by_size(substructure_atoms.shape[0], allowance.count(row_bytes))
     for chunk in chunks:
         preprocessed.calc_substructure_locations(chunk['start'], chunk['end'], substructures, location_queue, True)
         result = numpy.zeros((chunk['size'], substructure_atoms.shape[1], substructure_atoms.shape[2]), dtype='uint8')
         for i in range(result.shape[0]):
             idx, atom_locations = location_queue.get()
-            for index in range(len(atom_locations)):
-                x = atom_locations[index][0]
-                y = atom_locations[index][1]
-                result[idx, x, y] = 1.0
+            result[idx, atom_locations[:, 0], atom_locations[:, 1]] = 1
             progress.increment()
         substructure_atoms[chunk['start']:chunk['end']] = result[:]
+    allowance.release()
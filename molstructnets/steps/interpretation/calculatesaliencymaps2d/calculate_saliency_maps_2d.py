@@ -41,6 +41,7 @@ class CalculateSaliencyMaps2D:
         data_validation.validate_target(global_parameters)
         data_validation.validate_partition(global_parameters)
         data_validation.validate_preprocessed_specs(global_parameters)
+        data_validation.validate_one_hot_symbols(global_parameters)
         data_validation.validate_network(global_parameters)
         data_validation.validate_prediction(global_parameters)
 
@@ -66,9 +67,8 @@ class CalculateSaliencyMaps2D:
             else:
                 file_util.remove_file(saliency_map_path)
             saliency_map_h5 = h5py.File(temp_saliency_map_path, 'a')
-            target_h5 = h5py.File(file_structure.get_target_file(global_parameters), 'r')
-            classes = target_h5[file_structure.Target.classes][:]
-            target_h5.close()
+            classes = hdf5_util.load_data_set(file_structure.get_target_file(global_parameters),
+                                              file_structure.Target.classes)
             preprocessed = tensor_2d_array.load_array(global_parameters)
             partition_h5 = h5py.File(file_structure.get_partition_file(global_parameters), 'r')
             if local_parameters['partition'] == 'train':
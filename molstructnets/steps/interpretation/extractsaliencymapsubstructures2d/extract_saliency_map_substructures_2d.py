@@ -1,11 +1,12 @@
+import queue
+
 import h5py
 import numpy
 from rdkit import Chem
 
 from steps.interpretation.extractsaliencymapsubstructures2d import substructure_set
 from steps.preprocessing.shared.tensor2d import tensor_2d_array
-from util import data_validation, file_structure, file_util, progressbar, logger, misc, hdf5_util, buffered_queue,\
-    constants
+from util import data_validation, file_structure, file_util, progressbar, logger, misc, hdf5_util, constants
 
 
 class ExtractSaliencyMapSubstructures2D:
@@ -149,15 +150,14 @@ class ExtractSaliencyMapSubstructures2D:
 
     @staticmethod
     def extract(saliency_map, indices, array, substructures, threshold, progress):
-        location_queue = buffered_queue.BufferedQueue(1, 10000)
+        location_queue = queue.Queue(tensor_2d_array.location_queue_size)
         array.calc_atom_locations(0, len(array), location_queue)
         for i in range(len(array)):
             index, locations = location_queue.get()
             if index in indices:
-                smiles_string = array.smiles(index).decode('utf-8')
                 atom_indices, values = ExtractSaliencyMapSubstructures2D.pick_atoms(saliency_map[index], threshold, locations)
                 if len(atom_indices) > 0:
-                    molecule = Chem.MolFromSmiles(smiles_string)
+                    molecule = array.molecule(index)
                     ExtractSaliencyMapSubstructures2D.add_substructures(molecule, atom_indices, values, substructures)
                 progress.increment()
 
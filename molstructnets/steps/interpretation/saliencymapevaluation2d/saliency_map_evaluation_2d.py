@@ -1,9 +1,11 @@
+import queue
+
 import h5py
 import numpy
 from rdkit import Chem
 
 from steps.preprocessing.shared.tensor2d import tensor_2d_array
-from util import data_validation, file_structure, file_util, logger, misc, progressbar, buffered_queue, hdf5_util
+from util import data_validation, file_structure, file_util, logger, misc, progressbar, hdf5_util, memory_budget
 
 
 class SaliencyMapEvaluation2D:
@@ -85,9 +87,10 @@ class SaliencyMapEvaluation2D:
         substructure_std = hdf5_util.create_dataset(evaluation_h5, 'substructure_std', (len(indices),))
         not_substructure_mean = hdf5_util.create_dataset(evaluation_h5, 'not_substructure_mean', (len(indices),))
         not_substructure_std = hdf5_util.create_dataset(evaluation_h5, 'not_substructure_std', (len(indices),))
-        size = misc.max_in_memory_chunk_size(saliency_map.dtype, saliency_map.shape, use_swap=False)
-        location_queue = buffered_queue.BufferedQueue(1000, 10000)
-        chunks = misc.chunk_by_size(len(indices), size)
+        row_bytes = int(numpy.prod(saliency_map.shape[1:])) * numpy.dtype(saliency_map.dtype).itemsize
+        allowance = memory_budget.instance.request('Saliency map evaluation', row_bytes * len(indices), row_bytes)
+        location_queue = queue.Queue(tensor_2d_array.location_queue_size)
+        chunks = misc.chunk_by_size(len(indices), allowance.count(row_bytes))
         with progressbar.ProgressBar(len(indices)) as progress:
             for chunk in chunks:
                 preprocessed.calc_substructure_locations(chunk['start'], chunk['end'], substructures, location_queue,
@@ -115,3 +118,4 @@ class SaliencyMapEvaluation2D:
                 not_substructure_mean[chunk['start']:chunk['end']] = tmp_not_substructure_mean[:]
                 not_substructure_std[chunk['start']:chunk['end']] = tmp_not_substructure_std[:]
         evaluation_h5.close()
+        allowance.release()
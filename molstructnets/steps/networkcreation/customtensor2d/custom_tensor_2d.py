@@ -1,9 +1,9 @@
 from keras import initializers, optimizers
-from keras.layers import Input
 from keras.layers.convolutional import Convolution2D, MaxPooling2D
 from keras.layers.core import Dense, Flatten, Dropout
 from keras.models import Model
 
+from steps.networkcreation.shared import tensor_2d_input
 from util import file_structure, file_util, logger, constants
 
 
@@ -51,8 +51,7 @@ class CustomTensor2D:
             logger.log('Skipping step: ' + network_path + ' already exists')
         else:
             initializer = initializers.he_uniform()
-            input_layer = Input(shape=global_parameters[constants.GlobalParameters.input_dimensions], name='input')
-            layer = input_layer
+            input_layer, layer = tensor_2d_input.create_input(global_parameters)
             layer = Dropout(local_parameters['input_dropout'], name='input_dropout')(layer)
             convolution_output_size = local_parameters['base_convolution_output']
             for i in range(local_parameters['nr_blocks']):
@@ -0,0 +1,25 @@
+from keras.layers import Input
+from keras.layers.core import Lambda
+
+from util import constants
+
+
+def create_input(global_parameters):
+    # Returns the input layer and the layer the network continues with. Index encoded symbols (see the symbol
+    # encoding of the grid preprocessing) are expanded to a one-hot channel per symbol again.
+    dimensions = global_parameters[constants.GlobalParameters.input_dimensions]
+    input_layer = Input(shape=dimensions, name='input')
+    if constants.GlobalParameters.encoded_symbols not in global_parameters:
+        return input_layer, input_layer
+    number_symbols = global_parameters[constants.GlobalParameters.encoded_symbols]
+    layer = Lambda(expand_symbols, output_shape=tuple(dimensions[:2]) + (number_symbols + dimensions[2] - 1,),
+                   arguments={'number_symbols': number_symbols}, name='input_symbols')(input_layer)
+    return input_layer, layer
+
+
+def expand_symbols(input_, number_symbols):
+    # The function is saved with the model and loaded in another namespace, so it imports what it needs itself
+    from keras import backend
+    # Index 0 means no symbol and has no channel
+    symbols = backend.one_hot(backend.cast(input_[..., 0], 'int32'), number_symbols + 1)[..., 1:]
+    return backend.concatenate([symbols, input_[..., 1:]])
@@ -1,9 +1,9 @@
 from keras import initializers, optimizers
-from keras.layers import Input
 from keras.layers.convolutional import Convolution2D, MaxPooling2D
 from keras.layers.core import Dense, Flatten, Dropout
 from keras.models import Model
 
+from steps.networkcreation.shared import tensor_2d_input
 from util import file_structure, file_util, logger, constants
 
 
@@ -35,8 +35,7 @@ class Tensor2D:
             logger.log('Skipping step: ' + network_path + ' already exists')
         else:
             initializer = initializers.he_uniform(global_parameters[constants.GlobalParameters.seed])
-            input_layer = Input(shape=global_parameters[constants.GlobalParameters.input_dimensions], name='input')
-            layer = input_layer
+            input_layer, layer = tensor_2d_input.create_input(global_parameters)
             layer = Dropout(0.3, name='input-dropout')(layer)
 
             # Block 1
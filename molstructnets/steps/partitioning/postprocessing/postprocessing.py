@@ -2,7 +2,7 @@ import h5py
 import numpy
 
 from steps.partitioning.shared import partitioning
-from util import data_validation, file_structure, misc, file_util, logger, constants, hdf5_util
+from util import data_validation, file_structure, misc, file_util, logger, constants, hdf5_util, artifact_cache
 
 
 class Postprocessing:
@@ -21,7 +21,8 @@ class Postprocessing:
         parameters.append({'id': 'oversample', 'name': 'Oversample Training Partitioning', 'type': bool,
                            'default': True,
                            'description': 'If this is set the minority class will be oversampled, so that the class'
-                                          ' distribution in the training set is equal. Default: True'})
+                                          ' distribution in the training set is equal. For very imbalanced data use'
+                                          ' the class balanced sampling of the training instead. Default: True'})
         parameters.append({'id': 'shuffle', 'name': 'Shuffle Training Partitioning', 'type': bool, 'default': True,
                            'description': 'If this is set the training data will be shuffled. Default: True'})
         parameters.append({'id': 'seed', 'name': 'Random Seed', 'type': int, 'default': None,
@@ -41,6 +42,8 @@ class Postprocessing:
         else:
             hash_parameters = misc.copy_dict_from_keys(local_parameters, ['seed'])
         hash_parameters.update(misc.copy_dict_from_keys(local_parameters, ['oversample', 'shuffle']))
+        hash_parameters['partition'] = artifact_cache.file_digest(global_parameters,
+                                                                 file_structure.get_partition_file(global_parameters))
         file_name = file_util.get_filename(file_structure.get_partition_file(global_parameters), False) \
                     + '_postprocessed_' + misc.hash_parameters(hash_parameters) + '.h5'
         return file_util.resolve_subpath(file_structure.get_partition_folder(global_parameters), file_name)
@@ -51,35 +54,37 @@ class Postprocessing:
         partition_path = Postprocessing.get_result_file(global_parameters, local_parameters)
         global_parameters[constants.GlobalParameters.partition_data] = file_util.get_filename(partition_path,
                                                                                               with_extension=False)
-        if file_util.file_exists(partition_path):
-            logger.log('Skipping step: ' + partition_path + ' already exists')
-        else:
-            if local_parameters['seed'] is None:
-                seed = global_parameters[constants.GlobalParameters.seed]
+        # Experiments running at the same time wait for the one that writes the file
+        with file_util.FileLock(partition_path):
+            if file_util.file_exists(partition_path):
+                logger.log('Skipping step: ' + partition_path + ' already exists')
             else:
-                seed = local_parameters['seed']
-            target_h5 = h5py.File(file_structure.get_target_file(global_parameters), 'r')
-            classes = target_h5[file_structure.Target.classes]
-            classes = classes[:].astype('bool')
-            temp_partition_path = file_util.get_temporary_file_path('postprocessing')
-            source_partition_h5 = h5py.File(source_partition_path, 'r')
-            partition_train = source_partition_h5[file_structure.Partitions.train]
-            partition_train = partition_train[:].astype('uint32')
-            partition_test = source_partition_h5[file_structure.Partitions.test]
-            partition_test = partition_test[:].astype('uint32')
-            train_percentage = (len(partition_train) / (len(partition_train) + len(partition_test))) * 100
-            if local_parameters['oversample']:
-                partition_train = partitioning.oversample(partition_train, classes, logger.LogLevel.VERBOSE)
-            if local_parameters['shuffle']:
-                numpy.random.seed(seed)
-                numpy.random.shuffle(partition_train)
-            partition_h5 = h5py.File(temp_partition_path, 'w')
-            hdf5_util.create_dataset_from_data(partition_h5, file_structure.Partitions.test, partition_test)
-            hdf5_util.create_dataset_from_data(partition_h5, file_structure.Partitions.train, partition_train)
-            target_h5.close()
-            partition_h5.close()
-            source_partition_h5.close()
-            hdf5_util.set_property(temp_partition_path, 'train_percentage', train_percentage)
-            hdf5_util.set_property(temp_partition_path, 'oversample', local_parameters['oversample'])
-            hdf5_util.set_property(temp_partition_path, 'shuffle', local_parameters['shuffle'])
-            file_util.move_file(temp_partition_path, partition_path)
+                if local_parameters['seed'] is None:
+                    seed = global_parameters[constants.GlobalParameters.seed]
+                else:
+                    seed = local_parameters['seed']
+                target_h5 = h5py.File(file_structure.get_target_file(global_parameters), 'r')
+                classes = target_h5[file_structure.Target.classes]
+                classes = classes[:].astype('bool')
+                temp_partition_path = file_util.get_temporary_file_path('postprocessing')
+                source_partition_h5 = h5py.File(source_partition_path, 'r')
+                partition_train = source_partition_h5[file_structure.Partitions.train]
+                partition_train = partition_train[:].astype('uint32')
+                partition_test = source_partition_h5[file_structure.Partitions.test]
+                partition_test = partition_test[:].astype('uint32')
+                train_percentage = (len(partition_train) / (len(partition_train) + len(partition_test))) * 100
+                if local_parameters['oversample']:
+                    partition_train = partitioning.oversample(partition_train, classes, logger.LogLevel.VERBOSE)
+                if local_parameters['shuffle']:
+                    numpy.random.seed(seed)
+                    numpy.random.shuffle(partition_train)
+                partition_h5 = h5py.File(temp_partition_path, 'w')
+                hdf5_util.create_dataset_from_data(partition_h5, file_structure.Partitions.test, partition_test)
+                hdf5_util.create_dataset_from_data(partition_h5, file_structure.Partitions.train, partition_train)
+                target_h5.close()
+                partition_h5.close()
+                source_partition_h5.close()
+                hdf5_util.set_property(temp_partition_path, 'train_percentage', train_percentage)
+                hdf5_util.set_property(temp_partition_path, 'oversample', local_parameters['oversample'])
+                hdf5_util.set_property(temp_partition_path, 'shuffle', local_parameters['shuffle'])
+                file_util.move_file(temp_partition_path, partition_path)
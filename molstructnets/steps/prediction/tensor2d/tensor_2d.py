@@ -3,7 +3,7 @@ from keras import models
 import numpy
 
 from steps.prediction.shared.tensor2d import prediction_array
-from util import data_validation, file_structure, progressbar, logger, file_util, hdf5_util, misc
+from util import data_validation, file_structure, progressbar, logger, file_util, hdf5_util
 
 
 class Tensor2D:
@@ -25,6 +25,20 @@ class Tensor2D:
         parameters.append({'id': 'number_predictions', 'name': 'Predictions per data point', 'type': int, 'default': 1,
                            'min': 1, 'description': 'The number of times a data point is predicted (with different'
                                                     ' transformations). The result is the mean of all predictions. Default: 1'})
+        parameters.append({'id': 'sparse', 'name': 'Sparse Batches', 'type': bool, 'default': False,
+                           'description': 'Pass the batches from preprocessing to the network in a sparse format. This'
+                                          ' needs less memory, so more batches can be preprocessed in advance.'
+                                          ' Default: False'})
+        parameters.append({'id': 'prefetch_batches', 'name': 'Prefetched Batches', 'type': int, 'default': 10,
+                           'min': 1, 'description': 'Number of batches that are preprocessed ahead of the network. Up to'
+                                                    ' this number of batches is ready while as many are being'
+                                                    ' preprocessed. Default: 10'})
+        parameters.append({'id': 'workers', 'name': 'Workers', 'type': int, 'default': 1, 'min': 0,
+                           'description': 'Number of threads (or processes) that assemble batches for the network.'
+                                          ' Default: 1'})
+        parameters.append({'id': 'use_multiprocessing', 'name': 'Worker Processes', 'type': bool, 'default': False,
+                           'description': 'Assemble the batches in worker processes instead of threads. Each worker'
+                                          ' then preprocesses its batches itself. Default: False'})
         return parameters
 
     @staticmethod
@@ -38,19 +52,25 @@ class Tensor2D:
         if file_util.file_exists(prediction_path):
             logger.log('Skipping step: ' + prediction_path + ' already exists')
         else:
+            # Worker processes assemble their batches themselves, otherwise the worker threads share a process pool
             array = prediction_array.PredictionArrays(global_parameters, local_parameters['batch_size'],
-                                                      transformations=local_parameters['number_predictions'])
-            predictions = numpy.zeros((len(array.input), 2))
+                                                      transformations=local_parameters['number_predictions'],
+                                                      multi_process=not local_parameters['use_multiprocessing'],
+                                                      sparse=local_parameters['sparse'],
+                                                      prefetch_batches=local_parameters['prefetch_batches'])
+            predictions = numpy.zeros((len(array), 2))
             temp_prediction_path = file_util.get_temporary_file_path('tensor_prediction')
             model_path = file_structure.get_network_file(global_parameters)
             model = models.load_model(model_path)
             logger.log('Predicting data')
-            chunks = misc.chunk_by_size(len(array.input), local_parameters['batch_size'])
-            with progressbar.ProgressBar(len(array.input) * local_parameters['number_predictions']) as progress:
+            with progressbar.ProgressBar(len(array) * local_parameters['number_predictions']) as progress:
                 for iteration in range(local_parameters['number_predictions']):
-                    for chunk in chunks:
-                        predictions[chunk['start']:chunk['end']] += model.predict(array.input.next())[:]
-                        progress.increment(chunk['size'])
+                    # The epoch of the sequence selects the transformation
+                    array.sequence.epoch = iteration
+                    predictions += model.predict_generator(array.sequence, workers=local_parameters['workers'],
+                                                           use_multiprocessing=local_parameters['use_multiprocessing'],
+                                                           max_queue_size=array.prefetch_batches)
+                    progress.increment(len(array))
             predictions /= local_parameters['number_predictions']
             array.close()
             prediction_h5 = h5py.File(temp_prediction_path, 'w')
@@ -21,37 +21,45 @@ class Properties:
     selected = [formal_charge, aromatic, number_neighbors, valence, in_ring, mol_log_p, mol_mr, partial_charge, asa]
 
 
-def get_chemical_properties(atom, properties=None):
+def get_chemical_properties_matrix(molecule, properties=None):
+    # Returns a (number atoms, number properties) matrix, molecule wide descriptors are only calculated once
     if properties is None:
         properties = Properties.selected
-    values = numpy.zeros(len(properties), dtype='float32')
+    atoms = list(molecule.GetAtoms())
+    values = numpy.zeros((len(atoms), len(properties)), dtype='float32')
+    crippen_contributions = None
     for i in range(len(properties)):
         if properties[i] == Properties.atomic_number:
-            values[i] = atom.GetAtomicNum()
+            values[:, i] = [atom.GetAtomicNum() for atom in atoms]
         if properties[i] == Properties.formal_charge:
-            values[i] = atom.GetFormalCharge()
+            values[:, i] = [atom.GetFormalCharge() for atom in atoms]
         if properties[i] == Properties.aromatic:
-            values[i] = atom.GetIsAromatic()
+            values[:, i] = [atom.GetIsAromatic() for atom in atoms]
         if properties[i] == Properties.isotope:
-            values[i] = atom.GetIsotope()
+            values[:, i] = [atom.GetIsotope() for atom in atoms]
         if properties[i] == Properties.mass:
-            values[i] = atom.GetMass()
+            values[:, i] = [atom.GetMass() for atom in atoms]
         if properties[i] == Properties.number_neighbors:
-            values[i] = len(atom.GetNeighbors())
+            values[:, i] = [atom.GetDegree() for atom in atoms]
         if properties[i] == Properties.number_hs:
-            values[i] = atom.GetTotalNumHs()
+            values[:, i] = [atom.GetTotalNumHs() for atom in atoms]
         if properties[i] == Properties.valence:
-            values[i] = atom.GetTotalValence()
+            values[:, i] = [atom.GetTotalValence() for atom in atoms]
         if properties[i] == Properties.in_ring:
-            values[i] = int(atom.IsInRing())
-        if properties[i] == Properties.mol_log_p:
-            values[i] = rdMolDescriptors._CalcCrippenContribs(atom.GetOwningMol())[atom.GetIdx()][0]
-        if properties[i] == Properties.mol_mr:
-            values[i] = rdMolDescriptors._CalcCrippenContribs(atom.GetOwningMol())[atom.GetIdx()][1]
+            values[:, i] = [atom.IsInRing() for atom in atoms]
+        if properties[i] == Properties.mol_log_p or properties[i] == Properties.mol_mr:
+            if crippen_contributions is None:
+                crippen_contributions = numpy.array(rdMolDescriptors._CalcCrippenContribs(molecule),
+                                                    dtype='float32').reshape(-1, 2)
+            if properties[i] == Properties.mol_log_p:
+                values[:, i] = crippen_contributions[:, 0]
+            else:
+                values[:, i] = crippen_contributions[:, 1]
         if properties[i] == Properties.partial_charge:
-            if atom.HasProp('_GasteigerCharge') < 1:
-                rdPartialCharges.ComputeGasteigerCharges(atom.GetOwningMol())
-            values[i] == atom.GetDoubleProp('_GasteigerCharge')
+            rdPartialCharges.ComputeGasteigerCharges(molecule)
+            values[:, i] = [atom.GetDoubleProp('_GasteigerCharge') for atom in atoms]
+            # Gasteiger charges are not defined for all elements
+            values[~numpy.isfinite(values[:, i]), i] = 0
         if properties[i] == Properties.asa:
-            values[i] == list(rdMolDescriptors._CalcLabuteASAContribs(atom.GetOwningMol())[0])[atom.GetIdx()]
+            values[:, i] = list(rdMolDescriptors._CalcLabuteASAContribs(molecule)[0])
     return values
@@ -0,0 +1,118 @@
+import h5py
+import numpy
+from rdkit import Chem
+
+from util import file_structure, file_util, hdf5_util, misc, process_pool, multi_process_progressbar, logger, \
+    artifact_cache
+
+
+class MoleculeStore:
+
+    # Read access to the parsed RDKit molecules of a data set. The molecules are stored in their binary form in one
+    # memory mapped blob, so an instance can be sent to worker processes (only the path is pickled) which then share
+    # the page cache instead of parsing and sanitizing the SMILES again.
+
+    def __init__(self, path):
+        self._path = path
+        self._offsets = None
+        self._molecules = None
+
+    def _load(self):
+        self._offsets = hdf5_util.memory_map(self._path, file_structure.MoleculeStore.offsets)
+        self._molecules = hdf5_util.memory_map(self._path, file_structure.MoleculeStore.molecules)
+
+    def get(self, index):
+        # Returns the molecule at the given data set index (None if the SMILES could not be parsed)
+        if self._offsets is None:
+            self._load()
+        start = self._offsets[index]
+        end = self._offsets[index + 1]
+        if start == end:
+            return None
+        return Chem.Mol(self._molecules[start:end].tobytes())
+
+    def __len__(self):
+        if self._offsets is None:
+            self._load()
+        return len(self._offsets) - 1
+
+    def __getstate__(self):
+        return self._path
+
+    def __setstate__(self, state):
+        self._path = state
+        self._offsets = None
+        self._molecules = None
+
+
+def get_molecule(smiles, index, molecules=None):
+    # Returns the molecule from the store if one is given, otherwise the SMILES is parsed
+    if molecules is not None:
+        return molecules.get(index)
+    return Chem.MolFromSmiles(smiles.decode('utf-8'))
+
+
+def get_file(global_parameters):
+    # Named by the content of the data set and shared by all data sets in the artifacts folder, so converted or renamed
+    # copies find the same file
+    file_name = 'molecules_' + artifact_cache.data_set_digest(global_parameters) + '.h5'
+    return file_util.resolve_subpath(artifact_cache.get_folder(global_parameters), file_name)
+
+
+def load(global_parameters):
+    # Returns the store of the given data set or None if it has not been written
+    path = get_file(global_parameters)
+    if file_util.file_exists(path):
+        return MoleculeStore(path)
+    return None
+
+
+def write_molecules(global_parameters, smiles):
+    path = get_file(global_parameters)
+    # Experiments running at the same time wait for the one that writes the file
+    with file_util.FileLock(path):
+        if file_util.file_exists(path):
+            return path
+        logger.log('Parsing molecules')
+        chunks = misc.chunk(len(smiles), process_pool.default_number_processes)
+        with process_pool.ProcessPool(len(chunks)) as pool:
+            with multi_process_progressbar.MultiProcessProgressbar(len(smiles), value_buffer=100) as progress:
+                for chunk in chunks:
+                    pool.submit(convert_chunk, smiles[chunk['start']:chunk['end']], progress=progress.get_slave())
+                results = pool.get_results()
+        temp_path = file_util.get_temporary_file_path('molecules')
+        molecules_h5 = h5py.File(temp_path, 'w')
+        # Contiguous and uncompressed so that the data sets can be memory mapped
+        offsets = molecules_h5.create_dataset(file_structure.MoleculeStore.offsets, (len(smiles) + 1,), dtype='int64')
+        molecules = molecules_h5.create_dataset(file_structure.MoleculeStore.molecules,
+                                                (sum(len(result[1]) for result in results),), dtype='uint8')
+        offsets[0] = 0
+        offset = 0
+        for i in range(len(chunks)):
+            sizes, blob = results[i]
+            offsets[chunks[i]['start'] + 1:chunks[i]['end'] + 1] = offset + numpy.cumsum(sizes)
+            if len(blob) > 0:
+                molecules[offset:offset + len(blob)] = numpy.frombuffer(blob, dtype='uint8')
+            offset += len(blob)
+        hdf5_util.set_property(molecules_h5, file_structure.MoleculeStore.data_set_hash,
+                               artifact_cache.data_set_digest(global_parameters))
+        molecules_h5.close()
+        file_util.move_file(temp_path, path)
+        return path
+
+
+def convert_chunk(smiles, progress=None):
+    # Returns the size of each binary molecule and the concatenated binaries
+    sizes = numpy.zeros(len(smiles), dtype='int64')
+    binaries = list()
+    for i in range(len(smiles)):
+        molecule = Chem.MolFromSmiles(smiles[i].decode('utf-8'))
+        if molecule is not None:
+            # All properties are kept, the 2D depiction of a molecule depends on the ones computed while parsing
+            binaries.append(molecule.ToBinary(Chem.PropertyPickleOptions.AllProps))
+            sizes[i] = len(binaries[-1])
+        if progress is not None:
+            progress.increment()
+    if progress is not None:
+        progress.finish()
+    return sizes, b''.join(binaries)
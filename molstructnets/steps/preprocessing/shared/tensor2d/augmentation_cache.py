@@ -0,0 +1,122 @@
+import h5py
+import numpy
+
+from steps.preprocessing.shared.tensor2d import tensor_2d_array, tensor_2d_sequence, sparse_batch
+from util import file_structure, file_util, hdf5_util, misc, logger, progressbar, constants, artifact_cache
+
+# Entries are written in chunks of this many (compressed with LZF, which is fast enough to be bounded by the disk)
+chunk_size = 65536
+
+
+class AugmentationCache:
+
+    # Pre-rasterized training epochs in sparse format. The first epochs of a Tensor2DSequence are stored in their
+    # order, batch by batch, so reading an epoch is a sequential read and the batches are identical to the ones
+    # rasterized on the fly. Only the path is pickled.
+
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+
+    def _load(self):
+        self._file = h5py.File(self._path, 'r')
+        self._batch_offsets = self._file[file_structure.AugmentationCache.batch_offsets][:]
+        self._shape = tuple(self._file.attrs[file_structure.AugmentationCache.shape])
+        self._batch_size = int(self._file.attrs[file_structure.AugmentationCache.batch_size])
+        self._variants = int(self._file.attrs[file_structure.AugmentationCache.variants])
+
+    @property
+    def variants(self):
+        if self._file is None:
+            self._load()
+        return self._variants
+
+    def get(self, variant, index):
+        # Returns the SparseBatch with the given index of the cached epoch variant
+        if self._file is None:
+            self._load()
+        number_batches = len(self._batch_offsets) // self._variants
+        start = self._batch_offsets[variant * number_batches + index]
+        end = self._batch_offsets[variant * number_batches + index + 1]
+        indices = self._file[file_structure.AugmentationCache.indices][start:end].astype('int32')
+        values = self._file[file_structure.AugmentationCache.values][start:end]
+        size = min(self._batch_size, self._shape[0] - index * self._batch_size)
+        return sparse_batch.SparseBatch((size,) + self._shape[1:], indices, values)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __getstate__(self):
+        return self._path
+
+    def __setstate__(self, state):
+        self._path = state
+        self._file = None
+
+
+def get_file(global_parameters, array, batch_size, variants, sampler=None):
+    # The balanced sampler draws its orders from the classes, so the target is one of the inputs
+    parameters = dict()
+    parameters['indices'] = misc.hash_array(array.indices)
+    parameters['seed'] = global_parameters[constants.GlobalParameters.seed]
+    parameters['batch_size'] = batch_size
+    parameters['variants'] = variants
+    if sampler is not None:
+        parameters['sampler'] = sampler.parameters
+    preprocessed_path = global_parameters[constants.GlobalParameters.preprocessed_data]
+    inputs = {'preprocessed': artifact_cache.file_digest(global_parameters, preprocessed_path),
+              'target': artifact_cache.file_digest(global_parameters,
+                                                   file_structure.get_target_file(global_parameters))}
+    return artifact_cache.get_file(global_parameters, 'augmentation_cache', parameters, inputs)
+
+
+def write_cache(global_parameters, path, batch_size, variants, multi_process=True, prefetch_batches=10,
+                sampler=None):
+    # Rasterizes the first variants epochs of the training data the same way TrainingArrays does
+    # Experiments running at the same time wait for the one that writes the file
+    with file_util.FileLock(path):
+        if file_util.file_exists(path):
+            return path
+        logger.log('Writing ' + str(variants) + ' augmented variants of the training data')
+        array = tensor_2d_array.load_array(global_parameters, train=True, transform=True, multi_process=multi_process,
+                                           sparse=True)
+        sequence = tensor_2d_sequence.Tensor2DSequence(array, batch_size,
+                                                       global_parameters[constants.GlobalParameters.seed], shuffle=True,
+                                                       prefetch_batches=prefetch_batches, sampler=sampler)
+        dtype = 'int16'
+        if max(array.shape[1:] + (batch_size,)) >= numpy.iinfo('int16').max:
+            dtype = 'int32'
+        temp_path = file_util.get_temporary_file_path('augmentation_cache')
+        cache_h5 = h5py.File(temp_path, 'w')
+        indices = cache_h5.create_dataset(file_structure.AugmentationCache.indices, (0, 4), dtype=dtype,
+                                          maxshape=(None, 4), chunks=(chunk_size, 4), compression='lzf')
+        # The values are stored in the dtype of the array, which dense batches have as well
+        values = cache_h5.create_dataset(file_structure.AugmentationCache.values, (0,), dtype=array.dtype,
+                                         maxshape=(None,), chunks=(chunk_size,), compression='lzf')
+        batch_offsets = numpy.zeros(variants * len(sequence) + 1, dtype='int64')
+        offset = 0
+        with progressbar.ProgressBar(variants * len(sequence)) as progress:
+            for variant in range(variants):
+                for index in range(len(sequence)):
+                    batch = sequence.get(variant, index, dense=False)
+                    end = offset + len(batch.values)
+                    indices.resize((end, 4))
+                    indices[offset:end] = batch.indices
+                    values.resize((end,))
+                    values[offset:end] = batch.values
+                    offset = end
+                    batch_offsets[variant * len(sequence) + index + 1] = offset
+                    progress.increment()
+        cache_h5.create_dataset(file_structure.AugmentationCache.batch_offsets, data=batch_offsets)
+        hdf5_util.set_property(cache_h5, file_structure.AugmentationCache.variants, variants)
+        hdf5_util.set_property(cache_h5, file_structure.AugmentationCache.batch_size, batch_size)
+        # The first dimension is the number of items per epoch
+        epoch_length = len(sampler) if sampler is not None else len(array)
+        hdf5_util.set_property(cache_h5, file_structure.AugmentationCache.shape, (epoch_length,) + array.shape[1:])
+        cache_h5.close()
+        sequence.close()
+        array.close()
+        file_util.move_file(temp_path, path)
+        return path
@@ -0,0 +1,43 @@
+import numpy
+
+from util import misc
+
+
+class BalancedSampler:
+
+    # Epoch orders in which both classes are equally frequent, as an alternative to oversampled partitions. A class
+    # with fewer items than its half of the epoch is drawn with replacement, the other one without, so by default
+    # (twice the size of the majority class) every majority item appears once per epoch. Like the orders of a
+    # Tensor2DSequence an epoch only depends on the seed and its number.
+
+    def __init__(self, classes, seed=0, length=None):
+        # classes holds the classes of the array items, an item belongs to the first class if its first value is at
+        # least as large as the second
+        first = classes[:, 0] >= classes[:, 1]
+        self._positions = [numpy.nonzero(first)[0], numpy.nonzero(~first)[0]]
+        if len(self._positions[0]) == 0 or len(self._positions[1]) == 0:
+            raise ValueError('One of the classes is not represented')
+        if length is None:
+            length = 2 * max(len(positions) for positions in self._positions)
+        self._length = length
+        self._seed = seed
+
+    def __len__(self):
+        return self._length
+
+    def order(self, epoch):
+        # Returns the positions of the array items in the order of the given epoch
+        random_ = misc.epoch_random(self._seed, epoch)
+        orders = list()
+        for i in range(len(self._positions)):
+            count = self._length // 2 + (self._length % 2 if i == 0 else 0)
+            positions = self._positions[i]
+            orders.append(random_.choice(positions, count, replace=count > len(positions)))
+        order = numpy.concatenate(orders)
+        random_.shuffle(order)
+        return order
+
+    @property
+    def parameters(self):
+        # Everything the orders depend on besides the classes
+        return {'seed': self._seed, 'length': self._length}
@@ -1,46 +1,76 @@
+import numpy
+
+
 def calculate(molecule, atom_positions):
+    bonds = [(bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()) for bond in molecule.GetBonds()]
+    atom_positions = [atom_positions[atom.GetIdx()] for atom in molecule.GetAtoms()]
+    bond_positions_list = calculate_from_bonds(bonds, atom_positions)
     bond_positions = dict()
-    occupied_positions = set()
-    for atom in molecule.GetAtoms():
-        occupied_positions.add((atom_positions[atom.GetIdx()][0], atom_positions[atom.GetIdx()][1]))
     for bond in molecule.GetBonds():
-        positions = list()
-        x1 = atom_positions[bond.GetBeginAtomIdx()][0]
-        y1 = atom_positions[bond.GetBeginAtomIdx()][1]
-        x2 = atom_positions[bond.GetEndAtomIdx()][0]
-        y2 = atom_positions[bond.GetEndAtomIdx()][1]
-        f = LinearFunction(x1, y1, x2, y2)
-        for x in range(min(x1, x2) + 1, max(x1, x2)):
-            y = round(f.get_y(x))
-            position = (x, y)
-            if position not in occupied_positions:
-                occupied_positions.add(position)
-                positions.append(position)
-        for y in range(min(y1, y2) + 1, max(y1, y2)):
-            x = round(f.get_x(y))
-            position = (x, y)
-            if position not in occupied_positions:
-                occupied_positions.add(position)
-                positions.append(position)
-        bond_positions[bond.GetIdx()] = positions
+        bond_positions[bond.GetIdx()] = bond_positions_list[bond.GetIdx()]
+    return bond_positions
+
+
+def calculate_from_bonds(bonds, atom_positions):
+    # bonds contains the begin and end atom index of each bond, returns the list of positions for each bond
+    positions, bond_indices = calculate_array(bonds, atom_positions)
+    bond_positions = [list() for i in range(len(bonds))]
+    for position, bond_index in zip(positions.tolist(), bond_indices.tolist()):
+        bond_positions[bond_index].append(tuple(position))
     return bond_positions
 
 
-class LinearFunction:
+def calculate_array(bonds, atom_positions):
+    # bonds is a (m, 2) array with the begin and end atom index of each bond, atom_positions is a (n, 2) array. Returns
+    # the (k, 2) positions of all bonds and the (k,) index of the bond each position belongs to, ordered by bond.
+    # Positions are claimed first-come: atoms first, then the bonds in their order, each along x and then along y.
+    bonds = numpy.asarray(bonds, dtype='int64').reshape(-1, 2)
+    atom_positions = numpy.asarray(atom_positions, dtype='int64').reshape(-1, 2)
+    if len(bonds) == 0:
+        return numpy.zeros((0, 2), dtype='int64'), numpy.zeros(0, dtype='int64')
+    x1 = atom_positions[bonds[:, 0], 0]
+    y1 = atom_positions[bonds[:, 0], 1]
+    x2 = atom_positions[bonds[:, 1], 0]
+    y2 = atom_positions[bonds[:, 1], 1]
+    vertical = x1 == x2
+    # Line through both atoms: y = m * x + b along x and x = (y - b) / m along y, vertical bonds keep the x of their
+    # atoms
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        m = (y1 - y2) / (x1 - x2)
+        b = y1 - m * x1
+    # Points along x (the y of vertical bonds is never needed as they have no points along x)
+    x_bonds, xs = ranges(numpy.minimum(x1, x2) + 1, numpy.maximum(x1, x2))
+    x_points = numpy.stack([xs, numpy.round(m[x_bonds] * xs + b[x_bonds])], axis=1)
+    # Points along y
+    y_bonds, ys = ranges(numpy.minimum(y1, y2) + 1, numpy.maximum(y1, y2))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        y_xs = numpy.where(vertical[y_bonds], x1[y_bonds], numpy.round((ys - b[y_bonds]) / m[y_bonds]))
+    y_points = numpy.stack([y_xs, ys], axis=1)
+    positions = numpy.concatenate([x_points, y_points]).astype('int64')
+    bond_indices = numpy.concatenate([x_bonds, y_bonds])
+    # Order by bond and within a bond the points along x before the ones along y
+    order = numpy.argsort(bond_indices * 2 + numpy.repeat([0, 1], [len(x_bonds), len(y_bonds)]), kind='stable')
+    positions = positions[order]
+    bond_indices = bond_indices[order]
+    # Keep a position only if no atom occupies it and it is its first occurrence
+    all_positions = numpy.concatenate([atom_positions, positions])
+    minimum = all_positions.min(axis=0)
+    size = all_positions.max(axis=0) - minimum + 1
+    atom_keys = (atom_positions[:, 0] - minimum[0]) * size[1] + atom_positions[:, 1] - minimum[1]
+    keys = (positions[:, 0] - minimum[0]) * size[1] + positions[:, 1] - minimum[1]
+    occupied = numpy.zeros(size[0] * size[1], dtype='bool')
+    occupied[atom_keys] = True
+    first = numpy.zeros(len(keys), dtype='bool')
+    first[numpy.unique(keys, return_index=True)[1]] = True
+    keep = first & ~occupied[keys]
+    return positions[keep], bond_indices[keep]
 
-    def __init__(self, x1, y1, x2, y2):
-        if x1 - x2 == 0:
-            self.x = x1
-        else:
-            self.x = None
-            self.m = (y1 - y2) / (x1 - x2)
-            self.b = y1 - self.m * x1
 
-    def get_x(self, y):
-        if self.x is not None:
-            return self.x
-        else:
-            return (y - self.b) / self.m
+def ranges(starts, ends):
+    # Concatenates range(starts[i], ends[i]) for all i, returns the index i and the value of every element
+    counts = numpy.maximum(ends - starts, 0)
+    indices = numpy.repeat(numpy.arange(len(counts)), counts)
+    offsets = numpy.cumsum(counts) - counts
+    values = starts[indices] + numpy.arange(counts.sum()) - offsets[indices]
+    return indices, values
 
-    def get_y(self, x):
-        return self.m * x + self.b
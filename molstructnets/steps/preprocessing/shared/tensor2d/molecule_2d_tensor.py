@@ -11,54 +11,77 @@ padding = 2
 def molecule_to_2d_tensor(molecule, index_lookup, rasterizer_, preprocessed_shape, atom_locations_shape=None,
                           transformer_=None, random_=None, flip=False, rotation=0, chemical_properties_=[],
                           data_type='float32'):
-    # We redo this if the transformation size does not fit
-    while True:
-        try:
-            preprocessed_row = numpy.zeros((preprocessed_shape[1], preprocessed_shape[2], preprocessed_shape[3]),
-                                           dtype=data_type)
-            if atom_locations_shape is None:
-                atom_locations_row = None
+    if len(chemical_properties_) > 0:
+        chemical_property_values = chemical_properties.get_chemical_properties_matrix(molecule, chemical_properties_)
+    AllChem.Compute2DCoords(molecule)
+    coordinates = molecule.GetConformer().GetPositions()[:, :2]
+    if transformer_ is not None and random_ is not None:
+        flip = bool(random_.getrandbits(1))
+        rotation = random_.randrange(0, 360)
+        atom_positions = rasterize_atoms(coordinates, rasterizer_, transformer_, flip, rotation)
+        transformations = None
+        while not fits(atom_positions, preprocessed_shape):
+            # Instead of retrying draw from the transformations that fit
+            if transformations is None:
+                transformations = transformer_.fitting_transformations(coordinates, rasterizer_,
+                                                                       preprocessed_shape[1:])
             else:
-                atom_locations_row = numpy.full((atom_locations_shape[1], atom_locations_shape[2]), -1, dtype='int16')
-            atom_positions = dict()
-            AllChem.Compute2DCoords(molecule)
-            if transformer_ is not None and random_ is not None:
-                flip = bool(random_.getrandbits(1))
-                rotation = random_.randrange(0, 360)
-            for atom in molecule.GetAtoms():
-                position = molecule.GetConformer().GetAtomPosition(atom.GetIdx())
-                x = position.x
-                y = position.y
-                if transformer_ is not None:
-                    x, y = transformer_.apply(x, y, flip, rotation)
-                x, y = rasterizer_.apply(x, y)
-                # Check if coordinates fit into the shape
-                if (not 0 <= x < preprocessed_row.shape[0]) or (not 0 <= y < preprocessed_row.shape[1]):
-                    # Redo everything hoping for a better fitting transformation
-                    raise ValueError()
-                if atom.GetSymbol() in index_lookup:
-                    symbol_index = index_lookup[atom.GetSymbol()]
-                    preprocessed_row[x, y, symbol_index] = 1
-                if len(chemical_properties_) > 0:
-                    preprocessed_row[x, y, len(index_lookup):] = \
-                        chemical_properties.get_chemical_properties(atom, chemical_properties_)[:]
-                if atom_locations_row is not None:
-                    atom_locations_row[atom.GetIdx(), 0] = x
-                    atom_locations_row[atom.GetIdx(), 1] = y
-                atom_positions[atom.GetIdx()] = [x, y]
-            bond_positions_ = bond_positions.calculate(molecule, atom_positions)
-            for bond in molecule.GetBonds():
-                bond_symbol = bond_symbols.get_bond_symbol(bond.GetBondType())
-                if bond_symbol is not None and bond_symbol in index_lookup:
-                    bond_symbol_index = index_lookup[bond_symbol]
-                    for position in bond_positions_[bond.GetIdx()]:
-                        preprocessed_row[position[0], position[1], bond_symbol_index] = 1
-            if with_empty_bits and ' ' in index_lookup:
-                set_empty_bits(preprocessed_row, len(index_lookup), index_lookup[' '])
-            return preprocessed_row, atom_locations_row
-        except ValueError:
-            # Redo everything hoping for a better fitting transformation
-            pass
+                # Rounding errors can make a transformation at the border of the grid fail
+                transformations = numpy.delete(transformations, index, axis=0)
+            if len(transformations) == 0:
+                raise ValueError('Molecule does not fit into the grid with any transformation')
+            index = random_.randrange(len(transformations))
+            flip = bool(transformations[index, 0])
+            rotation = int(transformations[index, 1])
+            atom_positions = rasterize_atoms(coordinates, rasterizer_, transformer_, flip, rotation)
+    else:
+        atom_positions = rasterize_atoms(coordinates, rasterizer_, transformer_, flip, rotation)
+        if not fits(atom_positions, preprocessed_shape):
+            raise ValueError('Position out of bounds')
+    preprocessed_row = numpy.zeros((preprocessed_shape[1], preprocessed_shape[2], preprocessed_shape[3]),
+                                   dtype=data_type)
+    if atom_locations_shape is None:
+        atom_locations_row = None
+    else:
+        atom_locations_row = numpy.full((atom_locations_shape[1], atom_locations_shape[2]), -1, dtype='int16')
+    for atom in molecule.GetAtoms():
+        x, y = atom_positions[atom.GetIdx()]
+        if atom.GetSymbol() in index_lookup:
+            symbol_index = index_lookup[atom.GetSymbol()]
+            preprocessed_row[x, y, symbol_index] = 1
+        if len(chemical_properties_) > 0:
+            preprocessed_row[x, y, len(index_lookup):] = chemical_property_values[atom.GetIdx()]
+        if atom_locations_row is not None:
+            atom_locations_row[atom.GetIdx(), 0] = x
+            atom_locations_row[atom.GetIdx(), 1] = y
+    bond_positions_ = bond_positions.calculate(molecule, atom_positions)
+    for bond in molecule.GetBonds():
+        bond_symbol = bond_symbols.get_bond_symbol(bond.GetBondType())
+        if bond_symbol is not None and bond_symbol in index_lookup:
+            bond_symbol_index = index_lookup[bond_symbol]
+            for position in bond_positions_[bond.GetIdx()]:
+                preprocessed_row[position[0], position[1], bond_symbol_index] = 1
+    if with_empty_bits and ' ' in index_lookup:
+        set_empty_bits(preprocessed_row, len(index_lookup), index_lookup[' '])
+    return preprocessed_row, atom_locations_row
+
+
+def rasterize_atoms(coordinates, rasterizer_, transformer_=None, flip=False, rotation=0):
+    atom_positions = dict()
+    for i in range(len(coordinates)):
+        x = coordinates[i, 0]
+        y = coordinates[i, 1]
+        if transformer_ is not None:
+            x, y = transformer_.apply(x, y, flip, rotation)
+        atom_positions[i] = list(rasterizer_.apply(x, y))
+    return atom_positions
+
+
+def fits(atom_positions, preprocessed_shape):
+    for x, y in atom_positions.values():
+        if (not 0 <= x < preprocessed_shape[1]) or (not 0 <= y < preprocessed_shape[2]):
+            return False
+    return True
 
 
 def set_empty_bits(preprocessed_row, number_symbols, empty_symbol_index):
@@ -0,0 +1,172 @@
+import h5py
+import numpy
+from rdkit.Chem import AllChem
+
+from steps.preprocessing.shared.moleculestore import molecule_store
+from util import file_structure, file_util, hdf5_util, misc, process_pool, multi_process_progressbar, logger, \
+    artifact_cache
+
+data_set_names = [file_structure.MoleculeCoordinates.atom_offsets, file_structure.MoleculeCoordinates.coordinates,
+                  file_structure.MoleculeCoordinates.atomic_numbers, file_structure.MoleculeCoordinates.bond_offsets,
+                  file_structure.MoleculeCoordinates.bonds]
+
+
+class MoleculeCoordinates:
+
+    # Read access to the 2D depiction of every molecule in a data set. The data is memory mapped and loaded lazily,
+    # so an instance can be sent to worker processes (only the path is pickled) which then share the page cache.
+
+    def __init__(self, path):
+        self._path = path
+        self._arrays = None
+
+    def _load(self):
+        self._arrays = dict()
+        for name in data_set_names:
+            self._arrays[name] = hdf5_util.memory_map(self._path, name)
+
+    def get(self, index):
+        # Returns the (n, 2) coordinates, the (n,) atomic numbers and the (m, 3) bonds (begin, end, type)
+        if self._arrays is None:
+            self._load()
+        atom_offsets = self._arrays[file_structure.MoleculeCoordinates.atom_offsets]
+        bond_offsets = self._arrays[file_structure.MoleculeCoordinates.bond_offsets]
+        atom_start = atom_offsets[index]
+        atom_end = atom_offsets[index + 1]
+        bond_start = bond_offsets[index]
+        bond_end = bond_offsets[index + 1]
+        return self._arrays[file_structure.MoleculeCoordinates.coordinates][atom_start:atom_end], \
+            self._arrays[file_structure.MoleculeCoordinates.atomic_numbers][atom_start:atom_end], \
+            self._arrays[file_structure.MoleculeCoordinates.bonds][bond_start:bond_end]
+
+    def get_range(self, start, end):
+        # Returns the coordinates, atomic numbers and bonds of all molecules in the given range concatenated
+        if self._arrays is None:
+            self._load()
+        atom_offsets = self._arrays[file_structure.MoleculeCoordinates.atom_offsets]
+        bond_offsets = self._arrays[file_structure.MoleculeCoordinates.bond_offsets]
+        return self._arrays[file_structure.MoleculeCoordinates.coordinates][atom_offsets[start]:atom_offsets[end]], \
+            self._arrays[file_structure.MoleculeCoordinates.atomic_numbers][atom_offsets[start]:atom_offsets[end]], \
+            self._arrays[file_structure.MoleculeCoordinates.bonds][bond_offsets[start]:bond_offsets[end]]
+
+    def sizes(self):
+        # Returns the number of molecules, atoms and bonds
+        if self._arrays is None:
+            self._load()
+        atom_offsets = self._arrays[file_structure.MoleculeCoordinates.atom_offsets]
+        bond_offsets = self._arrays[file_structure.MoleculeCoordinates.bond_offsets]
+        return len(atom_offsets) - 1, int(atom_offsets[-1]), int(bond_offsets[-1])
+
+    def __getstate__(self):
+        return self._path
+
+    def __setstate__(self, state):
+        self._path = state
+        self._arrays = None
+
+
+def from_molecule(molecule):
+    AllChem.Compute2DCoords(molecule)
+    coordinates = molecule.GetConformer().GetPositions()[:, :2].astype('float32')
+    atomic_numbers = numpy.array([atom.GetAtomicNum() for atom in molecule.GetAtoms()], dtype='int16')
+    bonds = numpy.array([[bond.GetBeginAtomIdx(), bond.GetEndAtomIdx(), int(bond.GetBondType())]
+                         for bond in molecule.GetBonds()], dtype='int16').reshape(-1, 3)
+    return coordinates, atomic_numbers, bonds
+
+
+def get_file(global_parameters):
+    # Named by the content of the data set and shared by all data sets in the artifacts folder, so converted or renamed
+    # copies find the same file
+    file_name = 'tensor_2d_coordinates_' + artifact_cache.data_set_digest(global_parameters) + '.h5'
+    return file_util.resolve_subpath(artifact_cache.get_folder(global_parameters), file_name)
+
+
+def write_coordinates(global_parameters, smiles, molecules=None):
+    path = get_file(global_parameters)
+    # Experiments running at the same time wait for the one that writes the file
+    with file_util.FileLock(path):
+        if file_util.file_exists(path):
+            return path
+        logger.log('Calculating 2D coordinates')
+        chunks = misc.chunk(len(smiles), process_pool.default_number_processes)
+        chunk_paths = list()
+        with process_pool.ProcessPool(len(chunks)) as pool:
+            with multi_process_progressbar.MultiProcessProgressbar(len(smiles), value_buffer=100) as progress:
+                for chunk in chunks:
+                    chunk_paths.append(file_util.get_temporary_file_path('tensor_2d_coordinates_chunk'))
+                    pool.submit(calculate_chunk, smiles[chunk['start']:chunk['end']], chunk_paths[-1], molecules,
+                                chunk['start'], progress=progress.get_slave())
+                sizes = pool.get_results()
+        number_atoms = sum(size[0] for size in sizes)
+        number_bonds = sum(size[1] for size in sizes)
+        temp_path = file_util.get_temporary_file_path('tensor_2d_coordinates')
+        coordinates_h5 = h5py.File(temp_path, 'w')
+        # Contiguous and uncompressed so that the data sets can be memory mapped
+        atom_offsets = coordinates_h5.create_dataset(file_structure.MoleculeCoordinates.atom_offsets,
+                                                     (len(smiles) + 1,), dtype='int64')
+        coordinates = coordinates_h5.create_dataset(file_structure.MoleculeCoordinates.coordinates,
+                                                    (number_atoms, 2), dtype='float32')
+        atomic_numbers = coordinates_h5.create_dataset(file_structure.MoleculeCoordinates.atomic_numbers,
+                                                       (number_atoms,), dtype='int16')
+        bond_offsets = coordinates_h5.create_dataset(file_structure.MoleculeCoordinates.bond_offsets,
+                                                     (len(smiles) + 1,), dtype='int64')
+        bonds = coordinates_h5.create_dataset(file_structure.MoleculeCoordinates.bonds, (number_bonds, 3),
+                                              dtype='int16')
+        atom_offset = 0
+        bond_offset = 0
+        for i in range(len(chunks)):
+            chunk_h5 = h5py.File(chunk_paths[i], 'r')
+            chunk_atom_counts = chunk_h5[file_structure.MoleculeCoordinates.atom_offsets][:]
+            chunk_bond_counts = chunk_h5[file_structure.MoleculeCoordinates.bond_offsets][:]
+            start = chunks[i]['start']
+            end = chunks[i]['end']
+            atom_offsets[start + 1:end + 1] = atom_offset + numpy.cumsum(chunk_atom_counts)
+            bond_offsets[start + 1:end + 1] = bond_offset + numpy.cumsum(chunk_bond_counts)
+            next_atom_offset = atom_offset + sizes[i][0]
+            next_bond_offset = bond_offset + sizes[i][1]
+            if sizes[i][0] > 0:
+                coordinates[atom_offset:next_atom_offset] = chunk_h5[file_structure.MoleculeCoordinates.coordinates][:]
+                atomic_numbers[atom_offset:next_atom_offset] = \
+                    chunk_h5[file_structure.MoleculeCoordinates.atomic_numbers][:]
+            if sizes[i][1] > 0:
+                bonds[bond_offset:next_bond_offset] = chunk_h5[file_structure.MoleculeCoordinates.bonds][:]
+            atom_offset = next_atom_offset
+            bond_offset = next_bond_offset
+            chunk_h5.close()
+            file_util.remove_file(chunk_paths[i])
+        atom_offsets[0] = 0
+        bond_offsets[0] = 0
+        hdf5_util.set_property(coordinates_h5, file_structure.MoleculeCoordinates.data_set_hash,
+                               artifact_cache.data_set_digest(global_parameters))
+        coordinates_h5.close()
+        file_util.move_file(temp_path, path)
+        return path
+
+
+def calculate_chunk(smiles, chunk_path, molecules=None, start=0, progress=None):
+    # Writes the depiction of the given molecules into chunk_path (offsets are stored as per molecule counts)
+    atom_counts = numpy.zeros(len(smiles), dtype='int64')
+    bond_counts = numpy.zeros(len(smiles), dtype='int64')
+    coordinates = list()
+    atomic_numbers = list()
+    bonds = list()
+    for i in range(len(smiles)):
+        molecule = molecule_store.get_molecule(smiles[i], start + i, molecules)
+        molecule_coordinates, molecule_atomic_numbers, molecule_bonds = from_molecule(molecule)
+        atom_counts[i] = len(molecule_atomic_numbers)
+        bond_counts[i] = len(molecule_bonds)
+        coordinates.append(molecule_coordinates)
+        atomic_numbers.append(molecule_atomic_numbers)
+        bonds.append(molecule_bonds)
+        if progress is not None:
+            progress.increment()
+    if progress is not None:
+        progress.finish()
+    chunk_h5 = h5py.File(chunk_path, 'w')
+    chunk_h5.create_dataset(file_structure.MoleculeCoordinates.atom_offsets, data=atom_counts)
+    chunk_h5.create_dataset(file_structure.MoleculeCoordinates.bond_offsets, data=bond_counts)
+    chunk_h5.create_dataset(file_structure.MoleculeCoordinates.coordinates, data=numpy.concatenate(coordinates))
+    chunk_h5.create_dataset(file_structure.MoleculeCoordinates.atomic_numbers, data=numpy.concatenate(atomic_numbers))
+    chunk_h5.create_dataset(file_structure.MoleculeCoordinates.bonds, data=numpy.concatenate(bonds))
+    chunk_h5.close()
+    return int(atom_counts.sum()), int(bond_counts.sum())
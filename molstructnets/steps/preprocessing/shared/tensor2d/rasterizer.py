@@ -1,3 +1,6 @@
+import numpy
+
+
 class Rasterizer:
 
     def __init__(self, factor, padding, min_x, max_x, min_y, max_y, square=False):
@@ -21,3 +24,7 @@ class Rasterizer:
         x = int(round((x + self.offset_x) * self.factor) + self.padding)
         y = int(round((y + self.offset_y) * self.factor) + self.padding)
         return x, y
+
+    def apply_array(self, positions):
+        offset = numpy.array([self.offset_x, self.offset_y])
+        return (numpy.round((positions + offset) * self.factor) + self.padding).astype('int64')
@@ -0,0 +1,76 @@
+import numpy
+
+# Bytes per non zero entry (sample, x, y, channel as int32 and the float32 value)
+entry_size = 20
+
+
+class SparseBatch():
+
+    # Batch of grid tensors in coordinate format. indices holds the (sample, x, y, channel) of each non zero value,
+    # sorted by sample. Entries are applied in order, so later entries at the same location take precedence just like
+    # when filling a dense array.
+
+    def __init__(self, shape, indices, values):
+        self._shape = tuple(shape)
+        self._indices = indices
+        self._values = values
+
+    @staticmethod
+    def from_preprocessed(shape, preprocessed_list):
+        # preprocessed_list holds the Tensor2DPreprocessed of every sample, ordered by their position in the batch
+        indices = list()
+        values = list()
+        for i in range(len(preprocessed_list)):
+            locations, location_values = preprocessed_list[i].entries(shape[-1])
+            sample_indices = numpy.empty((len(locations), 4), dtype='int32')
+            sample_indices[:, 0] = i
+            sample_indices[:, 1:] = locations
+            indices.append(sample_indices)
+            values.append(location_values)
+        if len(indices) == 0:
+            return SparseBatch(shape, numpy.zeros((0, 4), dtype='int32'), numpy.zeros(0, dtype='float32'))
+        return SparseBatch(shape, numpy.concatenate(indices), numpy.concatenate(values))
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def indices(self):
+        return self._indices
+
+    @property
+    def values(self):
+        return self._values
+
+    @property
+    def nbytes(self):
+        return self._indices.nbytes + self._values.nbytes
+
+    def __len__(self):
+        return self._shape[0]
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            raise TypeError('SparseBatch can only be sliced')
+        start, stop, step = item.indices(len(self))
+        if step != 1:
+            raise ValueError('SparseBatch can only be sliced with a step of 1')
+        stop = max(start, stop)
+        entry_start, entry_stop = numpy.searchsorted(self._indices[:, 0], [start, stop])
+        indices = self._indices[entry_start:entry_stop].copy()
+        indices[:, 0] -= start
+        return SparseBatch((stop - start,) + self._shape[1:], indices, self._values[entry_start:entry_stop])
+
+    def to_dense(self, dtype='float32'):
+        # dtype should be the one of the array the batch comes from, so sparse and dense batches are equal
+        array = numpy.zeros(self._shape, dtype=dtype)
+        array[self._indices[:, 0], self._indices[:, 1], self._indices[:, 2], self._indices[:, 3]] = self._values
+        return array
+
+
+def to_dense(batch, dtype='float32'):
+    # Densifies sparse batches, dense batches are returned as they are
+    if isinstance(batch, SparseBatch):
+        return batch.to_dense(dtype)
+    return batch
@@ -1,20 +1,28 @@
+import math
 import queue
-import random
+import threading
 
-import h5py
 import numpy
-from numpy import random
 
-from steps.preprocessing.shared.tensor2d import tensor_2d_preprocessor
-from util import file_structure, constants, process_pool, misc, buffered_queue
+from steps.preprocessing.shared.moleculestore import molecule_store
+from steps.preprocessing.shared.tensor2d import tensor_2d_preprocessor, molecule_coordinates, sparse_batch
+from util import file_structure, constants, process_pool, misc, file_util, shared_array, hdf5_util
+
+# Maximum size of the queues that calc_substructure_locations() and calc_atom_locations() fill, tasks are only
+# submitted to the pool while their locations fit into this many more (see feed_locations())
+location_queue_size = 10000
 
 
 class Tensor2DArray():
 
-    def __init__(self, smiles, classes, indices, preprocessed_path, random_seed, multi_process=True):
+    def __init__(self, smiles, classes, indices, preprocessed_path, random_seed, multi_process=True,
+                 coordinates_path=None, molecules_path=None, sparse=False, data_set_path=None, shuffle_seed=0):
         self._smiles = smiles
         self._classes = classes
         self._indices = indices
+        # Iteration 0 uses the given order, every later one a permutation of it seeded with (shuffle_seed, iteration)
+        self._base_indices = indices
+        self._shuffle_seed = shuffle_seed
         self._close_pool = False
         if isinstance(multi_process, process_pool.ProcessPool):
             self._pool = multi_process
@@ -23,78 +31,151 @@ class Tensor2DArray():
             self._close_pool = True
         else:
             self._pool = None
-        self._preprocessor = tensor_2d_preprocessor.Tensor2DPreprocessor(preprocessed_path)
-        self._shape = tuple([len(self._indices)] + list(self._preprocessor.shape))
+        self._preprocessor = tensor_2d_preprocessor.Tensor2DPreprocessor(preprocessed_path, coordinates_path,
+                                                                         molecules_path)
+        # If the data set file is known the workers load the preprocessor and SMILES once and tasks only carry indices
+        if data_set_path is not None:
+            self._worker_preprocessor = process_pool.WorkerObject(create_worker_preprocessor, preprocessed_path,
+                                                                  coordinates_path, molecules_path, data_set_path)
+        else:
+            self._worker_preprocessor = None
+        if molecules_path is not None:
+            self._molecules = molecule_store.MoleculeStore(molecules_path)
+        else:
+            self._molecules = None
+        self._shape = tuple([len(self._indices)] + list(self._preprocessor.array_shape))
         self._random_seed = random_seed
         self._iteration = 0
+        # Batches are returned as SparseBatch instead of dense arrays
+        self._sparse = sparse
 
     def shuffle(self):
-        random.shuffle(self._indices)
-        self._iteration += 1
+        self.set_iteration(self._iteration + 1)
 
     def set_iteration(self, iteration):
+        # Any iteration can be reached directly, the base indices are never changed (they may be a read only memory
+        # map)
         self._iteration = iteration
+        if iteration == 0:
+            self._indices = self._base_indices
+        else:
+            random_ = misc.epoch_random(self._shuffle_seed, iteration)
+            self._indices = self._base_indices[random_.permutation(len(self._base_indices))]
 
     def __len__(self):
         return self._shape[0]
 
     def __getitem__(self, item):
+        return self.submit(item).get()
+
+    def submit(self, item, iteration=None, position=None):
+        # Starts preprocessing the given items and returns a PendingBatch. Indices and seeds are fixed here, so the
+        # array can be shuffled before the batch is done. iteration and position override the values the seeds are
+        # derived from.
         indices = self._indices[item]
         single_item = False
         if not hasattr(indices, '__len__'):
             single_item = True
             indices = [indices]
+        indices = numpy.array(indices)
         random_seed = None
+        # Seeds depend on the position in the array, so that the batches of an iteration are transformed differently
+        if position is None:
+            position = 0
+            if isinstance(item, slice):
+                position = item.indices(len(self))[0]
+            elif single_item:
+                position = int(item) % len(self)
+        if iteration is None:
+            iteration = self._iteration
+        shape = [len(indices)] + list(self._preprocessor.array_shape)
         if self._pool is not None and len(indices) > 1:
-            all_results = numpy.zeros([len(indices)] + list(self._preprocessor.shape), dtype='float32')
+            # Dense batches are written by the workers directly into shared memory, sparse ones are returned by the
+            # tasks
+            all_results = None
+            if not self._sparse:
+                all_results = shared_array.SharedArray(shape, self.dtype)
+            futures = list()
             chunks = misc.chunk(len(indices), self._pool.get_number_threads())
-            data_queue = buffered_queue.BufferedQueue(10)
             for chunk in chunks:
                 indices_chunk = indices[chunk['start']:chunk['end']]
                 if self._random_seed is not None:
-                    random_seed = self._random_seed + chunk['start'] + self._iteration * len(self)
-                self._pool.submit(self._preprocessor.preprocess, self._smiles[indices_chunk], chunk['start'],
-                                  data_queue, random_seed)
-            done = 0
-            while done < len(indices):
-                preprocessed = data_queue.get()
-                preprocessed.fill_array(all_results)
-                done += 1
-            return all_results
+                    random_seed = self._random_seed + position + chunk['start'] + iteration * len(self)
+                if self._sparse:
+                    futures.append(self._submit('preprocess', indices_chunk, chunk['start'], ListQueue(),
+                                                random_seed))
+                else:
+                    futures.append(self._submit('preprocess_into', indices_chunk, chunk['start'], all_results,
+                                                random_seed))
+            return PendingBatch(shape, futures, all_results)
         else:
             if self._random_seed is not None:
-                random_seed = self._random_seed + indices[0] + self._iteration * len(self)
-            data_queue = queue.Queue()
-            self._preprocessor.preprocess(self._smiles[indices], 0, data_queue, random_seed)
-            result = numpy.zeros([len(indices)] + list(self._preprocessor.shape), dtype='float32')
-            preprocessed = data_queue.get()
-            preprocessed.fill_array(result)
+                random_seed = self._random_seed + position + iteration * len(self)
+            preprocessed = ListQueue()
+            self._preprocessor.preprocess(self._smiles[indices], 0, preprocessed, random_seed, indices)
+            if self._sparse and not single_item:
+                return PendingBatch(shape, result=sparse_batch.SparseBatch.from_preprocessed(shape, preprocessed))
+            result = numpy.zeros(shape, dtype=self.dtype)
+            for molecule in preprocessed:
+                molecule.fill_array(result)
             if single_item:
                 result = result[0]
-            return result
+            return PendingBatch(shape, result=result)
 
     def calc_substructure_locations(self, start, end, substructures, location_queue, only_substructures=False,
                                     only_atoms=False):
         random_seed = None
         if self._pool is not None and len(self._smiles) > 1:
-            chunks = misc.chunk(end - start, self._pool.get_number_threads())
-            for chunk in chunks:
+            def submit(chunk, callback_):
                 indices_chunk = range(start + chunk['start'], start + chunk['end'])
+                chunk_seed = None
                 if self._random_seed is not None:
-                    random_seed = self._random_seed + start + chunk['start'] + self._iteration * len(self)
-                self._pool.submit(self._preprocessor.substructure_locations, self._smiles[indices_chunk], substructures,
-                                  chunk['start'], location_queue, random_seed, only_substructures, only_atoms)
+                    chunk_seed = self._random_seed + start + chunk['start'] + self._iteration * len(self)
+                self._submit('substructure_locations', indices_chunk, substructures, chunk['start'], ListQueue(),
+                             chunk_seed, only_substructures, only_atoms, callback_=callback_)
+            self._feed_locations(end - start, submit, location_queue)
+        else:
+            if self._random_seed is not None:
+                random_seed = self._random_seed + start + self._iteration * len(self)
+            # In a thread, the caller only takes the locations out of its bounded queue after this returns
+            threading.Thread(target=self._preprocessor.substructure_locations,
+                             args=(self._smiles[start:end], substructures, 0, location_queue, random_seed,
+                                   only_substructures, only_atoms),
+                             kwargs={'indices': range(start, end)}, daemon=True).start()
 
     def calc_atom_locations(self, start, end, location_queue):
         random_seed = None
         if self._pool is not None and len(self._smiles) > 1:
-            chunks = misc.chunk(end - start, self._pool.get_number_threads())
-            for chunk in chunks:
+            def submit(chunk, callback_):
                 indices_chunk = range(start + chunk['start'], start + chunk['end'])
+                chunk_seed = None
                 if self._random_seed is not None:
-                    random_seed = self._random_seed + start + chunk['start'] + self._iteration * len(self)
-                self._pool.submit(self._preprocessor.atom_locations, self._smiles[indices_chunk], chunk['start'],
-                                  location_queue, random_seed)
+                    chunk_seed = self._random_seed + start + chunk['start'] + self._iteration * len(self)
+                self._submit('atom_locations', indices_chunk, chunk['start'], ListQueue(), chunk_seed,
+                             callback_=callback_)
+            self._feed_locations(end - start, submit, location_queue)
+        else:
+            if self._random_seed is not None:
+                random_seed = self._random_seed + start + self._iteration * len(self)
+            threading.Thread(target=self._preprocessor.atom_locations,
+                             args=(self._smiles[start:end], 0, location_queue, random_seed),
+                             kwargs={'indices': range(start, end)}, daemon=True).start()
+
+    def _feed_locations(self, number, submit, location_queue):
+        # Chunks are small enough that several of them fit into the location queue at once
+        number_threads = self._pool.get_number_threads()
+        chunk_size = max(1, min(math.ceil(number / number_threads), location_queue_size // number_threads))
+        chunks = misc.chunk_by_size(number, chunk_size)
+        threading.Thread(target=feed_locations, args=(chunks, submit, location_queue), daemon=True).start()
+
+    def _submit(self, function_name, indices, *args, callback_=None):
+        # Runs the preprocessor function on the molecules with the given data set indices in the pool
+        if self._worker_preprocessor is not None:
+            return self._pool.submit_async(run_worker_preprocessor, self._worker_preprocessor, function_name,
+                                           indices, *args, callback_=callback_)
+        else:
+            return self._pool.submit_async(run_preprocessor, self._preprocessor, function_name, self._smiles[indices],
+                                           indices, *args, callback_=callback_)
 
     @property
     def shape(self):
@@ -102,13 +183,41 @@ class Tensor2DArray():
 
     @property
     def dtype(self):
-        return numpy.float32
+        return self._preprocessor.dtype
+
+    @property
+    def indices(self):
+        return self._indices
+
+    @property
+    def multi_process(self):
+        return self._pool is not None
+
+    @property
+    def sparse(self):
+        return self._sparse
+
+    @property
+    def memory_shape(self):
+        # Shape of an array of the dtype that needs as much memory as a batch of all items
+        if self._sparse:
+            entry_size = sparse_batch.entry_size // numpy.dtype(self.dtype).itemsize
+            return len(self), self._preprocessor.estimate_number_entries(), entry_size
+        return self._shape
+
+    def memory_size(self, number_items):
+        # Bytes needed by a batch of the given number of items
+        return number_items * int(numpy.prod(self.memory_shape[1:])) * numpy.dtype(self.dtype).itemsize
 
     def smiles(self, item=None):
         if item is None:
             item = slice(0, len(self._indices))
         return self._smiles[self._indices[item]]
 
+    def molecule(self, item):
+        index = self._indices[item]
+        return molecule_store.get_molecule(self._smiles[index], index, self._molecules)
+
     def classes(self, item=None):
         if item is None:
             item = slice(0, len(self._indices))
@@ -119,31 +228,53 @@ class Tensor2DArray():
             self._pool.close()
 
 
-def load_array(global_parameters, train=False, test=False, transform=False, multi_process=True, percent=1):
-    smiles_h5 = h5py.File(file_structure.get_data_set_file(global_parameters), 'r')
-    smiles = smiles_h5[file_structure.DataSet.smiles][:]
-    smiles_h5.close()
-    classes_h5 = h5py.File(file_structure.get_target_file(global_parameters), 'r')
-    classes = classes_h5[file_structure.Target.classes][:]
-    classes_h5.close()
+class PendingBatch:
+
+    # Batch that is preprocessed in the process pool, get() waits for it
+
+    def __init__(self, shape, futures=None, shared_array_=None, result=None):
+        self._shape = shape
+        self._futures = futures
+        self._shared_array = shared_array_
+        self._result = result
+
+    def ready(self):
+        return self._result is not None or all(future.ready() for future in self._futures)
+
+    def get(self):
+        if self._result is None:
+            if self._shared_array is None:
+                preprocessed = list()
+                for future in self._futures:
+                    preprocessed += future.get()
+                self._result = sparse_batch.SparseBatch.from_preprocessed(self._shape, preprocessed)
+            else:
+                for future in self._futures:
+                    future.get()
+                self._result = self._shared_array.release()
+            self._futures = None
+            self._shared_array = None
+        return self._result
+
+
+def load_array(global_parameters, train=False, test=False, transform=False, multi_process=True, percent=1,
+               sparse=False):
+    # The data set, target and partition are memory mapped if they are stored contiguously (see convert_data_sets.py)
+    smiles = hdf5_util.load_data_set(file_structure.get_data_set_file(global_parameters), file_structure.DataSet.smiles)
+    classes = hdf5_util.load_data_set(file_structure.get_target_file(global_parameters), file_structure.Target.classes)
     if train:
-        partition_h5 = h5py.File(file_structure.get_partition_file(global_parameters), 'r')
-        partition = partition_h5[file_structure.Partitions.train][:]
-        partition_h5.close()
+        partition = hdf5_util.load_data_set(file_structure.get_partition_file(global_parameters),
+                                            file_structure.Partitions.train)
     elif test:
-        partition_h5 = h5py.File(file_structure.get_partition_file(global_parameters), 'r')
-        partition = partition_h5[file_structure.Partitions.test][:]
-        partition_h5.close()
+        partition = hdf5_util.load_data_set(file_structure.get_partition_file(global_parameters),
+                                            file_structure.Partitions.test)
     else:
         partition = numpy.arange(len(smiles), dtype='uint32')
     if percent < 1:
-        target_h5 = h5py.File(file_structure.get_target_file(global_parameters), 'r')
-        classes = target_h5[file_structure.Target.classes][:]
-        target_h5.close()
-        classes = classes.astype('bool')
-        classes = classes[list(partition)]
-        active_partition = partition[classes[:, 0].nonzero()]
-        inactive_partition = partition[classes[:, 1].nonzero()]
+        active = classes[:, 0][partition].astype('bool')
+        inactive = classes[:, 1][partition].astype('bool')
+        active_partition = partition[active.nonzero()]
+        inactive_partition = partition[inactive.nonzero()]
         active_partition = active_partition[:round(len(active_partition)*percent)]
         inactive_partition = inactive_partition[:round(len(inactive_partition)*percent)]
         partition = numpy.append(active_partition, inactive_partition)
@@ -152,4 +283,61 @@ def load_array(global_parameters, train=False, test=False, transform=False, mult
     else:
         random_seed = None
     preprocessed_path = global_parameters[constants.GlobalParameters.preprocessed_data]
-    return Tensor2DArray(smiles, classes, partition, preprocessed_path, random_seed, multi_process=multi_process)
+    coordinates_path = molecule_coordinates.get_file(global_parameters)
+    if not file_util.file_exists(coordinates_path):
+        coordinates_path = None
+    molecules_path = molecule_store.get_file(global_parameters)
+    if not file_util.file_exists(molecules_path):
+        molecules_path = None
+    return Tensor2DArray(smiles, classes, partition, preprocessed_path, random_seed, multi_process=multi_process,
+                         coordinates_path=coordinates_path, molecules_path=molecules_path, sparse=sparse,
+                         data_set_path=file_structure.get_data_set_file(global_parameters),
+                         shuffle_seed=global_parameters[constants.GlobalParameters.seed])
+
+
+def create_worker_preprocessor(preprocessed_path, coordinates_path, molecules_path, data_set_path):
+    preprocessor = tensor_2d_preprocessor.Tensor2DPreprocessor(preprocessed_path, coordinates_path, molecules_path)
+    return preprocessor, hdf5_util.load_data_set(data_set_path, file_structure.DataSet.smiles)
+
+
+def run_worker_preprocessor(worker_preprocessor, function_name, indices, *args):
+    preprocessor, smiles = worker_preprocessor.get()
+    return run_preprocessor(preprocessor, function_name, smiles[indices], indices, *args)
+
+
+def run_preprocessor(preprocessor, function_name, smiles, indices, *args):
+    # Results put into a ListQueue are returned to the parent process together
+    result = getattr(preprocessor, function_name)(smiles, *args, indices=indices)
+    for arg in args:
+        if isinstance(arg, ListQueue):
+            return list(arg)
+    return result
+
+
+def feed_locations(chunks, submit, location_queue):
+    # Submits the location task of every chunk with submit(chunk, callback_) and puts the values they return into
+    # location_queue. The callbacks run in the result handler thread that all tasks of the pool share, so they only
+    # hand the values over to this thread, which may block on location_queue. A chunk is only submitted while the
+    # values of all submitted chunks that have not been put yet fit into location_queue_size.
+    results = queue.Queue()
+    outstanding = 0
+    next_chunk = 0
+    while next_chunk < len(chunks) or outstanding > 0:
+        while next_chunk < len(chunks) \
+                and (outstanding == 0 or outstanding + chunks[next_chunk]['size'] <= location_queue_size):
+            chunk = chunks[next_chunk]
+            submit(chunk, lambda values, size=chunk['size']: results.put((size, values)))
+            outstanding += chunk['size']
+            next_chunk += 1
+        size, values = results.get()
+        for value in values:
+            location_queue.put(value)
+        outstanding -= size
+
+
+class ListQueue(list):
+
+    # Collects the values a task puts, so they can be returned as the task's result
+
+    def put(self, value):
+        self.append(value)
@@ -1,27 +1,79 @@
+import numpy
+
+
 class Tensor2DPreprocessed():
 
-    def __init__(self, position):
-        self._position = position
-        self._atoms = list()
+    # Compact representation of a single preprocessed molecule. It is pickled as a handful of raw buffers so it
+    # can be cheaply moved between processes.
+    __slots__ = ('_position', '_symbol_locations', '_feature_locations', '_features', '_index_encoded')
 
-    def add_atom(self, atom):
-        self._atoms.append(atom)
+    def __init__(self, position, symbol_positions, symbols, feature_positions=None, features=None,
+                 index_encoded=False):
+        # symbol_positions: (n, 2) grid coordinates of atoms and bonds with their symbol channel in symbols
+        # feature_positions: (m, 2) grid coordinates of atoms with their (m, number_features) feature values
+        # index_encoded: symbols are written as index + 1 into the first channel instead of a channel each
+        self._position = position
+        self._index_encoded = index_encoded
+        self._symbol_locations = numpy.empty((len(symbols), 3), dtype='int16')
+        self._symbol_locations[:, :2] = symbol_positions
+        self._symbol_locations[:, 2] = symbols
+        if features is None or features.shape[1] == 0:
+            self._feature_locations = None
+            self._features = None
+        else:
+            self._feature_locations = numpy.ascontiguousarray(feature_positions, dtype='int16')
+            self._features = numpy.ascontiguousarray(features, dtype='float32')
 
     def fill_array(self, array):
-        for atom in self._atoms:
-            atom.fill_array(array, self._position)
+        if self._index_encoded:
+            # Reversed so that atoms take precedence over bonds at the same location
+            symbol_locations = self._symbol_locations[::-1]
+            array[self._position, symbol_locations[:, 0], symbol_locations[:, 1], 0] = symbol_locations[:, 2] + 1
+        else:
+            array[self._position, self._symbol_locations[:, 0], self._symbol_locations[:, 1],
+                  self._symbol_locations[:, 2]] = 1
+        if self._features is not None:
+            array[self._position, self._feature_locations[:, 0], self._feature_locations[:, 1],
+                  -self._features.shape[1]:] = self._features
 
+    def entries(self, number_channels):
+        # Returns the (n, 3) x, y and channel of all values set by fill_array and the values, in the same order
+        if self._index_encoded:
+            symbol_locations = self._symbol_locations[::-1].astype('int32')
+            values = [(symbol_locations[:, 2] + 1).astype('float32')]
+            symbol_locations[:, 2] = 0
+            locations = [symbol_locations]
+        else:
+            locations = [self._symbol_locations.astype('int32')]
+            values = [numpy.ones(len(self._symbol_locations), dtype='float32')]
+        if self._features is not None:
+            number_features = self._features.shape[1]
+            feature_locations = numpy.empty((self._features.size, 3), dtype='int32')
+            feature_locations[:, :2] = numpy.repeat(self._feature_locations, number_features, axis=0)
+            feature_locations[:, 2] = numpy.tile(numpy.arange(number_channels - number_features, number_channels),
+                                                 len(self._feature_locations))
+            locations.append(feature_locations)
+            values.append(self._features.reshape(-1))
+        return numpy.concatenate(locations), numpy.concatenate(values)
 
-class Tensor2DPreprocessedAtom():
+    @property
+    def position(self):
+        return self._position
 
-    def __init__(self, position_x, position_y, symbol=None, features=None):
-        self._position_x = position_x
-        self._position_y = position_y
-        self._symbol = symbol
-        self._features = features
+    def __getstate__(self):
+        if self._features is None:
+            return self._position, self._symbol_locations.tobytes(), None, None, 0, self._index_encoded
+        return self._position, self._symbol_locations.tobytes(), self._feature_locations.tobytes(),\
+            self._features.tobytes(), self._features.shape[1], self._index_encoded
 
-    def fill_array(self, array, position):
-        if self._symbol is not None:
-            array[position, self._position_x, self._position_y, self._symbol] = 1
-        if self._features is not None:
-            array[position, self._position_x, self._position_y, -len(self._features):] = self._features[:]
+    def __setstate__(self, state):
+        position, symbol_locations, feature_locations, features, number_features, index_encoded = state
+        self._position = position
+        self._index_encoded = index_encoded
+        self._symbol_locations = numpy.frombuffer(symbol_locations, dtype='int16').reshape(-1, 3)
+        if features is None:
+            self._feature_locations = None
+            self._features = None
+        else:
+            self._feature_locations = numpy.frombuffer(feature_locations, dtype='int16').reshape(-1, 2)
+            self._features = numpy.frombuffer(features, dtype='float32').reshape(-1, number_features)
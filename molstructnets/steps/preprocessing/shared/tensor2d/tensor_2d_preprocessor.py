@@ -1,21 +1,32 @@
+import math
 import random
 
 import h5py
 import numpy
 from rdkit import Chem
-from rdkit.Chem import AllChem
+from rdkit.Chem.rdchem import BondType
 
 from steps.preprocessing.shared.chemicalproperties import chemical_properties
+from steps.preprocessing.shared.moleculestore import molecule_store
 from steps.preprocessing.shared.tensor2d import rasterizer, bond_positions, bond_symbols, tensor_2d_preprocessed
-from steps.preprocessing.shared.tensor2d import transformer
+from steps.preprocessing.shared.tensor2d import transformer, molecule_coordinates
 from util import hdf5_util, file_structure, normalization
 
 padding = 2
+periodic_table_size = 119
+# Symbol indices are stored as uint8 with 0 for no symbol
+max_index_encoded_symbols = 255
+
+
+class SymbolEncodings:
+    # One-hot sets a channel per symbol, index stores the symbol index + 1 in the first channel (0 for no symbol)
+    one_hot = 'One-hot'
+    index = 'Index'
 
 
 class Tensor2DPreprocessor:
 
-    def __init__(self, preprocessed_path):
+    def __init__(self, preprocessed_path, coordinates_path=None, molecules_path=None):
         preprocessed_h5 = h5py.File(preprocessed_path, 'r')
         self._shape = \
             tuple(hdf5_util.get_property(preprocessed_h5, file_structure.PreprocessedTensor2D.dimensions))
@@ -28,6 +39,7 @@ class Tensor2DPreprocessor:
         max_y = hdf5_util.get_property(preprocessed_h5, file_structure.PreprocessedTensor2D.max_y)
         self._rasterizer = rasterizer.Rasterizer(self._scale, padding, min_x, max_x, min_y, max_y, square)
         self._transformer = transformer.Transformer(min_x, max_x, min_y, max_y)
+        self._shifts = [shift / self._scale - 0.5 / self._scale for shift in range(2)]
         if hdf5_util.has_data_set(preprocessed_h5, file_structure.PreprocessedTensor2D.symbols):
             symbols = preprocessed_h5[file_structure.PreprocessedTensor2D.symbols]
             self._symbol_index_lookup = dict()
@@ -37,6 +49,19 @@ class Tensor2DPreprocessor:
         else:
             self._symbol_index_lookup = None
             self._number_symbols = 0
+        self._atom_symbol_lookup, self._bond_symbol_lookup = create_symbol_lookups(self._symbol_index_lookup)
+        self._symbol_encoding = hdf5_util.get_property(preprocessed_h5,
+                                                       file_structure.PreprocessedTensor2D.symbol_encoding)
+        if self._symbol_encoding is None:
+            self._symbol_encoding = SymbolEncodings.one_hot
+        if coordinates_path is not None:
+            self._coordinates = molecule_coordinates.MoleculeCoordinates(coordinates_path)
+        else:
+            self._coordinates = None
+        if molecules_path is not None:
+            self._molecules = molecule_store.MoleculeStore(molecules_path)
+        else:
+            self._molecules = None
         if hdf5_util.has_data_set(preprocessed_h5, file_structure.PreprocessedTensor2D.chemical_properties):
             self._chemical_properties = \
                 numpy_array_to_string_list(preprocessed_h5[file_structure.PreprocessedTensor2D.chemical_properties])
@@ -55,188 +80,202 @@ class Tensor2DPreprocessor:
             self._normalization_std = preprocessed_h5[file_structure.PreprocessedTensor2D.normalization_std][:]
         preprocessed_h5.close()
 
-    def preprocess(self, smiles_array, offset, queue, random_seed=None):
+    def preprocess(self, smiles_array, offset, queue, random_seed=None, indices=None):
         for i in range(len(smiles_array)):
+            random_ = None
             if random_seed is not None:
                 random_ = random.Random(random_seed + i)
-            smiles = smiles_array[i].decode('utf-8')
-            molecule = Chem.MolFromSmiles(smiles)
-            AllChem.Compute2DCoords(molecule)
-            successful = False
-            while not successful:
-                preprocessed_molecule = tensor_2d_preprocessed.Tensor2DPreprocessed(i + offset)
-                successful = True
-                atom_positions = dict()
-                if random_seed is not None:
-                    rotation = random_.randint(0, 359)
-                    flip = bool(random_.randint(0, 1))
-                    shift_x = random_.randint(0, 1) / self._scale - 0.5 / self._scale
-                    shift_y = random_.randint(0, 1) / self._scale - 0.5 / self._scale
-                for atom in molecule.GetAtoms():
-                    position = molecule.GetConformer().GetAtomPosition(atom.GetIdx())
-                    position_x = position.x
-                    position_y = position.y
-                    if random_seed is not None:
-                        position_x, position_y = self._transformer.apply(position_x, position_y, flip, rotation,
-                                                                         shift_x, shift_y)
-                    position_x, position_y = self._rasterizer.apply(position_x, position_y)
-                    if position_x >= self.shape[0] or position_y >= self.shape[1]:
-                        successful = False
-                        break
-                    symbol_index = None
-                    if self._symbol_index_lookup is not None:
-                        if atom.GetSymbol() in self._symbol_index_lookup:
-                            symbol_index = self._symbol_index_lookup[atom.GetSymbol()]
-                    chemical_property_values = None
-                    if self._chemical_properties is not None:
-                        chemical_property_values = chemical_properties.get_chemical_properties(atom,
-                                                                                               self._chemical_properties)
-                        self.normalize(chemical_property_values)
-                    preprocessed_molecule.add_atom(tensor_2d_preprocessed.Tensor2DPreprocessedAtom(
-                        position_x, position_y, symbol=symbol_index, features=chemical_property_values))
-                    atom_positions[atom.GetIdx()] = [position_x, position_y]
-            if self._with_bonds:
-                bond_positions_ = bond_positions.calculate(molecule, atom_positions)
-                for bond in molecule.GetBonds():
-                    bond_symbol = bond_symbols.get_bond_symbol(bond.GetBondType())
-                    if bond_symbol is not None and bond_symbol in self._symbol_index_lookup:
-                        bond_symbol_index = self._symbol_index_lookup[bond_symbol]
-                        for position in bond_positions_[bond.GetIdx()]:
-                            preprocessed_molecule.add_atom(tensor_2d_preprocessed.Tensor2DPreprocessedAtom(
-                                position[0], position[1], symbol=bond_symbol_index))
-            queue.put(preprocessed_molecule)
+            layout, molecule = self.load_molecule(smiles_array, indices, i, self._chemical_properties is not None)
+            atom_positions = self.atom_positions(layout, random_)
+            queue.put(self.rasterize_molecule(layout, atom_positions, i + offset, molecule))
         if hasattr(queue, 'flush'):
             queue.flush()
 
+    def preprocess_into(self, smiles_array, offset, shared_array, random_seed=None, indices=None):
+        # Rasterizes the molecules directly into the rows starting at offset of the (zeroed) shared array
+        try:
+            array = shared_array.array
+        except FileNotFoundError:
+            # The batch has been dropped before this task started
+            return 0
+        self.preprocess(smiles_array, offset, ArrayFiller(array), random_seed, indices)
+        return len(smiles_array)
+
     def preprocess_single_smiles(self, smiles, flip=False, rotation=0, shift_x=0, shift_y=0):
         molecule = Chem.MolFromSmiles(smiles)
-        AllChem.Compute2DCoords(molecule)
-        preprocessed_molecule = tensor_2d_preprocessed.Tensor2DPreprocessed(0)
-        atom_positions = dict()
-        for atom in molecule.GetAtoms():
-            position = molecule.GetConformer().GetAtomPosition(atom.GetIdx())
-            position_x = position.x
-            position_y = position.y
-            position_x, position_y = self._transformer.apply(position_x, position_y, flip, rotation, shift_x, shift_y)
-            position_x, position_y = self._rasterizer.apply(position_x, position_y)
-            if position_x >= self.shape[0] or position_y >= self.shape[1]:
-                raise ValueError('Position out of bounds')
-            symbol_index = None
-            if self._symbol_index_lookup is not None:
-                if atom.GetSymbol() in self._symbol_index_lookup:
-                    symbol_index = self._symbol_index_lookup[atom.GetSymbol()]
-            chemical_property_values = None
-            if self._chemical_properties is not None:
-                chemical_property_values = chemical_properties.get_chemical_properties(atom,
-                                                                                       self._chemical_properties)
-                self.normalize(chemical_property_values)
-            preprocessed_molecule.add_atom(tensor_2d_preprocessed.Tensor2DPreprocessedAtom(
-                position_x, position_y, symbol=symbol_index, features=chemical_property_values))
-            atom_positions[atom.GetIdx()] = [position_x, position_y]
-        if self._with_bonds:
-            bond_positions_ = bond_positions.calculate(molecule, atom_positions)
-            for bond in molecule.GetBonds():
-                bond_symbol = bond_symbols.get_bond_symbol(bond.GetBondType())
-                if bond_symbol is not None and bond_symbol in self._symbol_index_lookup:
-                    bond_symbol_index = self._symbol_index_lookup[bond_symbol]
-                    for position in bond_positions_[bond.GetIdx()]:
-                        preprocessed_molecule.add_atom(tensor_2d_preprocessed.Tensor2DPreprocessedAtom(
-                            position[0], position[1], symbol=bond_symbol_index))
-        return preprocessed_molecule
+        layout = molecule_coordinates.from_molecule(molecule)
+        atom_positions = self._rasterizer.apply_array(
+            self._transformer.apply_array(layout[0], flip, rotation, shift_x, shift_y))
+        if not self.fits(atom_positions):
+            raise ValueError('Position out of bounds')
+        return self.rasterize_molecule(layout, atom_positions, 0, molecule)
 
     def substructure_locations(self, smiles_array, substructures, offset, locations_queue, random_seed=None,
-                               only_substructures=False, only_atoms=False):
+                               only_substructures=False, only_atoms=False, indices=None):
         for i in range(len(smiles_array)):
+            random_ = None
             if random_seed is not None:
                 random_ = random.Random(random_seed + i)
-            smiles = smiles_array[i].decode('utf-8')
-            molecule = Chem.MolFromSmiles(smiles)
-            AllChem.Compute2DCoords(molecule)
-            indices = set()
+            layout, molecule = self.load_molecule(smiles_array, indices, i, True)
+            substructure_atoms = set()
             for substructure in substructures:
                 matches = molecule.GetSubstructMatches(substructure)
                 for match in matches:
                     for index in match:
-                        indices.add(index)
-            successful = False
-            while not successful:
-                successful = True
-                atom_positions = dict()
-                other_locations = list()
-                substructure_locations_ = list()
-                if random_seed is not None:
-                    rotation = random_.randint(0, 359)
-                    flip = bool(random_.randint(0, 1))
-                    shift_x = random_.randint(0, 1) / self._scale - 0.5 / self._scale
-                    shift_y = random_.randint(0, 1) / self._scale - 0.5 / self._scale
-                for atom in molecule.GetAtoms():
-                    position = molecule.GetConformer().GetAtomPosition(atom.GetIdx())
-                    position_x = position.x
-                    position_y = position.y
-                    if random_seed is not None:
-                        position_x, position_y = self._transformer.apply(position_x, position_y, flip, rotation,
-                                                                         shift_x, shift_y)
-                    position_x, position_y = self._rasterizer.apply(position_x, position_y)
-                    if position_x >= self.shape[0] or position_y >= self.shape[1]:
-                        successful = False
-                        break
-                    atom_positions[atom.GetIdx()] = [position_x, position_y]
-                    if atom.GetIdx() in indices:
-                        substructure_locations_.append([position_x, position_y])
-                    else:
-                        other_locations.append([position_x, position_y])
+                        substructure_atoms.add(index)
+            atom_positions = self.atom_positions(layout, random_)
+            in_substructure = numpy.zeros(len(atom_positions), dtype='bool')
+            in_substructure[list(substructure_atoms)] = True
+            substructure_locations_ = [atom_positions[in_substructure]]
+            other_locations = [atom_positions[~in_substructure]]
             if self._with_bonds and not only_atoms:
-                bond_positions_ = bond_positions.calculate(molecule, atom_positions)
-                for bond in molecule.GetBonds():
-                    bond_symbol = bond_symbols.get_bond_symbol(bond.GetBondType())
-                    if bond_symbol is not None and bond_symbol in self._symbol_index_lookup:
-                        if bond.GetBeginAtomIdx() in indices and bond.GetEndAtomIdx() in indices:
-                            for position in bond_positions_[bond.GetIdx()]:
-                                substructure_locations_.append([position[0], position[1]])
-                        else:
-                            for position in bond_positions_[bond.GetIdx()]:
-                                other_locations.append([position[0], position[1]])
+                bonds = layout[2]
+                positions, bond_indices, bond_symbol_indices = self.bond_locations(layout, atom_positions)
+                bond_in_substructure = in_substructure[bonds[bond_indices, 0]] & in_substructure[bonds[bond_indices, 1]]
+                substructure_locations_.append(positions[bond_in_substructure])
+                other_locations.append(positions[~bond_in_substructure])
+            substructure_locations_ = numpy.concatenate(substructure_locations_)
+            other_locations = numpy.concatenate(other_locations)
             if only_substructures:
                 locations_queue.put((i + offset, substructure_locations_))
             else:
                 locations_queue.put((i + offset, substructure_locations_, other_locations))
-        locations_queue.flush()
+        if hasattr(locations_queue, 'flush'):
+            locations_queue.flush()
 
-    def atom_locations(self, smiles_array, offset, locations_queue, random_seed=None):
+    def atom_locations(self, smiles_array, offset, locations_queue, random_seed=None, indices=None):
         for i in range(len(smiles_array)):
+            random_ = None
             if random_seed is not None:
                 random_ = random.Random(random_seed + i)
-            smiles = smiles_array[i].decode('utf-8')
-            molecule = Chem.MolFromSmiles(smiles)
-            AllChem.Compute2DCoords(molecule)
-            successful = False
-            while not successful:
-                successful = True
-                atom_positions = dict()
-                if random_seed is not None:
-                    rotation = random_.randint(0, 359)
-                    flip = bool(random_.randint(0, 1))
-                    shift_x = random_.randint(0, 1) / self._scale - 0.5 / self._scale
-                    shift_y = random_.randint(0, 1) / self._scale - 0.5 / self._scale
-                for atom in molecule.GetAtoms():
-                    position = molecule.GetConformer().GetAtomPosition(atom.GetIdx())
-                    position_x = position.x
-                    position_y = position.y
-                    if random_seed is not None:
-                        position_x, position_y = self._transformer.apply(position_x, position_y, flip, rotation,
-                                                                         shift_x, shift_y)
-                    position_x, position_y = self._rasterizer.apply(position_x, position_y)
-                    if position_x >= self.shape[0] or position_y >= self.shape[1]:
-                        successful = False
-                        break
-                    atom_positions[atom.GetIdx()] = [position_x, position_y]
-            locations_queue.put((i + offset, atom_positions))
-        locations_queue.flush()
+            layout, molecule = self.load_molecule(smiles_array, indices, i)
+            locations_queue.put((i + offset, self.atom_positions(layout, random_)))
+        if hasattr(locations_queue, 'flush'):
+            locations_queue.flush()
+
+    def load_molecule(self, smiles_array, indices, i, with_molecule=False):
+        # Returns the 2D layout (coordinates, atomic numbers, bonds) of the i-th molecule. The layout is read from
+        # the coordinates file if the data set indices are known, otherwise it is calculated. The RDKit molecule is
+        # only loaded if it is needed, from the molecule store if there is one.
+        molecule = None
+        molecules = None
+        index = None
+        if indices is not None:
+            molecules = self._molecules
+            index = indices[i]
+        if self._coordinates is not None and indices is not None:
+            layout = self._coordinates.get(index)
+            if with_molecule:
+                molecule = molecule_store.get_molecule(smiles_array[i], index, molecules)
+        else:
+            molecule = molecule_store.get_molecule(smiles_array[i], index, molecules)
+            layout = molecule_coordinates.from_molecule(molecule)
+        return layout, molecule
+
+    def atom_positions(self, layout, random_=None):
+        # Returns the (n, 2) grid positions of all atoms, with a random transformation if random_ is given
+        coordinates = layout[0]
+        if random_ is None:
+            atom_positions = self._rasterizer.apply_array(coordinates)
+            if not self.fits(atom_positions):
+                raise ValueError('Position out of bounds')
+            return atom_positions
+        rotation = random_.randint(0, 359)
+        flip = random_.randint(0, 1)
+        shift_x = random_.randint(0, 1)
+        shift_y = random_.randint(0, 1)
+        atom_positions = self.transformed_atom_positions(coordinates, flip, rotation, shift_x, shift_y)
+        if self.fits(atom_positions):
+            return atom_positions
+        # Instead of retrying draw from the transformations that fit. Together with the first draw every fitting
+        # transformation is still equally likely.
+        transformations = self._transformer.fitting_transformations(coordinates, self._rasterizer, self._shape,
+                                                                    self._shifts)
+        while len(transformations) > 0:
+            index = random_.randrange(len(transformations))
+            atom_positions = self.transformed_atom_positions(coordinates, *transformations[index])
+            if self.fits(atom_positions):
+                return atom_positions
+            # Rounding errors can make a transformation at the border of the grid fail
+            transformations = numpy.delete(transformations, index, axis=0)
+        raise ValueError('Molecule does not fit into the grid with any transformation')
+
+    def transformed_atom_positions(self, coordinates, flip, rotation, shift_x, shift_y):
+        # shift_x and shift_y are indices into the possible shifts
+        return self._rasterizer.apply_array(
+            self._transformer.apply_array(coordinates, bool(flip), int(rotation), self._shifts[shift_x],
+                                          self._shifts[shift_y]))
+
+    def fits(self, positions):
+        return bool(numpy.all((positions >= 0) & (positions < numpy.array(self._shape[:2]))))
+
+    def rasterize_molecule(self, layout, atom_positions, position, molecule=None):
+        atomic_numbers = layout[1]
+        atom_symbols = self._atom_symbol_lookup[atomic_numbers]
+        has_symbol = atom_symbols >= 0
+        symbol_positions = [atom_positions[has_symbol]]
+        symbols = [atom_symbols[has_symbol]]
+        if self._with_bonds:
+            positions, bond_indices, bond_symbol_indices = self.bond_locations(layout, atom_positions)
+            symbol_positions.append(positions)
+            symbols.append(bond_symbol_indices)
+        symbol_positions = numpy.concatenate(symbol_positions)
+        symbols = numpy.concatenate(symbols)
+        features = None
+        if self._chemical_properties is not None:
+            features = chemical_properties.get_chemical_properties_matrix(molecule, self._chemical_properties)
+            self.normalize(features)
+        return tensor_2d_preprocessed.Tensor2DPreprocessed(position, symbol_positions, symbols,
+                                                           feature_positions=atom_positions, features=features,
+                                                           index_encoded=self.index_encoded)
+
+    def bond_locations(self, layout, atom_positions):
+        # Returns the (k, 2) grid positions of all bonds with a known symbol, the index of the bond and the symbol
+        # index of each position
+        bonds = layout[2]
+        positions, bond_indices = bond_positions.calculate_array(bonds[:, :2], atom_positions)
+        bond_symbol_indices = self._bond_symbol_lookup[bonds[bond_indices, 2]]
+        known = bond_symbol_indices >= 0
+        return positions[known], bond_indices[known], bond_symbol_indices[known]
 
     @property
     def shape(self):
         return self._shape
 
+    @property
+    def index_encoded(self):
+        return self._symbol_encoding == SymbolEncodings.index
+
+    @property
+    def array_shape(self):
+        # Shape of a preprocessed molecule, with index encoding all symbols share the first channel
+        if self.index_encoded:
+            return self._shape[:2] + (self._shape[2] - self._number_symbols + 1,)
+        return self._shape
+
+    @property
+    def dtype(self):
+        if not self.index_encoded:
+            return numpy.dtype('float32')
+        if self._chemical_properties is not None:
+            return numpy.dtype('float16')
+        return numpy.dtype('uint8')
+
+    def estimate_number_entries(self):
+        # Estimates the average number of values a molecule sets in its grid (the full grid if there are no
+        # coordinates to estimate from)
+        if self._coordinates is None:
+            return int(numpy.prod(self.array_shape))
+        number_molecules, number_atoms, number_bonds = self._coordinates.sizes()
+        number_features = 0
+        if self._chemical_properties is not None:
+            number_features = len(self._chemical_properties)
+        entries = number_atoms * (1 + number_features)
+        if self._with_bonds:
+            # Bonds in 2D depictions are 1.5 units long
+            entries += number_bonds * math.ceil(1.5 * self._scale)
+        return max(1, math.ceil(entries / max(1, number_molecules)))
+
     def normalize(self, values):
         if self._normalization_type == normalization.NormalizationTypes.min_max_1:
             values -= self._normalization_min
@@ -253,6 +292,34 @@ class Tensor2DPreprocessor:
             values[numpy.logical_or(values == numpy.inf, values == numpy.NINF)] = 0
 
 
+class ArrayFiller:
+
+    # Queue replacement that fills the preprocessed molecules into an array
+
+    def __init__(self, array):
+        self._array = array
+
+    def put(self, preprocessed):
+        preprocessed.fill_array(self._array)
+
+
+def create_symbol_lookups(symbol_index_lookup):
+    # Maps atomic numbers and RDKit bond types to their symbol channel (-1 if the symbol has no channel)
+    periodic_table = Chem.GetPeriodicTable()
+    atom_symbol_lookup = numpy.full(periodic_table_size, -1, dtype='int64')
+    bond_symbol_lookup = numpy.full(max(BondType.values.keys()) + 1, -1, dtype='int64')
+    if symbol_index_lookup is not None:
+        for atomic_number in range(periodic_table_size):
+            symbol = periodic_table.GetElementSymbol(atomic_number)
+            if symbol in symbol_index_lookup:
+                atom_symbol_lookup[atomic_number] = symbol_index_lookup[symbol]
+        for bond_type_number, bond_type in BondType.values.items():
+            symbol = bond_symbols.get_bond_symbol(bond_type)
+            if symbol is not None and symbol in symbol_index_lookup:
+                bond_symbol_lookup[bond_type_number] = symbol_index_lookup[symbol]
+    return atom_symbol_lookup, bond_symbol_lookup
+
+
 def numpy_array_to_string_list(numpy_array):
     string_list = list()
     for i in range(len(numpy_array)):
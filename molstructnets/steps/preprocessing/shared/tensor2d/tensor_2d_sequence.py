@@ -0,0 +1,150 @@
+import math
+import os
+import threading
+import time
+
+import numpy
+from keras import utils
+
+from steps.preprocessing.shared.tensor2d import sparse_batch
+from util import logger, misc
+
+
+class Tensor2DSequence(utils.Sequence):
+
+    # Batches of a Tensor2DArray for fit_generator() and predict_generator(). A batch only depends on the epoch and
+    # its index: the order is a permutation seeded with (seed, epoch) and the augmentation seeds follow the position in
+    # that order. Keras can therefore request batches in any order and from several worker threads or processes.
+
+    def __init__(self, array, batch_size, seed=0, shuffle=False, with_classes=False, epoch=0, prefetch_batches=0,
+                 cache=None, sampler=None):
+        self._array = array
+        self._batch_size = batch_size
+        self._seed = seed
+        self._shuffle = shuffle
+        self._with_classes = with_classes
+        self.epoch = epoch
+        # The batches following a requested one are already submitted to the process pool of the array
+        if array.multi_process:
+            self._prefetch_batches = prefetch_batches
+        else:
+            self._prefetch_batches = 0
+        self._pending = dict()
+        # Epochs are read from an AugmentationCache instead, epoch e uses the cached epoch e % cache.variants
+        self._cache = cache
+        # The orders are drawn from a BalancedSampler instead, which also determines the length of an epoch
+        self._sampler = sampler
+        if sampler is not None:
+            self._length = len(sampler)
+        else:
+            self._length = len(array)
+        self._order = None
+        self._order_epoch = None
+        # The lock and the pending batches belong to the process that created them, see _check_process()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self.batches = 0
+        self.stalls = 0
+        self.stall_time = 0
+
+    def __len__(self):
+        return math.ceil(self._length / self._batch_size)
+
+    def __getitem__(self, index):
+        return self.get(self.epoch, index)
+
+    def get(self, epoch, index, dense=True):
+        self._check_process()
+        if self._cache is not None:
+            return self._get_cached(epoch, index, dense)
+        with self._lock:
+            for key in [key for key in self._pending if key[0] != epoch]:
+                # Waiting for the batch frees its memory
+                self._pending.pop(key)[0].get()
+            if (epoch, index) in self._pending:
+                batch, item = self._pending.pop((epoch, index))
+            else:
+                batch, item = self._submit(epoch, index)
+            for i in range(index + 1, min(len(self), index + 1 + self._prefetch_batches)):
+                if (epoch, i) not in self._pending:
+                    self._pending[(epoch, i)] = self._submit(epoch, i)
+            self.batches += 1
+            stalled = not batch.ready()
+            if stalled:
+                self.stalls += 1
+        start = time.perf_counter()
+        data = batch.get()
+        if dense:
+            data = sparse_batch.to_dense(data, self._array.dtype)
+        if stalled:
+            self.stall_time += time.perf_counter() - start
+        if self._with_classes:
+            return data, self._array.classes(item)
+        return data
+
+    def _get_cached(self, epoch, index, dense):
+        epoch = epoch % self._cache.variants
+        data = self._cache.get(epoch, index)
+        if dense:
+            data = data.to_dense(self._array.dtype)
+        if self._with_classes:
+            start = index * self._batch_size
+            with self._lock:
+                item = self.order(epoch)[start:start + self._batch_size]
+            return data, self._array.classes(item)
+        return data
+
+    def _check_process(self):
+        # Keras worker processes work on a forked copy of the sequence. A copied lock may be held by a thread that does
+        # not exist in the worker and the pending batches are futures of the process pool of the parent, so a worker
+        # starts with its own.
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._pending = dict()
+            self._pid = os.getpid()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_lock']
+        state['_pending'] = dict()
+        state['_pid'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def on_epoch_end(self):
+        self.epoch += 1
+
+    def order(self, epoch):
+        # Returns the positions of the array in the order of the given epoch
+        if not self._shuffle and self._sampler is None:
+            return numpy.arange(len(self._array))
+        if self._order_epoch != epoch:
+            if self._sampler is not None:
+                self._order = self._sampler.order(epoch)
+            else:
+                self._order = misc.epoch_random(self._seed, epoch).permutation(len(self._array))
+            self._order_epoch = epoch
+        return self._order
+
+    def _submit(self, epoch, index):
+        start = index * self._batch_size
+        end = min(self._length, start + self._batch_size)
+        if self._shuffle or self._sampler is not None:
+            item = self.order(epoch)[start:end]
+        else:
+            item = slice(start, end)
+        return self._array.submit(item, iteration=epoch, position=start), item
+
+    def log_stalls(self, name, log_level=logger.LogLevel.VERBOSE):
+        if self.batches > 0:
+            logger.log(name + ': waited for ' + str(self.stalls) + ' of ' + str(self.batches) + ' batches ('
+                       + str(round(self.stall_time, 1)) + 's)', log_level)
+
+    def close(self):
+        with self._lock:
+            for batch, item in self._pending.values():
+                batch.get()
+            self._pending = dict()
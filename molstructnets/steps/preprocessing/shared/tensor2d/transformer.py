@@ -1,5 +1,7 @@
 import math
 
+import numpy
+
 
 class Transformer:
 
@@ -14,6 +16,59 @@ class Transformer:
             x, y = Transformer.rotate((self.center_x, self.center_y), (x, y), rotation)
         return x + shift_x, y + shift_y
 
+    def apply_array(self, positions, flip=False, rotation=0, shift_x=0, shift_y=0):
+        # Flip and rotation around the center combined into one matrix, positions has the shape (n, 2)
+        matrix = Transformer.rotation_matrix(rotation)
+        if flip:
+            matrix = matrix * numpy.array([-1, 1])
+        center = numpy.array([self.center_x, self.center_y])
+        return numpy.dot(positions - center, matrix.T) + center + numpy.array([shift_x, shift_y])
+
+    def extents(self, positions):
+        # Minimum and maximum (x, y) of the positions for every flip (first axis) and rotation in degrees (second axis)
+        center = numpy.array([self.center_x, self.center_y])
+        if len(positions) == 0:
+            positions = center.reshape(1, 2)
+        angles = numpy.radians(numpy.arange(360))
+        cos = numpy.cos(angles).reshape(-1, 1)
+        sin = numpy.sin(angles).reshape(-1, 1)
+        mins = numpy.zeros((2, 360, 2))
+        maxs = numpy.zeros((2, 360, 2))
+        for flip in range(2):
+            difference = positions - center
+            if flip:
+                difference = difference * numpy.array([-1, 1])
+            x = cos * difference[:, 0] - sin * difference[:, 1]
+            y = sin * difference[:, 0] + cos * difference[:, 1]
+            mins[flip, :, 0] = x.min(axis=1)
+            mins[flip, :, 1] = y.min(axis=1)
+            maxs[flip, :, 0] = x.max(axis=1)
+            maxs[flip, :, 1] = y.max(axis=1)
+        return mins + center, maxs + center
+
+    def fitting_transformations(self, positions, rasterizer_, shape, shifts=(0,)):
+        # Returns a (k, 4) array with every (flip, rotation, shift x index, shift y index) for which the rasterized
+        # positions lie within the first two dimensions of shape. As rasterization is monotonic only the extents of
+        # the positions need to be checked.
+        mins, maxs = self.extents(positions)
+        size = numpy.array(shape[:2])
+        transformations = list()
+        for shift_x in range(len(shifts)):
+            for shift_y in range(len(shifts)):
+                shift = numpy.array([shifts[shift_x], shifts[shift_y]])
+                fits = numpy.all(rasterizer_.apply_array(mins + shift) >= 0, axis=2) \
+                    & numpy.all(rasterizer_.apply_array(maxs + shift) < size, axis=2)
+                flips, rotations = numpy.nonzero(fits)
+                transformations.append(numpy.stack([flips, rotations, numpy.full(len(flips), shift_x),
+                                                    numpy.full(len(flips), shift_y)], axis=1))
+        return numpy.concatenate(transformations)
+
+    @staticmethod
+    def rotation_matrix(angle):
+        angle = math.radians(angle)
+        return numpy.array([[math.cos(angle), -math.sin(angle)],
+                            [math.sin(angle), math.cos(angle)]])
+
     @staticmethod
     def rotate(origin, point, angle):
         angle = math.radians(angle)
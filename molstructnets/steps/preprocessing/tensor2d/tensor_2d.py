@@ -1,12 +1,14 @@
 import h5py
 import numpy
 from rdkit import Chem
-from rdkit.Chem import AllChem
+from rdkit.Chem.rdchem import BondType
 
 from steps.preprocessing.shared.chemicalproperties import chemical_properties
-from steps.preprocessing.shared.tensor2d import molecule_2d_tensor, bond_symbols, rasterizer, tensor_2d_preprocessor
+from steps.preprocessing.shared.moleculestore import molecule_store
+from steps.preprocessing.shared.tensor2d import molecule_2d_tensor, bond_symbols, rasterizer, tensor_2d_preprocessor, \
+    molecule_coordinates
 from util import data_validation, misc, file_structure, file_util, logger, process_pool, hdf5_util, normalization, \
-    constants, multi_process_progressbar
+    constants, multi_process_progressbar, artifact_cache
 
 fixed_symbols = {'-', '=', '#', '$', ':'}
 if molecule_2d_tensor.with_empty_bits:
@@ -50,6 +52,17 @@ class Tensor2D:
                                        normalization.NormalizationTypes.min_max_2,
                                        normalization.NormalizationTypes.z_score],
                            'description': 'Normalization type (only applied to chemical properties). Default: None'})
+        parameters.append({'id': 'symbol_encoding', 'name': 'Symbol Encoding', 'type': str,
+                           'default': tensor_2d_preprocessor.SymbolEncodings.one_hot,
+                           'options': [tensor_2d_preprocessor.SymbolEncodings.one_hot,
+                                       tensor_2d_preprocessor.SymbolEncodings.index],
+                           'description': 'One-hot uses a channel per symbol. Index stores the symbol index in a'
+                                          ' single uint8 channel (float16 with chemical properties) that the network'
+                                          ' expands again, which needs a fraction of the memory per batch. Index'
+                                          ' encoded data can not be used for saliency maps. Default: One-hot'})
+        parameters.append({'id': 'molecule_store', 'name': 'Store Molecules', 'type': bool, 'default': True,
+                           'description': 'Stores the parsed molecules of the data set, so that following steps do not'
+                                          ' need to parse the SMILES again. Default: True'})
         return parameters
 
     @staticmethod
@@ -66,242 +79,190 @@ class Tensor2D:
     def get_result_file(global_parameters, local_parameters):
         hash_parameters = misc.copy_dict_from_keys(local_parameters,
                                                    ['scale', 'symbols', 'square', 'bonds', 'atom_symbols',
-                                                    'chemical_properties', 'normalization'])
-        hash_parameters['data_set'] = global_parameters[constants.GlobalParameters.data_set]
-        file_name = 'tensor_2d_jit_' + misc.hash_parameters(hash_parameters) + '.h5'
-        tmp_global_parameters = global_parameters.copy()
-        if constants.GlobalParameters.transfer_data_sets in global_parameters:
-            tmp_global_parameters[constants.GlobalParameters.data_set] = global_parameters[constants.GlobalParameters.transfer_data_sets]
-        return file_util.resolve_subpath(file_structure.get_preprocessed_folder(tmp_global_parameters), file_name)
+                                                    'chemical_properties', 'normalization', 'symbol_encoding'])
+        if isinstance(global_parameters[constants.GlobalParameters.data_set], list):
+            data_sets = global_parameters[constants.GlobalParameters.data_set]
+        else:
+            data_sets = [global_parameters[constants.GlobalParameters.data_set]]
+        inputs = dict()
+        for i in range(len(data_sets)):
+            tmp_global_parameters = global_parameters.copy()
+            tmp_global_parameters[constants.GlobalParameters.data_set] = data_sets[i]
+            inputs['data_set_' + str(i)] = artifact_cache.data_set_digest(tmp_global_parameters)
+        return artifact_cache.get_file(global_parameters, 'tensor_2d_jit', hash_parameters, inputs)
 
     @staticmethod
     def execute(global_parameters, local_parameters):
         global_parameters[constants.GlobalParameters.feature_id] = '2d_tensor'
         preprocessed_path = Tensor2D.get_result_file(global_parameters, local_parameters)
         global_parameters[constants.GlobalParameters.preprocessed_data] = preprocessed_path
-        if file_util.file_exists(preprocessed_path):
-            global_parameters[constants.GlobalParameters.input_dimensions] = \
-                tuple(hdf5_util.get_property(preprocessed_path, file_structure.PreprocessedTensor2D.dimensions))
-            logger.log('Skipping step: ' + preprocessed_path + ' already exists')
+        # Parse the molecules and calculate their 2D coordinates once per data set, they are shared by all following
+        # steps
+        if isinstance(global_parameters[constants.GlobalParameters.data_set], list):
+            data_sets = global_parameters[constants.GlobalParameters.data_set]
         else:
-            if isinstance(global_parameters[constants.GlobalParameters.data_set], list):
-                # Concatenate all data sets in the list into one
-                smiles = numpy.ndarray(shape=[0], dtype='|S0')
-                for i in range(len(global_parameters[constants.GlobalParameters.data_set])):
-                    data_set_h5 = h5py.File(file_structure.get_data_set_file(global_parameters, n=i), 'r')
-                    smiles = numpy.concatenate((smiles, data_set_h5[file_structure.DataSet.smiles][:]))
-                    data_set_h5.close()
+            data_sets = [global_parameters[constants.GlobalParameters.data_set]]
+        smiles_list = list()
+        coordinates_list = list()
+        molecules_list = list()
+        for data_set in data_sets:
+            tmp_global_parameters = global_parameters.copy()
+            tmp_global_parameters[constants.GlobalParameters.data_set] = data_set
+            smiles = hdf5_util.load_data_set(file_structure.get_data_set_file(tmp_global_parameters),
+                                             file_structure.DataSet.smiles)
+            molecules = None
+            if local_parameters['molecule_store']:
+                molecules = molecule_store.MoleculeStore(molecule_store.write_molecules(tmp_global_parameters, smiles))
+            coordinates_path = molecule_coordinates.write_coordinates(tmp_global_parameters, smiles, molecules)
+            smiles_list.append(smiles)
+            molecules_list.append(molecules)
+            coordinates_list.append(molecule_coordinates.MoleculeCoordinates(coordinates_path))
+        # Experiments running at the same time wait for the one that writes the file
+        with file_util.FileLock(preprocessed_path):
+            if file_util.file_exists(preprocessed_path):
+                Tensor2D.set_input_dimensions(global_parameters, preprocessed_path)
+                logger.log('Skipping step: ' + preprocessed_path + ' already exists')
             else:
-                data_set_h5 = h5py.File(file_structure.get_data_set_file(global_parameters), 'r')
-                smiles = data_set_h5[file_structure.DataSet.smiles][:]
-                data_set_h5.close()
-            temp_preprocessed_path = file_util.get_temporary_file_path('tensor_2d')
-            preprocessed_h5 = h5py.File(temp_preprocessed_path, 'w')
-            number_chemical_properties = len(local_parameters['chemical_properties'])
-            chunks = misc.chunk(smiles.shape[0], process_pool.default_number_processes)
-            # First run: Calculate gridsize_x, gridsize_y, symbols, normalization_min, normalization_max,
-            # normalization_mean
-            logger.log('Calculating stats')
-            with process_pool.ProcessPool(len(chunks)) as pool:
+                number_molecules = sum(len(smiles) for smiles in smiles_list)
+                temp_preprocessed_path = file_util.get_temporary_file_path('tensor_2d')
+                preprocessed_h5 = h5py.File(temp_preprocessed_path, 'w')
+                number_chemical_properties = len(local_parameters['chemical_properties'])
+                chunks = list()
+                for i in range(len(smiles_list)):
+                    for chunk in misc.chunk(len(smiles_list[i]), process_pool.default_number_processes):
+                        chunk['data_set'] = i
+                        chunks.append(chunk)
+                # Calculate gridsize_x, gridsize_y, symbols and the statistics of the chemical properties in a single
+                # run, the statistics of the chunks are merged afterwards
+                logger.log('Calculating stats')
                 needs_min_max = local_parameters['normalization'] == normalization.NormalizationTypes.min_max_1 \
                                 or local_parameters['normalization'] == normalization.NormalizationTypes.min_max_2
                 needs_mean_std = local_parameters['normalization'] == normalization.NormalizationTypes.z_score
-                with multi_process_progressbar.MultiProcessProgressbar(smiles.shape[0], value_buffer=10) as progress:
-                    for chunk in chunks:
-                        pool.submit(Tensor2D.first_run, smiles[chunk['start']:chunk['end']],
-                                    chemical_properties_=local_parameters['chemical_properties'],
-                                    with_atom_symbols=local_parameters['atom_symbols'],
-                                    with_bonds=local_parameters['bonds'],
-                                    normalization_min=needs_min_max, normalization_max=needs_min_max,
-                                    normalization_mean=needs_mean_std, progress=progress.get_slave())
-                    results = pool.get_results()
-                same_values = results[0]['same_values']
+                with process_pool.ProcessPool() as pool:
+                    with multi_process_progressbar.MultiProcessProgressbar(number_molecules,
+                                                                           value_buffer=10) as progress:
+                        for chunk in chunks:
+                            pool.submit(Tensor2D.first_run, smiles_list[chunk['data_set']][chunk['start']:chunk['end']],
+                                        coordinates_list[chunk['data_set']], chunk['start'],
+                                        molecules=molecules_list[chunk['data_set']],
+                                        chemical_properties_=local_parameters['chemical_properties'],
+                                        with_atom_symbols=local_parameters['atom_symbols'],
+                                        with_bonds=local_parameters['bonds'], progress=progress.get_slave())
+                        results = pool.get_results()
+                statistics = results[0]
                 for i in range(1, len(results)):
-                    for j in range(len(same_values)):
-                        same_values[j].add_same_value(results[i]['same_values'][j])
+                    statistics.merge(results[i])
                 valid_property_indices = list()
                 valid_properties = list()
                 for i in range(len(local_parameters['chemical_properties'])):
-                    if same_values[i].same():
+                    if statistics.same(i):
                         logger.log('All values for ' + local_parameters['chemical_properties'][i] + ' are '
-                                   + str(same_values[i].get_value()) + '. Leaving it out.', logger.LogLevel.WARNING)
+                                   + str(statistics.get_value(i)) + '. Leaving it out.', logger.LogLevel.WARNING)
                     else:
                         valid_property_indices.append(i)
                         valid_properties.append(local_parameters['chemical_properties'][i])
-                min_x = None
-                max_x = None
-                min_y = None
-                max_y = None
-                symbols = set()
-                if needs_min_max:
-                    mins = numpy.zeros(len(valid_property_indices), dtype='float32')
-                    mins[:] = numpy.nan
-                    maxs = numpy.zeros(len(valid_property_indices), dtype='float32')
-                    maxs[:] = numpy.nan
-                if needs_mean_std:
-                    means = numpy.zeros(len(valid_property_indices), dtype='float32')
-                for i in range(len(results)):
-                    min_x = misc.minimum(min_x, results[i]['min_x'])
-                    max_x = misc.maximum(max_x, results[i]['max_x'])
-                    min_y = misc.minimum(min_y, results[i]['min_y'])
-                    max_y = misc.maximum(max_y, results[i]['max_y'])
-                    symbols = symbols.union(results[i]['symbols'])
-                    if needs_min_max or needs_mean_std:
-                        index = 0
-                        for j in valid_property_indices:
-                            if needs_min_max:
-                                mins[index] = misc.minimum(mins[index], results[i]['normalization_min'][j])
-                                maxs[index] = misc.maximum(maxs[index], results[i]['normalization_max'][j])
-                            if needs_mean_std:
-                                means[index] += results[i]['normalization_mean'][j]
-                            index += 1
+                symbols = statistics.symbols
                 if local_parameters['symbols'] is not None:
                     symbols = symbols.union(set(local_parameters['symbols'].split(';')))
-                if needs_mean_std:
-                    means /= len(chunks)
+                max_symbols = tensor_2d_preprocessor.max_index_encoded_symbols
+                if local_parameters['symbol_encoding'] == tensor_2d_preprocessor.SymbolEncodings.index \
+                        and len(symbols) > max_symbols:
+                    raise ValueError('Index encoding supports up to ' + str(max_symbols) + ' symbols, found '
+                                     + str(len(symbols)))
                 if len(symbols) > 0:
                     symbols = Tensor2D.string_list_to_numpy_array(sorted(symbols))
                     hdf5_util.create_dataset_from_data(preprocessed_h5, file_structure.PreprocessedTensor2D.symbols,
                                                        symbols)
                 if needs_min_max:
                     hdf5_util.create_dataset_from_data(preprocessed_h5,
-                                                       file_structure.PreprocessedTensor2D.normalization_min, mins)
+                                                       file_structure.PreprocessedTensor2D.normalization_min,
+                                                       statistics.min[valid_property_indices].astype('float32'))
                     hdf5_util.create_dataset_from_data(preprocessed_h5,
-                                                       file_structure.PreprocessedTensor2D.normalization_max, maxs)
+                                                       file_structure.PreprocessedTensor2D.normalization_max,
+                                                       statistics.max[valid_property_indices].astype('float32'))
                 if needs_mean_std:
                     hdf5_util.create_dataset_from_data(preprocessed_h5,
-                                                       file_structure.PreprocessedTensor2D.normalization_mean, means)
+                                                       file_structure.PreprocessedTensor2D.normalization_mean,
+                                                       statistics.mean[valid_property_indices].astype('float32'))
+                    hdf5_util.create_dataset_from_data(preprocessed_h5,
+                                                       file_structure.PreprocessedTensor2D.normalization_std,
+                                                       statistics.std()[valid_property_indices].astype('float32'))
+                min_x = statistics.min_x
+                max_x = statistics.max_x
+                min_y = statistics.min_y
+                max_y = statistics.max_y
                 rasterizer_ = rasterizer.Rasterizer(local_parameters['scale'], tensor_2d_preprocessor.padding,
-                                                    min_x, max_x,
-                                                    min_y, max_y, local_parameters['square'])
+                                                    min_x, max_x, min_y, max_y, local_parameters['square'])
                 dimensions = (rasterizer_.size_x, rasterizer_.size_y, len(symbols) + len(valid_properties))
-                # Second run: Calculate normalization_std
-                if needs_mean_std:
-                    logger.log('Calculating standard deviation')
-                    with multi_process_progressbar.MultiProcessProgressbar(smiles.shape[0],
-                                                                           value_buffer=10) as progress:
-                        for chunk in chunks:
-                            pool.submit(Tensor2D.second_run, smiles[chunk['start']:chunk['end']],
-                                        valid_properties, means, progress=progress.get_slave())
-                        results = pool.get_results()
-                    stds = numpy.zeros(len(valid_properties), dtype='float32')
-                    atom_counter = 0
-                    for i in range(len(results)):
-                        atom_counter += results[i]['atom_counter']
-                        for j in range(len(valid_properties)):
-                            stds[j] += results[i]['normalization_std'][j]
-                    stds /= atom_counter
-                    stds = numpy.sqrt(stds)
+                # Write chemical properties
+                if number_chemical_properties > 0:
+                    chemical_properties_array = Tensor2D.string_list_to_numpy_array(valid_properties)
                     hdf5_util.create_dataset_from_data(preprocessed_h5,
-                                                       file_structure.PreprocessedTensor2D.normalization_std, stds)
-            # Write chemical properties
-            if number_chemical_properties > 0:
-                chemical_properties_array = Tensor2D.string_list_to_numpy_array(valid_properties)
-                hdf5_util.create_dataset_from_data(preprocessed_h5,
-                                                   file_structure.PreprocessedTensor2D.chemical_properties,
-                                                   chemical_properties_array)
-            hdf5_util.set_property(preprocessed_h5, file_structure.PreprocessedTensor2D.dimensions, dimensions)
-            hdf5_util.set_property(preprocessed_h5, file_structure.PreprocessedTensor2D.min_x, min_x)
-            hdf5_util.set_property(preprocessed_h5, file_structure.PreprocessedTensor2D.max_x, max_x)
-            hdf5_util.set_property(preprocessed_h5, file_structure.PreprocessedTensor2D.min_y, min_y)
-            hdf5_util.set_property(preprocessed_h5, file_structure.PreprocessedTensor2D.max_y, max_y)
-            hdf5_util.set_property(preprocessed_h5, file_structure.PreprocessedTensor2D.scale,
-                                   local_parameters['scale'])
-            hdf5_util.set_property(preprocessed_h5, file_structure.PreprocessedTensor2D.with_bonds,
-                                   local_parameters['bonds'])
-            hdf5_util.set_property(preprocessed_h5, file_structure.PreprocessedTensor2D.square,
-                                   local_parameters['square'])
-            if local_parameters['normalization'] is not None:
-                hdf5_util.set_property(preprocessed_h5, file_structure.PreprocessedTensor2D.normalization_type,
-                                       local_parameters['normalization'])
-            preprocessed_h5.close()
-            file_util.move_file(temp_preprocessed_path, preprocessed_path)
-            global_parameters[constants.GlobalParameters.input_dimensions] = dimensions
+                                                       file_structure.PreprocessedTensor2D.chemical_properties,
+                                                       chemical_properties_array)
+                hdf5_util.set_property(preprocessed_h5, file_structure.PreprocessedTensor2D.dimensions, dimensions)
+                hdf5_util.set_property(preprocessed_h5, file_structure.PreprocessedTensor2D.min_x, min_x)
+                hdf5_util.set_property(preprocessed_h5, file_structure.PreprocessedTensor2D.max_x, max_x)
+                hdf5_util.set_property(preprocessed_h5, file_structure.PreprocessedTensor2D.min_y, min_y)
+                hdf5_util.set_property(preprocessed_h5, file_structure.PreprocessedTensor2D.max_y, max_y)
+                hdf5_util.set_property(preprocessed_h5, file_structure.PreprocessedTensor2D.scale,
+                                       local_parameters['scale'])
+                hdf5_util.set_property(preprocessed_h5, file_structure.PreprocessedTensor2D.with_bonds,
+                                       local_parameters['bonds'])
+                hdf5_util.set_property(preprocessed_h5, file_structure.PreprocessedTensor2D.square,
+                                       local_parameters['square'])
+                if local_parameters['normalization'] is not None:
+                    hdf5_util.set_property(preprocessed_h5, file_structure.PreprocessedTensor2D.normalization_type,
+                                           local_parameters['normalization'])
+                hdf5_util.set_property(preprocessed_h5, file_structure.PreprocessedTensor2D.symbol_encoding,
+                                       local_parameters['symbol_encoding'])
+                preprocessed_h5.close()
+                file_util.move_file(temp_preprocessed_path, preprocessed_path)
+                Tensor2D.set_input_dimensions(global_parameters, preprocessed_path)
 
     @staticmethod
-    def first_run(smiles, chemical_properties_=[], with_atom_symbols=False, with_bonds=False, normalization_min=False,
-                  normalization_max=False, normalization_mean=False, progress=None):
-        results = dict()
-        same_values = list()
-        for i in range(len(chemical_properties_)):
-            same_values.append(SameValues())
-        min_x = None
-        max_x = None
-        min_y = None
-        max_y = None
-        symbols = set()
-        if normalization_min:
-            n_min = numpy.zeros(len(chemical_properties_), dtype='float32')
-            n_min[:] = numpy.nan
-        if normalization_max:
-            n_max = numpy.zeros(len(chemical_properties_), dtype='float32')
-            n_max[:] = numpy.nan
-        if normalization_mean:
-            atom_counter = 0
-            n_mean = numpy.zeros(len(chemical_properties_), dtype='float32')
-        for i in range(smiles.shape[0]):
-            molecule = Chem.MolFromSmiles(smiles[i].decode('utf-8'))
-            AllChem.Compute2DCoords(molecule)
-            for atom in molecule.GetAtoms():
-                position = molecule.GetConformer().GetAtomPosition(atom.GetIdx())
-                min_x = misc.minimum(min_x, position.x)
-                max_x = misc.maximum(max_x, position.x)
-                min_y = misc.minimum(min_y, position.y)
-                max_y = misc.maximum(max_y, position.y)
-                if with_atom_symbols:
-                    symbols.add(atom.GetSymbol())
-                chemical_property_values = chemical_properties.get_chemical_properties(atom, chemical_properties_)
-                for j in range(len(chemical_property_values)):
-                    same_values[j].add(chemical_property_values[j])
-                    if normalization_min:
-                        n_min[j] = misc.minimum(n_min[j], chemical_property_values[j])
-                    if normalization_max:
-                        n_max[j] = misc.maximum(n_max[j], chemical_property_values[j])
-                    if normalization_mean:
-                        n_mean[j] += chemical_property_values[j]
-                if normalization_mean:
-                    atom_counter += 1
-            if with_bonds:
-                for bond in molecule.GetBonds():
-                    symbols.add(bond_symbols.get_bond_symbol(bond.GetBondType()))
-            if progress is not None:
-                progress.increment()
-        if progress is not None:
-            progress.finish()
-        results['min_x'] = min_x
-        results['max_x'] = max_x
-        results['min_y'] = min_y
-        results['max_y'] = max_y
-        results['symbols'] = symbols
-        if normalization_min:
-            results['normalization_min'] = n_min
-        if normalization_max:
-            results['normalization_max'] = n_max
-        if normalization_mean:
-            n_mean /= atom_counter
-            results['normalization_mean'] = n_mean
-        results['same_values'] = same_values
-        return results
+    def set_input_dimensions(global_parameters, preprocessed_path):
+        # With index encoding the network input has a single symbol channel and the number of symbols it encodes is
+        # set as encoded_symbols
+        dimensions = tuple(hdf5_util.get_property(preprocessed_path, file_structure.PreprocessedTensor2D.dimensions))
+        global_parameters.pop(constants.GlobalParameters.encoded_symbols, None)
+        if hdf5_util.get_property(preprocessed_path, file_structure.PreprocessedTensor2D.symbol_encoding) \
+                == tensor_2d_preprocessor.SymbolEncodings.index:
+            number_symbols = 0
+            if hdf5_util.has_data_set(preprocessed_path, file_structure.PreprocessedTensor2D.symbols):
+                with h5py.File(preprocessed_path, 'r') as preprocessed_h5:
+                    number_symbols = len(preprocessed_h5[file_structure.PreprocessedTensor2D.symbols])
+            dimensions = dimensions[:2] + (dimensions[2] - number_symbols + 1,)
+            global_parameters[constants.GlobalParameters.encoded_symbols] = number_symbols
+        global_parameters[constants.GlobalParameters.input_dimensions] = dimensions
 
     @staticmethod
-    def second_run(smiles, chemical_properties_, means, progress=None):
-        results = dict()
-        n_std = numpy.zeros(len(chemical_properties_), dtype='float32')
-        atom_counter = 0
-        for i in range(smiles.shape[0]):
-            molecule = Chem.MolFromSmiles(smiles[i].decode('utf-8'))
-            for atom in molecule.GetAtoms():
-                chemical_property_values = chemical_properties.get_chemical_properties(atom, chemical_properties_)
-                for j in range(len(chemical_property_values)):
-                    n_std[j] += (chemical_property_values[j] - means[j]) ** 2
-                atom_counter += 1
-            if progress is not None:
-                progress.increment()
+    def first_run(smiles, coordinates, start, molecules=None, chemical_properties_=[], with_atom_symbols=False,
+                  with_bonds=False, progress=None):
+        statistics = Statistics(len(chemical_properties_))
+        atom_coordinates, atomic_numbers, bonds = coordinates.get_range(start, start + smiles.shape[0])
+        statistics.add_coordinates(atom_coordinates)
+        if with_atom_symbols:
+            periodic_table = Chem.GetPeriodicTable()
+            for atomic_number in numpy.unique(atomic_numbers):
+                statistics.symbols.add(periodic_table.GetElementSymbol(int(atomic_number)))
+        if with_bonds:
+            for bond_type in numpy.unique(bonds[:, 2]):
+                bond_symbol = bond_symbols.get_bond_symbol(BondType.values[int(bond_type)])
+                if bond_symbol is not None:
+                    statistics.symbols.add(bond_symbol)
+        if len(chemical_properties_) > 0:
+            for i in range(smiles.shape[0]):
+                molecule = molecule_store.get_molecule(smiles[i], start + i, molecules)
+                statistics.add_values(chemical_properties.get_chemical_properties_matrix(molecule,
+                                                                                         chemical_properties_))
+                if progress is not None:
+                    progress.increment()
+        elif progress is not None:
+            progress.increment(smiles.shape[0])
         if progress is not None:
             progress.finish()
-        results['normalization_std'] = n_std
-        results['atom_counter'] = atom_counter
-        return results
+        return statistics
 
     @staticmethod
     def string_list_to_numpy_array(string_list):
@@ -314,32 +275,74 @@ class Tensor2D:
         return array
 
 
-class SameValues():
+class Statistics():
 
-    def __init__(self):
-        self._value = None
-        self._same = True
+    # Single pass statistics of the grid extent, the symbols and the chemical properties. The statistics of
+    # different chunks can be merged exactly (mean and variance are combined with the parallel algorithm of Chan et
+    # al.).
 
-    def add(self, value):
-        if self._same:
-            if self._value is None:
-                self._value = value
-            elif self._value != value:
-                self._same = False
-                self._value = None
+    def __init__(self, number_properties):
+        self.min_x = None
+        self.max_x = None
+        self.min_y = None
+        self.max_y = None
+        self.symbols = set()
+        self.count = 0
+        self.mean = numpy.zeros(number_properties, dtype='float64')
+        self.m2 = numpy.zeros(number_properties, dtype='float64')
+        self.min = numpy.full(number_properties, numpy.nan, dtype='float64')
+        self.max = numpy.full(number_properties, numpy.nan, dtype='float64')
+
+    def add_coordinates(self, coordinates):
+        if len(coordinates) > 0:
+            self.min_x = misc.minimum(self.min_x, float(coordinates[:, 0].min()))
+            self.max_x = misc.maximum(self.max_x, float(coordinates[:, 0].max()))
+            self.min_y = misc.minimum(self.min_y, float(coordinates[:, 1].min()))
+            self.max_y = misc.maximum(self.max_y, float(coordinates[:, 1].max()))
+
+    def add_values(self, values):
+        # Adds a (number values, number properties) matrix
+        if len(values) > 0:
+            values = values.astype('float64')
+            mean = values.mean(axis=0)
+            self._combine(len(values), mean, ((values - mean) ** 2).sum(axis=0), values.min(axis=0),
+                          values.max(axis=0))
+
+    def merge(self, other):
+        self.min_x = misc.minimum(self.min_x, other.min_x)
+        self.max_x = misc.maximum(self.max_x, other.max_x)
+        self.min_y = misc.minimum(self.min_y, other.min_y)
+        self.max_y = misc.maximum(self.max_y, other.max_y)
+        self.symbols = self.symbols.union(other.symbols)
+        if other.count > 0:
+            self._combine(other.count, other.mean, other.m2, other.min, other.max)
+
+    def _combine(self, count, mean, m2, min_, max_):
+        if self.count == 0:
+            self.mean = mean.copy()
+            self.m2 = m2.copy()
+            self.min = min_.copy()
+            self.max = max_.copy()
+        else:
+            total = self.count + count
+            delta = mean - self.mean
+            self.mean = self.mean + delta * (count / total)
+            self.m2 = self.m2 + m2 + delta ** 2 * (self.count * count / total)
+            self.min = numpy.fmin(self.min, min_)
+            self.max = numpy.fmax(self.max, max_)
+        self.count += count
 
-    def add_same_value(self, value):
-        if not self._same or not value._same:
-            self._same = False
-            self._value = None
-        elif self._value is None:
-            self._value = value._value
-        elif self._value != value._value:
-            self._same = False
-            self._value = None
+    def std(self):
+        # Population standard deviation
+        if self.count == 0:
+            return numpy.zeros(len(self.m2), dtype='float64')
+        return numpy.sqrt(self.m2 / self.count)
 
-    def same(self):
-        return self._same
+    def same(self, index):
+        # True if all values of the property are the same (or there are none)
+        return self.count == 0 or self.min[index] == self.max[index]
 
-    def get_value(self):
-        return self._value
+    def get_value(self, index):
+        if self.count == 0:
+            return None
+        return self.min[index]
@@ -4,7 +4,8 @@ import h5py
 import numpy
 from rdkit import Chem
 
-from util import data_validation, file_structure, file_util, misc, process_pool, logger, constants, hdf5_util
+from util import data_validation, file_structure, file_util, misc, process_pool, logger, constants, hdf5_util, \
+    artifact_cache
 
 
 class Substructure:
@@ -41,6 +42,8 @@ class Substructure:
     @staticmethod
     def get_result_file(global_parameters, local_parameters):
         hash_parameters = misc.copy_dict_from_keys(local_parameters, ['substructures', 'logic', 'error'])
+        # Targets are found by name, so they stay in the target folder but their name covers the data set content
+        hash_parameters['data_set'] = artifact_cache.data_set_digest(global_parameters)
         file_name = misc.hash_parameters(hash_parameters) + '.h5'
         if local_parameters['name'] is not None:
             substructure_name = local_parameters['name']
@@ -57,41 +60,42 @@ class Substructure:
             logger.log('Target has already been specified. Overwriting target parameter with generated target.',
                        logger.LogLevel.WARNING)
         global_parameters[constants.GlobalParameters.target] = file_util.get_filename(target_path, False)
-        if file_util.file_exists(target_path):
-            logger.log('Skipping step: ' + target_path + ' already exists')
-        else:
-            substructures = []
-            for string in local_parameters['substructures'].split(';'):
-                substructures.append(Chem.MolFromSmiles(string, sanitize=False))
-            temp_target_path = file_util.get_temporary_file_path('substructure_target_data')
-            logic = local_parameters['logic']
-            if logic is None:
-                logic = 'a'
-                for i in range(1, len(substructures)):
-                    logic += '&' + chr(ord('a') + i)
-            error = local_parameters['error'] * 0.01
-            data_h5 = h5py.File(file_structure.get_data_set_file(global_parameters), 'r')
-            smiles_data = data_h5[file_structure.DataSet.smiles][:]
-            data_h5.close()
-            chunks = misc.chunk(len(smiles_data), process_pool.default_number_processes)
-            pool = process_pool.ProcessPool(len(chunks))
-            for i in range(len(chunks)):
-                chunk = chunks[i]
-                pool.submit(generate_targets, smiles_data[chunk['start']:chunk['end']], substructures, logic, error,
-                            global_parameters[constants.GlobalParameters.seed] + i)
-            results = pool.get_results()
-            pool.close()
-            target_h5 = h5py.File(temp_target_path, 'w')
-            classes = hdf5_util.create_dataset(target_h5, file_structure.Target.classes, (len(smiles_data), 2),
-                                               dtype='uint8')
-            offset = 0
-            for result in results:
-                classes[offset:offset + len(result)] = result[:]
-                offset += len(result)
-            hdf5_util.set_property(target_h5, 'substructures', local_parameters['substructures'])
-            hdf5_util.set_property(target_h5, 'logic', logic)
-            target_h5.close()
-            file_util.move_file(temp_target_path, target_path)
+        # Experiments running at the same time wait for the one that writes the file
+        with file_util.FileLock(target_path):
+            if file_util.file_exists(target_path):
+                logger.log('Skipping step: ' + target_path + ' already exists')
+            else:
+                substructures = []
+                for string in local_parameters['substructures'].split(';'):
+                    substructures.append(Chem.MolFromSmiles(string, sanitize=False))
+                temp_target_path = file_util.get_temporary_file_path('substructure_target_data')
+                logic = local_parameters['logic']
+                if logic is None:
+                    logic = 'a'
+                    for i in range(1, len(substructures)):
+                        logic += '&' + chr(ord('a') + i)
+                error = local_parameters['error'] * 0.01
+                smiles_data = hdf5_util.load_data_set(file_structure.get_data_set_file(global_parameters),
+                                                      file_structure.DataSet.smiles)
+                chunks = misc.chunk(len(smiles_data), process_pool.default_number_processes)
+                pool = process_pool.ProcessPool(len(chunks))
+                for i in range(len(chunks)):
+                    chunk = chunks[i]
+                    pool.submit(generate_targets, smiles_data[chunk['start']:chunk['end']], substructures, logic, error,
+                                global_parameters[constants.GlobalParameters.seed] + i)
+                results = pool.get_results()
+                pool.close()
+                target_h5 = h5py.File(temp_target_path, 'w')
+                # Contiguous and uncompressed so that the classes can be memory mapped
+                classes = target_h5.create_dataset(file_structure.Target.classes, (len(smiles_data), 2), dtype='uint8')
+                offset = 0
+                for result in results:
+                    classes[offset:offset + len(result)] = result[:]
+                    offset += len(result)
+                hdf5_util.set_property(target_h5, 'substructures', local_parameters['substructures'])
+                hdf5_util.set_property(target_h5, 'logic', logic)
+                target_h5.close()
+                file_util.move_file(temp_target_path, target_path)
 
 
 def generate_targets(smiles_data, substructures, logic, error, random_seed):
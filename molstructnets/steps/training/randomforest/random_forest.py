@@ -1,7 +1,7 @@
 import h5py
 
 from steps.training.shared.randomforest import random_forest
-from util import data_validation, file_structure, file_util, logger, constants
+from util import data_validation, file_structure, file_util, logger, constants, hdf5_util
 
 
 class RandomForest:
@@ -43,9 +43,8 @@ class RandomForest:
             partition_h5 = h5py.File(file_structure.get_partition_file(global_parameters), 'r')
             train = partition_h5[file_structure.Partitions.train][:]
             partition_h5.close()
-            target_h5 = h5py.File(file_structure.get_target_file(global_parameters), 'r')
-            classes = target_h5[file_structure.Target.classes][:]
-            target_h5.close()
+            classes = hdf5_util.load_data_set(file_structure.get_target_file(global_parameters),
+                                              file_structure.Target.classes)
             preprocessed_h5 = h5py.File(global_parameters[constants.GlobalParameters.preprocessed_data], 'r')
             preprocessed = preprocessed_h5[file_structure.Preprocessed.preprocessed][:]
             preprocessed_h5.close()
@@ -44,7 +44,16 @@ def transfer_weights(source_model, destination_model, weight_start_index, weight
 
 
 def set_weight_freeze(model, layer_start_index, layer_end_index, freeze):
+    # The training function of each freeze state is built once per model and then swapped in, rebuilding the graph on
+    # every switch is slow and leaks memory
     for i in range(layer_start_index, layer_end_index):
         model.layers[i].trainable = not freeze
-    model._collected_trainable_weights = model.trainable_weights
-    model._make_train_function()
+    if not hasattr(model, '_freeze_train_functions'):
+        model._freeze_train_functions = dict()
+    key = (layer_start_index, layer_end_index, freeze)
+    if key not in model._freeze_train_functions:
+        model._collected_trainable_weights = model.trainable_weights
+        model.train_function = None
+        model._make_train_function()
+        model._freeze_train_functions[key] = (model._collected_trainable_weights, model.train_function)
+    model._collected_trainable_weights, model.train_function = model._freeze_train_functions[key]
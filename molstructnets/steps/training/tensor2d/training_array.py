@@ -1,77 +1,52 @@
-import math
-import queue
-
-from steps.preprocessing.shared.tensor2d import tensor_2d_array
-from util import thread_pool, misc
+from steps.preprocessing.shared.tensor2d import tensor_2d_array, tensor_2d_sequence, augmentation_cache, \
+    balanced_sampler
+from util import constants, memory_budget
 
 
 class TrainingArrays():
 
-    def __init__(self, global_parameters, epochs, previous_epochs, batch_size, multi_process=True):
+    def __init__(self, global_parameters, previous_epochs, batch_size, multi_process=True, sparse=False,
+                 prefetch_batches=10, cached_variants=0, balanced=False, epoch_length=None):
         self._array = tensor_2d_array.load_array(global_parameters, train=True, transform=True,
-                                                 multi_process=multi_process)
-        for i in range(previous_epochs):
-            self._array.shuffle()
-        preprocess_size = misc.max_in_memory_chunk_size(self._array.dtype, self._array.shape, use_swap=False,
-                                                        fraction=1 / 3)
-        preprocess_size -= preprocess_size % batch_size
-        queue_size = int(preprocess_size / batch_size)
-        preprocess_size = min(len(self._array), preprocess_size)
-        input_queue = queue.Queue(queue_size)
-        output_queue = queue.Queue(queue_size)
-        self._input_array = QueueArray(self._array.shape, input_queue)
-        self._output_array = QueueArray((len(self._array), 2), output_queue)
-        self._pool = thread_pool.ThreadPool(1)
-        self._pool.submit(preprocess_batches, self._array, epochs, batch_size, input_queue, output_queue,
-                          preprocess_size)
+                                                 multi_process=multi_process, sparse=sparse)
+        # With balanced sampling the epochs draw both classes equally often instead of iterating over the partition
+        sampler = None
+        if balanced:
+            sampler = balanced_sampler.BalancedSampler(self._array.classes(),
+                                                       global_parameters[constants.GlobalParameters.seed],
+                                                       epoch_length)
+        # Up to prefetch_batches batches are being preprocessed and as many are waiting for the network
+        batch_bytes = self._array.memory_size(batch_size)
+        self._allowance = memory_budget.instance.request('Training data', 2 * prefetch_batches * batch_bytes,
+                                                         2 * batch_bytes)
+        self._prefetch_batches = self._allowance.count(2 * batch_bytes)
+        # The first cached_variants epochs are rasterized once and all epochs are then read from disk
+        self._cache = None
+        if cached_variants > 0:
+            cache_path = augmentation_cache.get_file(global_parameters, self._array, batch_size, cached_variants,
+                                                     sampler)
+            augmentation_cache.write_cache(global_parameters, cache_path, batch_size, cached_variants, multi_process,
+                                           self._prefetch_batches, sampler)
+            self._cache = augmentation_cache.AugmentationCache(cache_path)
+        self._sequence = tensor_2d_sequence.Tensor2DSequence(self._array, batch_size,
+                                                             global_parameters[constants.GlobalParameters.seed],
+                                                             shuffle=True, with_classes=True, epoch=previous_epochs,
+                                                             prefetch_batches=self._prefetch_batches, cache=self._cache,
+                                                             sampler=sampler)
 
     @property
-    def input(self):
-        return self._input_array
+    def sequence(self):
+        return self._sequence
 
     @property
-    def output(self):
-        return self._output_array
+    def prefetch_batches(self):
+        # Number of batches that may wait for the network within the memory allowance
+        return self._prefetch_batches
 
     def close(self):
-        self._pool.close()
+        self._sequence.log_stalls('Training data')
+        self._sequence.close()
         self._array.close()
-
-
-class QueueArray():
-
-    def __init__(self, shape, queue):
-        self._shape = shape
-        self._queue = queue
-
-    @property
-    def shape(self):
-        return self._shape
-
-    @property
-    def ndim(self):
-        return len(self._shape)
-
-    def __len__(self):
-        return self._shape[0]
-
-    def __getitem__(self, item):
-        return self._queue.get()
-
-
-def preprocess_batches(array, epochs, batch_size, input_queue, output_queue, preprocess_size=None):
-    if preprocess_size is None:
-        preprocess_size = len(array)
-    for epoch in range(epochs):
-        preprocess_offset = 0
-        while preprocess_offset < len(array):
-            preprocess_next = preprocess_offset + min(preprocess_size, len(array) - preprocess_offset)
-            data = array[preprocess_offset:preprocess_next]
-            offset = 0
-            while offset < len(data):
-                next = offset + min(batch_size, len(data) - offset)
-                input_queue.put(data[offset:next])
-                output_queue.put(array.classes(slice(preprocess_offset + offset, preprocess_offset + next)))
-                offset = next
-            preprocess_offset = preprocess_next
-        array.shuffle()
+        if self._cache is not None:
+            self._cache.close()
+        self._allowance.release()
@@ -0,0 +1,47 @@
+from steps.training.shared.tensor2d import weight_transfer
+
+
+def create_models(shared_model, number_heads):
+    # Returns a list of frozen and a list of trainable models with one model per head. Every model consists of the
+    # layers of the shared model up to the features layer and a clone of the layers after it, the frozen and the
+    # trainable model of a head use the same layers. A batch of a data set trains only the model of its head, so the
+    # weights of the other heads are not part of the update. Each model has its own copy of the optimizer of the
+    # shared model: optimizers with momentum (e.g. Adam) keep moving weights whose gradient is zero, so a shared
+    # optimizer would still change the other heads. As the trainable weights are collected at compilation, switching
+    # between frozen and unfrozen training does not need to rebuild anything. The layers of the shared model itself
+    # are trained, so it can be saved as it is.
+    # Keras is imported here, so the training loop can be used without it
+    from keras import models, optimizers
+    layer_start_index, layer_end_index = weight_transfer.get_layer_range(shared_model, 'input', 'features')
+    features = shared_model.layers[layer_end_index - 1].output
+    heads = list()
+    for i in range(number_heads):
+        layer = features
+        for head_layer in shared_model.layers[layer_end_index:]:
+            config = head_layer.get_config()
+            config['name'] = head_layer.name + '_' + str(i)
+            layer = head_layer.__class__.from_config(config)(layer)
+        heads.append(layer)
+    compiled_models = dict()
+    for freeze in [True, False]:
+        for i in range(layer_start_index, layer_end_index):
+            shared_model.layers[i].trainable = not freeze
+        compiled_models[freeze] = list()
+        for head in heads:
+            model = models.Model(inputs=shared_model.input, outputs=head)
+            optimizer = optimizers.deserialize(optimizers.serialize(shared_model.optimizer))
+            model.compile(optimizer=optimizer, loss=shared_model.loss)
+            compiled_models[freeze].append(model)
+    return compiled_models[True], compiled_models[False]
+
+
+def train_epoch(frozen_models, trainable_models, arrays, frozen_runs, progress, batch_size):
+    # The batches of the data sets are interleaved like the batches of the models per data set. Each batch trains the
+    # frozen model of its data set frozen_runs times and then its trainable model once.
+    for j in range(arrays.batches_per_epoch()):
+        for k in range(len(trainable_models)):
+            inputs, outputs = arrays.next_batch()
+            for run in range(frozen_runs):
+                frozen_models[k].train_on_batch(inputs, outputs)
+            trainable_models[k].train_on_batch(inputs, outputs)
+            progress.increment(batch_size)
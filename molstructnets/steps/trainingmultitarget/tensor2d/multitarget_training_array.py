@@ -1,13 +1,18 @@
 import queue
+import threading
+
 import numpy
 import math
 
 from steps.preprocessing.shared.tensor2d import tensor_2d_array
-from util import thread_pool, misc, constants
+from util import thread_pool, misc, constants, memory_budget
 
 
 class MultitargetTrainingArrays():
 
+    # Each data set has its own producer thread that preprocesses its batches into a bounded queue, so slow data sets
+    # do not stall the others. The queue of every data set is capped by its own memory allowance.
+
     def __init__(self, global_parameters, epochs, previous_epochs, batch_size, frozen_runs, multi_process=True):
         self._arrays = list()
         data_sets = global_parameters[constants.GlobalParameters.data_set]
@@ -18,26 +23,31 @@ class MultitargetTrainingArrays():
             global_params[constants.GlobalParameters.partition_data] = global_parameters[constants.GlobalParameters.partition_data][i]
             array = tensor_2d_array.load_array(global_params, train=True, transform=True, multi_process=multi_process)
             self._arrays.append(array)
-        preprocess_size = misc.max_in_memory_chunk_size(self._arrays[0].dtype, self._arrays[0].shape, use_swap=False,
-                                                        fraction=1 / 3)
-        preprocess_size = math.floor(preprocess_size/len(self._arrays))
-        preprocess_size -= preprocess_size % batch_size
-        queue_size = int(preprocess_size / batch_size) * len(self._arrays)
         max_length = None
         for i in range(len(self._arrays)):
             max_length = misc.maximum(max_length, len(self._arrays[i]))
         self._batches_per_epoch = math.ceil(max_length / batch_size)
-        input_queue = queue.Queue(queue_size)
-        output_queue = queue.Queue(queue_size)
+        self._allowances = list()
+        queues = list()
+        for i in range(len(self._arrays)):
+            batch_bytes = self._arrays[i].memory_size(batch_size) + batch_size * 2 * 4
+            allowance = memory_budget.instance.request('Multitarget training data (' + data_sets[i][0] + ')',
+                                                       batch_bytes * self._batches_per_epoch, batch_bytes)
+            self._allowances.append(allowance)
+            # One batch of the allowance is the one currently produced
+            queues.append(queue.Queue(max(1, allowance.count(batch_bytes) - 1)))
         input_shape = list(self._arrays[0].shape)
         input_shape[0] = batch_size
         input_shape = tuple(input_shape)
         output_shape = (batch_size, 2)
-        self._input_array = QueueArray(input_shape, input_queue)
-        self._output_array = QueueArray(output_shape, output_queue)
-        self._pool = thread_pool.ThreadPool(1)
-        self._pool.submit(preprocess_batches, self._arrays, epochs, previous_epochs, batch_size, frozen_runs,
-                          self._batches_per_epoch, input_queue, output_queue, preprocess_size)
+        batches = RoundRobinBatches(queues, frozen_runs + 1)
+        self._input_array = QueueArray(input_shape, batches, 0)
+        self._output_array = QueueArray(output_shape, batches, 1)
+        self._stop = threading.Event()
+        self._pool = thread_pool.ThreadPool(len(self._arrays))
+        for i in range(len(self._arrays)):
+            self._pool.submit(produce_batches, self._arrays[i], epochs, previous_epochs, batch_size,
+                              self._batches_per_epoch, queues[i], self._stop)
 
     @property
     def input(self):
@@ -50,17 +60,55 @@ class MultitargetTrainingArrays():
     def batches_per_epoch(self):
         return self._batches_per_epoch
 
+    def next_batch(self):
+        # Returns the inputs and outputs of the next batch, for training that does not pass input and output to Keras
+        # (only with frozen_runs 0, each batch is handed out once)
+        return self._input_array[0], self._output_array[0]
+
     def close(self):
+        self._stop.set()
         self._pool.close()
         for array in self._arrays:
             array.close()
+        for allowance in self._allowances:
+            allowance.release()
+
+
+class RoundRobinBatches():
+
+    # Hands out the batches of the data sets in turn, each one runs times (the model of a data set is first fitted with
+    # frozen feature layers). Keras requests the inputs (part 0) and outputs (part 1) separately, a batch is dropped
+    # once both have been handed out for every run.
+
+    def __init__(self, queues, runs):
+        self._queues = queues
+        self._runs = runs
+        self._counts = [0, 0]
+        self._batches = dict()
+        self._uses = dict()
+        self._lock = threading.Lock()
+
+    def get(self, part):
+        with self._lock:
+            number = self._counts[part] // self._runs
+            self._counts[part] += 1
+            if number not in self._batches:
+                self._batches[number] = self._queues[number % len(self._queues)].get()
+                self._uses[number] = 0
+            batch = self._batches[number]
+            self._uses[number] += 1
+            if self._uses[number] == 2 * self._runs:
+                del self._batches[number]
+                del self._uses[number]
+        return batch[part]
 
 
 class QueueArray():
 
-    def __init__(self, shape, queue):
+    def __init__(self, shape, batches, part):
         self._shape = shape
-        self._queue = queue
+        self._batches = batches
+        self._part = part
 
     @property
     def shape(self):
@@ -74,52 +122,33 @@ class QueueArray():
         return self._shape[0]
 
     def __getitem__(self, item):
-        return self._queue.get()
-
-
-def preprocess_batches(arrays, epochs, previous_epochs, batch_size, frozen_runs, batches_per_epoch, input_queue, output_queue, preprocess_size=None):
-    if preprocess_size is None:
-        preprocess_size = batch_size * batches_per_epoch
-    dtype = arrays[0].dtype
-    shape = list(arrays[0].shape)
-    shape[0] = preprocess_size
-    shape = tuple(shape)
-    inputs = list()
-    outputs = list()
-    offsets = list()
-    for i in range(len(arrays)):
-        inputs.append(numpy.zeros(shape, dtype))
-        outputs.append(numpy.zeros((preprocess_size, 2), 'float32'))
-        offsets.append(0)
+        return self._batches.get(self._part)
+
+
+def produce_batches(array, epochs, previous_epochs, batch_size, batches_per_epoch, queue_, stop):
+    # The data points of consecutive batches follow each other, the array is shuffled whenever it is used up
     done_points = batches_per_epoch * batch_size * previous_epochs
-    for i in range(len(arrays)):
-        shuffles = math.floor(done_points / len(arrays[i]))
-        for j in range(shuffles):
-            arrays[i].shuffle()
-        offsets[i] += done_points % len(arrays[i])
-    for epoch in range(epochs):
-        for i in range(math.ceil((batches_per_epoch * batch_size) / preprocess_size)):
-            remaining_batches = batches_per_epoch - (i * int(preprocess_size/batch_size))
-            # preprocessing
-            for data_set_index in range(len(arrays)):
-                done = 0
-                array = arrays[data_set_index]
-                todo = min(preprocess_size, remaining_batches * batch_size)
-                while done < todo:
-                    start = offsets[data_set_index]
-                    end = min(len(array), start + todo - done)
-                    size = end - start
-                    inputs[data_set_index][done:done+size] = array[start:end]
-                    outputs[data_set_index][done:done+size] = array.classes(slice(start, end))
-                    done += size
-                    offsets[data_set_index] += size
-                    if offsets[data_set_index] == len(array):
-                        offsets[data_set_index] = 0
-                        array.shuffle()
-            # filling queues
-            for batch_number in range(min(int(preprocess_size/batch_size), remaining_batches)):
-                offset = batch_number * batch_size
-                for data_set_index in range(len(arrays)):
-                    for j in range(frozen_runs + 1):
-                        input_queue.put(inputs[data_set_index][offset:offset+batch_size])
-                        output_queue.put(outputs[data_set_index][offset:offset+batch_size])
+    array.set_iteration(math.floor(done_points / len(array)))
+    offset = done_points % len(array)
+    for batch_number in range(epochs * batches_per_epoch):
+        inputs = list()
+        outputs = list()
+        done = 0
+        while done < batch_size:
+            end = min(len(array), offset + batch_size - done)
+            inputs.append(array[offset:end])
+            outputs.append(array.classes(slice(offset, end)))
+            done += end - offset
+            offset = end
+            if offset == len(array):
+                offset = 0
+                array.shuffle()
+        batch = (numpy.concatenate(inputs), numpy.concatenate(outputs).astype('float32'))
+        while True:
+            if stop.is_set():
+                return
+            try:
+                queue_.put(batch, timeout=1)
+                break
+            except queue.Full:
+                pass
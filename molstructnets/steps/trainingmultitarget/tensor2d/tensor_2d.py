@@ -1,6 +1,6 @@
 from keras import models
 
-from steps.trainingmultitarget.tensor2d import multitarget_training_array
+from steps.trainingmultitarget.tensor2d import multitarget_training_array, multi_head_model
 from steps.training.shared.tensor2d import weight_transfer
 from util import file_structure, logger, callbacks, file_util, constants, progressbar, process_pool
 
@@ -26,6 +26,10 @@ class Tensor2D:
         parameters.append({'id': 'frozen_runs', 'name': 'Frozen Runs', 'type': int, 'default': 1, 'min': 0,
                            'description': 'Number of times the network will be trained with frozen feature layers '
                                           'before they are unfrozen and the real training run is started. Default: 1'})
+        parameters.append({'id': 'multi_head', 'name': 'Multi-head model', 'type': bool, 'default': False,
+                           'description': 'Train models that share their feature layers and have one output head per'
+                                          ' data set, instead of one model per data set that the feature weights are'
+                                          ' copied between before every batch. Default: False'})
         return parameters
 
     @staticmethod
@@ -49,6 +53,14 @@ class Tensor2D:
             batch_size = local_parameters['batch_size']
             frozen_runs = local_parameters['frozen_runs']
             process_pool_ = process_pool.ProcessPool()
+            if local_parameters['multi_head']:
+                # The batches are requested directly, each one once
+                arrays = multitarget_training_array.MultitargetTrainingArrays(global_parameters, epochs - epoch, epoch,
+                                                                              batch_size, 0, process_pool_)
+                Tensor2D.train_multi_head(model_path, arrays, epoch, epochs, batch_size, frozen_runs, len(data_sets))
+                arrays.close()
+                process_pool_.close()
+                return
             arrays = multitarget_training_array.MultitargetTrainingArrays(global_parameters, epochs - epoch, epoch,
                                                                           batch_size, frozen_runs, process_pool_)
             shared_model = models.load_model(model_path)
@@ -81,3 +93,17 @@ class Tensor2D:
                     callbacks.save_model(shared_model, model_path, i)
             arrays.close()
             process_pool_.close()
+
+    @staticmethod
+    def train_multi_head(model_path, arrays, epoch, epochs, batch_size, frozen_runs, number_data_sets):
+        shared_model = models.load_model(model_path)
+        frozen_models, trainable_models = multi_head_model.create_models(shared_model, number_data_sets)
+        logger.log('Running multi-head multitarget training with:\nEpochs: ' + str(epochs) + '\nData sets: '
+                   + str(number_data_sets) + '\nBatches per epoch: ' + str(arrays.batches_per_epoch())
+                   + '\nBatch size: ' + str(batch_size) + '\nFrozen runs: ' + str(frozen_runs))
+        with progressbar.ProgressBar(epochs * arrays.batches_per_epoch() * number_data_sets * batch_size) as progress:
+            progress.increment(epoch * arrays.batches_per_epoch() * number_data_sets * batch_size)
+            for i in range(epoch, epochs):
+                multi_head_model.train_epoch(frozen_models, trainable_models, arrays, frozen_runs, progress, batch_size)
+                # The shared model contains the trained feature layers
+                callbacks.save_model(shared_model, model_path, i)
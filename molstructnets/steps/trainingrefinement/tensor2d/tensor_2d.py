@@ -1,10 +1,8 @@
 from keras import models
-import numpy
 
 from steps.training.tensor2d import training_array
 from keras.callbacks import Callback
-from util import data_validation, file_structure, logger, callbacks, file_util, misc, progressbar, constants,\
-    process_pool
+from util import data_validation, file_structure, logger, callbacks, file_util, constants, process_pool
 from steps.evaluation.shared import enrichment, roc_curve
 from steps.prediction.shared.tensor2d import prediction_array
 from steps.training.shared.tensor2d import weight_transfer
@@ -30,12 +28,30 @@ class Tensor2D:
                                           ' to faster processing but needs more memory. Default: 100'})
         parameters.append({'id': 'evaluate', 'name': 'Evaluate', 'type': bool, 'default': False,
                            'description': 'Evaluate on the test data after each epoch. Default: False'})
+        parameters.append({'id': 'balanced_sampling', 'name': 'Class Balanced Sampling', 'type': bool,
+                           'default': False,
+                           'description': 'Each epoch draws both classes equally often from the training partition,'
+                                          ' the minority class with replacement. This replaces an oversampled'
+                                          ' partition. Default: False'})
+        parameters.append({'id': 'epoch_length', 'name': 'Epoch Length', 'type': int, 'default': None, 'min': 2,
+                           'description': 'Number of data points per epoch with class balanced sampling. Default:'
+                                          ' Twice the size of the majority class'})
         parameters.append({'id': 'eval_partition_size', 'name': 'Evaluation partition size', 'type': int,
                            'default': 100, 'min': 1, 'max': 100, 'description':
                                'The size in percent of the test partition used for evaluation. Default: 100'})
         parameters.append({'id': 'frozen_epochs', 'name': 'Frozen Epochs', 'type': int, 'default': None,
                            'description': 'Number of epochs that will be trained with frozen feature layers. Default: '
                                           'All epochs'})
+        parameters.append({'id': 'prefetch_batches', 'name': 'Prefetched Batches', 'type': int, 'default': 10,
+                           'min': 1, 'description': 'Number of batches that are preprocessed ahead of the network. Up to'
+                                                    ' this number of batches is ready while as many are being'
+                                                    ' preprocessed. Default: 10'})
+        parameters.append({'id': 'workers', 'name': 'Workers', 'type': int, 'default': 1, 'min': 0,
+                           'description': 'Number of threads (or processes) that assemble batches for the network.'
+                                          ' Default: 1'})
+        parameters.append({'id': 'use_multiprocessing', 'name': 'Worker Processes', 'type': bool, 'default': False,
+                           'description': 'Assemble the batches in worker processes instead of threads. Each worker'
+                                          ' then preprocesses its batches itself. Default: False'})
         return parameters
 
     @staticmethod
@@ -68,49 +84,59 @@ class Tensor2D:
             weight_start_index, weight_end_index = weight_transfer.get_weight_range(shared_model, 'input', 'features')
             layer_start_index, layer_end_index = weight_transfer.get_layer_range(shared_model, 'input', 'features')
             weight_transfer.transfer_weights(shared_model, model, weight_start_index, weight_end_index)
-            process_pool_ = process_pool.ProcessPool()
-            arrays = training_array.TrainingArrays(global_parameters, epochs - epoch, epoch, batch_size, multi_process=process_pool_)
+            # Worker processes assemble their batches themselves, otherwise the worker threads share a process pool
+            process_pool_ = None
+            if not local_parameters['use_multiprocessing']:
+                process_pool_ = process_pool.ProcessPool()
+            arrays = training_array.TrainingArrays(global_parameters, epoch, batch_size, multi_process=process_pool_,
+                                                   prefetch_batches=local_parameters['prefetch_batches'],
+                                                   balanced=local_parameters['balanced_sampling'],
+                                                   epoch_length=local_parameters['epoch_length'])
+            # The queue of keras holds the ready batches, their memory is part of the allowance of the arrays
+            generator_arguments = {'workers': local_parameters['workers'],
+                                   'use_multiprocessing': local_parameters['use_multiprocessing'],
+                                   'max_queue_size': arrays.prefetch_batches}
             callbacks_ = [callbacks.CustomCheckpoint(model_path)]
             test_data = None
             if local_parameters['evaluate']:
                 test_data = prediction_array.PredictionArrays(global_parameters, local_parameters['batch_size'],
-                                                              test=True, runs=epochs - epoch, multi_process=process_pool_,
-                                                              percent=local_parameters['eval_partition_size'] * 0.01)
-                chunks = misc.chunk_by_size(len(test_data.input), local_parameters['batch_size'])
-                callbacks_ = [EvaluationCallback(test_data, chunks, global_parameters[constants.GlobalParameters.seed],
-                                                 model_path[:-3] + '-eval.txt')] + callbacks_
+                                                              test=True, multi_process=process_pool_,
+                                                              percent=local_parameters['eval_partition_size'] * 0.01,
+                                                              prefetch_batches=local_parameters['prefetch_batches'])
+                test_generator_arguments = dict(generator_arguments)
+                test_generator_arguments['max_queue_size'] = test_data.prefetch_batches
+                callbacks_ = [EvaluationCallback(test_data, global_parameters[constants.GlobalParameters.seed],
+                                                 model_path[:-3] + '-eval.txt', test_generator_arguments)] + callbacks_
             if epoch < frozen_epochs:
                 weight_transfer.set_weight_freeze(model, layer_start_index, layer_end_index, True)
                 logger.log('Training ' + str(frozen_epochs - epoch) + ' epochs with frozen features')
-                model.fit(arrays.input, arrays.output, epochs=frozen_epochs, shuffle=False, batch_size=batch_size,
-                          callbacks=callbacks_, initial_epoch=epoch)
+                arrays.sequence.epoch = epoch
+                model.fit_generator(arrays.sequence, epochs=frozen_epochs, shuffle=False, callbacks=callbacks_,
+                                    initial_epoch=epoch, **generator_arguments)
                 epoch = frozen_epochs
             if epoch < epochs:
                 weight_transfer.set_weight_freeze(model, layer_start_index, layer_end_index, False)
                 logger.log('Training ' + str(epochs - epoch) + ' epochs with trainable features')
-                model.fit(arrays.input, arrays.output, epochs=epochs, shuffle=False, batch_size=batch_size,
-                          callbacks=callbacks_, initial_epoch=epoch)
+                arrays.sequence.epoch = epoch
+                model.fit_generator(arrays.sequence, epochs=epochs, shuffle=False, callbacks=callbacks_,
+                                    initial_epoch=epoch, **generator_arguments)
             if test_data is not None:
                 test_data.close()
             arrays.close()
-            process_pool_.close()
+            if process_pool_ is not None:
+                process_pool_.close()
 
 
 class EvaluationCallback(Callback):
 
-    def __init__(self, test_data, chunks, seed, file_path):
+    def __init__(self, test_data, seed, file_path, generator_arguments):
         self.test_data = test_data
         self.seed = seed
         self.file_path = file_path
-        self.chunks = chunks
+        self.generator_arguments = generator_arguments
 
     def on_epoch_end(self, epoch, logs=None):
-        predictions = numpy.zeros((len(self.test_data.input), 2))
-        with progressbar.ProgressBar(len(self.test_data.input)) as progress:
-            for chunk in self.chunks:
-                predictions_chunk = self.model.predict(self.test_data.input.next())
-                predictions[chunk['start']:chunk['end']] = predictions_chunk[:]
-                progress.increment(chunk['size'])
+        predictions = self.model.predict_generator(self.test_data.sequence, **self.generator_arguments)
         actives, e_auc, efs = enrichment.stats(predictions, self.test_data.output, [5, 10], seed=self.seed)
         roc_auc = roc_curve.stats(predictions, self.test_data.output, seed=self.seed)[2]
         ef5 = efs[5]
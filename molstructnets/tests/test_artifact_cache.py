@@ -0,0 +1,57 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import h5py
+
+from util import artifact_cache, constants, file_util
+
+
+class TestFileDigest(unittest.TestCase):
+
+    def setUp(self):
+        self._folder = tempfile.TemporaryDirectory()
+        self.global_parameters = {constants.GlobalParameters.root: self._folder.name}
+        self.path = file_util.resolve_subpath(self._folder.name, 'data_sets', 'data_set.h5')
+        file_util.make_folders(self.path)
+        self.write(['CCO', 'c1ccccc1'])
+
+    def tearDown(self):
+        artifact_cache.digests.clear()
+        self._folder.cleanup()
+
+    def write(self, smiles):
+        with h5py.File(self.path, 'w') as data_set_h5:
+            data_set_h5.create_dataset('smiles', data=smiles, dtype=h5py.string_dtype())
+
+    def test_stored_digest_is_reused(self):
+        # Another process only has the stored digest
+        digest = artifact_cache.file_digest(self.global_parameters, self.path)
+        artifact_cache.digests.clear()
+        with mock.patch.object(artifact_cache, 'content_digest') as content_digest:
+            self.assertEqual(digest, artifact_cache.file_digest(self.global_parameters, self.path))
+            content_digest.assert_not_called()
+
+    def test_data_set_folder_is_not_written(self):
+        artifact_cache.file_digest(self.global_parameters, self.path)
+        self.assertEqual(['data_set.h5'], os.listdir(file_util.get_parent(self.path)))
+
+    def test_artifacts_folder_cannot_be_created(self):
+        digest = artifact_cache.content_digest(self.path)
+        open(artifact_cache.get_folder(self.global_parameters), 'w').close()
+        self.assertEqual(digest, artifact_cache.file_digest(self.global_parameters, self.path))
+
+    def test_artifacts_folder_is_not_writable(self):
+        digest = artifact_cache.content_digest(self.path)
+        with mock.patch.object(os, 'access', return_value=False):
+            self.assertEqual(digest, artifact_cache.file_digest(self.global_parameters, self.path))
+        folder = file_util.resolve_subpath(artifact_cache.get_folder(self.global_parameters), 'digests')
+        self.assertEqual(list(), os.listdir(folder))
+
+    def test_changed_file_is_hashed_again(self):
+        digest = artifact_cache.file_digest(self.global_parameters, self.path)
+        self.write(['CCO', 'CCN'])
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        self.assertNotEqual(digest, artifact_cache.file_digest(self.global_parameters, self.path))
@@ -0,0 +1,42 @@
+import multiprocessing
+import tempfile
+import time
+import unittest
+
+from util import file_util, memory_budget
+
+
+class SlowMemoryBudget(memory_budget.MemoryBudget):
+
+    # Waits after reading the free host memory, so the requests of all processes overlap
+
+    def _host_free(self, *args):
+        free = super()._host_free(*args)
+        time.sleep(0.2)
+        return free
+
+
+def request(ledger_path, barrier, results):
+    budget = SlowMemoryBudget(total=1000, host_total=1000, host_ledger=ledger_path)
+    allowance = budget.request('Test', 600)
+    results.put(allowance.bytes)
+    # Keeps the allowance in the ledger until every process has requested its own
+    barrier.wait()
+
+
+class TestHostLedger(unittest.TestCase):
+
+    def test_concurrent_requests_do_not_overcommit(self):
+        with tempfile.TemporaryDirectory() as folder:
+            ledger_path = file_util.resolve_subpath(folder, 'ledger.json')
+            number_processes = 4
+            barrier = multiprocessing.Barrier(number_processes)
+            results = multiprocessing.Queue()
+            processes = [multiprocessing.Process(target=request, args=(ledger_path, barrier, results))
+                         for i in range(number_processes)]
+            for process in processes:
+                process.start()
+            granted = [results.get(timeout=60) for i in range(number_processes)]
+            for process in processes:
+                process.join()
+        self.assertEqual(1000, sum(granted))
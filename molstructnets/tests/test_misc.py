@@ -0,0 +1,16 @@
+import unittest
+
+import numpy
+
+from util import misc
+
+
+class TestEpochRandom(unittest.TestCase):
+
+    def test_same_order_for_same_seed_and_epoch(self):
+        numpy.testing.assert_array_equal(misc.epoch_random(3, 2).permutation(100),
+                                         misc.epoch_random(3, 2).permutation(100))
+
+    def test_consecutive_seeds_are_not_shifted(self):
+        self.assertFalse(numpy.array_equal(misc.epoch_random(1, 0).permutation(100),
+                                           misc.epoch_random(0, 1).permutation(100)))
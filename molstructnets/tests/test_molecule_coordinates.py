@@ -0,0 +1,47 @@
+import tempfile
+import unittest
+
+import h5py
+
+from steps.preprocessing.shared.tensor2d import molecule_coordinates
+from util import artifact_cache, constants, file_structure, file_util, hdf5_util
+
+
+class TestGetFile(unittest.TestCase):
+
+    def setUp(self):
+        self._root = tempfile.TemporaryDirectory()
+        self.global_parameters = {constants.GlobalParameters.root: self._root.name,
+                                  constants.GlobalParameters.data_set: 'data_set'}
+        self.write_data_set(self.global_parameters)
+
+    def write_data_set(self, global_parameters):
+        path = file_structure.get_data_set_file(global_parameters)
+        file_util.make_folders(path)
+        with h5py.File(path, 'w') as data_set_h5:
+            data_set_h5.create_dataset(file_structure.DataSet.smiles, data=['CCO', 'c1ccccc1', 'CC(=O)O'],
+                                       dtype=h5py.string_dtype())
+
+    def tearDown(self):
+        artifact_cache.digests.clear()
+        self._root.cleanup()
+
+    def get_file(self):
+        # Loads the variable length SMILES like the steps do and forgets the digests of this process
+        hdf5_util.load_data_set(file_structure.get_data_set_file(self.global_parameters), file_structure.DataSet.smiles)
+        artifact_cache.digests.clear()
+        return molecule_coordinates.get_file(self.global_parameters)
+
+    def test_same_file_for_every_load(self):
+        self.assertEqual(self.get_file(), self.get_file())
+
+    def test_same_file_after_conversion(self):
+        path = self.get_file()
+        hdf5_util.make_contiguous(file_structure.get_data_set_file(self.global_parameters))
+        self.assertEqual(path, self.get_file())
+
+    def test_same_file_for_renamed_copy(self):
+        path = self.get_file()
+        self.global_parameters[constants.GlobalParameters.data_set] = 'renamed_data_set'
+        self.write_data_set(self.global_parameters)
+        self.assertEqual(path, self.get_file())
@@ -0,0 +1,34 @@
+import tempfile
+import unittest
+
+import h5py
+
+from steps.preprocessing.shared.moleculestore import molecule_store
+from util import artifact_cache, constants, file_structure, file_util
+
+
+class TestGetFile(unittest.TestCase):
+
+    def setUp(self):
+        self._root = tempfile.TemporaryDirectory()
+        self.global_parameters = {constants.GlobalParameters.root: self._root.name,
+                                  constants.GlobalParameters.data_set: 'data_set'}
+        self.write_data_set(self.global_parameters)
+
+    def tearDown(self):
+        artifact_cache.digests.clear()
+        self._root.cleanup()
+
+    @staticmethod
+    def write_data_set(global_parameters):
+        path = file_structure.get_data_set_file(global_parameters)
+        file_util.make_folders(path)
+        with h5py.File(path, 'w') as data_set_h5:
+            data_set_h5.create_dataset(file_structure.DataSet.smiles, data=['CCO', 'c1ccccc1'],
+                                       dtype=h5py.string_dtype())
+
+    def test_same_file_for_renamed_copy(self):
+        path = molecule_store.get_file(self.global_parameters)
+        self.global_parameters[constants.GlobalParameters.data_set] = 'renamed_data_set'
+        self.write_data_set(self.global_parameters)
+        self.assertEqual(path, molecule_store.get_file(self.global_parameters))
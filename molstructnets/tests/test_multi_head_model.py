@@ -0,0 +1,114 @@
+import unittest
+
+import numpy
+
+from steps.trainingmultitarget.tensor2d import multi_head_model
+
+try:
+    from keras import layers, models
+except ImportError:
+    models = None
+
+
+class RecordingModel:
+
+    def __init__(self, name, calls):
+        self._name = name
+        self._calls = calls
+
+    def train_on_batch(self, inputs, outputs):
+        self._calls.append((self._name, inputs, outputs))
+
+
+class Batches:
+
+    # Batches of the data sets in turn, like MultitargetTrainingArrays.next_batch()
+
+    def __init__(self, number_data_sets, batches_per_epoch):
+        self._number_data_sets = number_data_sets
+        self._batches_per_epoch = batches_per_epoch
+        self._count = 0
+
+    def batches_per_epoch(self):
+        return self._batches_per_epoch
+
+    def next_batch(self):
+        data_set = self._count % self._number_data_sets
+        number = self._count // self._number_data_sets
+        self._count += 1
+        return 'input ' + str(data_set) + ' ' + str(number), 'output ' + str(data_set) + ' ' + str(number)
+
+
+class Progress:
+
+    def __init__(self):
+        self.value = 0
+
+    def increment(self, value):
+        self.value += value
+
+
+class TestTrainEpoch(unittest.TestCase):
+
+    def train(self, frozen_runs):
+        calls = list()
+        frozen_models = [RecordingModel('frozen ' + str(i), calls) for i in range(3)]
+        trainable_models = [RecordingModel('trainable ' + str(i), calls) for i in range(3)]
+        progress = Progress()
+        multi_head_model.train_epoch(frozen_models, trainable_models, Batches(3, 2), frozen_runs, progress, 10)
+        self.assertEqual(60, progress.value)
+        return calls
+
+    def test_each_batch_trains_the_head_of_its_data_set(self):
+        calls = self.train(0)
+        self.assertEqual(6, len(calls))
+        for name, inputs, outputs in calls:
+            data_set = name.split(' ')[1]
+            self.assertEqual('trainable', name.split(' ')[0])
+            self.assertEqual(data_set, inputs.split(' ')[1])
+            self.assertEqual(data_set, outputs.split(' ')[1])
+        self.assertEqual(['input 0 0', 'input 1 0', 'input 2 0', 'input 0 1', 'input 1 1', 'input 2 1'],
+                         [inputs for name, inputs, outputs in calls])
+
+    def test_frozen_runs_come_first(self):
+        calls = self.train(2)
+        self.assertEqual(18, len(calls))
+        self.assertEqual([('frozen 1', 'input 1 0', 'output 1 0'), ('frozen 1', 'input 1 0', 'output 1 0'),
+                          ('trainable 1', 'input 1 0', 'output 1 0')], calls[3:6])
+
+
+@unittest.skipIf(models is None, 'Keras is not installed')
+class TestCreateModels(unittest.TestCase):
+
+    def setUp(self):
+        input_ = layers.Input((4,), name='input')
+        features = layers.Dense(3, activation='relu', name='features')(input_)
+        output = layers.Dense(2, activation='softmax', name='output')(features)
+        self.shared_model = models.Model(inputs=input_, outputs=output)
+        self.shared_model.compile(optimizer='adam', loss='categorical_crossentropy')
+        random = numpy.random.RandomState(0)
+        self.inputs = random.rand(8, 4)
+        self.outputs = numpy.eye(2)[random.randint(0, 2, 8)]
+
+    @staticmethod
+    def get_weights(layer):
+        return [weights.copy() for weights in layer.get_weights()]
+
+    def assert_weights_equal(self, expected, layer):
+        for expected_weights, weights in zip(expected, layer.get_weights()):
+            numpy.testing.assert_array_equal(expected_weights, weights)
+
+    def test_other_heads_stay_unchanged(self):
+        frozen_models, trainable_models = multi_head_model.create_models(self.shared_model, 2)
+        # The optimizer state of the first head is not zero anymore, a shared optimizer would keep moving its weights
+        for i in range(3):
+            frozen_models[0].train_on_batch(self.inputs, self.outputs)
+            trainable_models[0].train_on_batch(self.inputs, self.outputs)
+        head_0 = self.get_weights(trainable_models[0].layers[-1])
+        features = self.get_weights(self.shared_model.get_layer('features'))
+        for i in range(3):
+            frozen_models[1].train_on_batch(self.inputs, self.outputs)
+        self.assert_weights_equal(head_0, trainable_models[0].layers[-1])
+        self.assert_weights_equal(features, self.shared_model.get_layer('features'))
+        trainable_models[1].train_on_batch(self.inputs, self.outputs)
+        self.assert_weights_equal(head_0, trainable_models[0].layers[-1])
@@ -0,0 +1,60 @@
+import unittest
+
+from steps.training.shared.tensor2d import weight_transfer
+
+
+class Layer:
+
+    def __init__(self, name):
+        self.name = name
+        self.trainable = True
+
+
+class Model:
+
+    # Collects the trainable weights and builds a new training function like a compiled Keras 2 model
+
+    def __init__(self, names):
+        self.layers = [Layer(name) for name in names]
+        self.train_function = None
+        self._collected_trainable_weights = None
+        self.built_functions = 0
+
+    @property
+    def trainable_weights(self):
+        return [layer.name + '/kernel' for layer in self.layers if layer.trainable]
+
+    def _make_train_function(self):
+        if self.train_function is None:
+            self.built_functions += 1
+            self.train_function = object()
+
+
+class TestSetWeightFreeze(unittest.TestCase):
+
+    def setUp(self):
+        self.model = Model(['input', 'convolution', 'features', 'dense', 'output'])
+        self.start, self.end = weight_transfer.get_layer_range(self.model, 'input', 'features')
+
+    def test_layer_range(self):
+        self.assertEqual((0, 3), (self.start, self.end))
+
+    def test_frozen_layers_are_not_trained(self):
+        weight_transfer.set_weight_freeze(self.model, self.start, self.end, True)
+        self.assertEqual(['dense/kernel', 'output/kernel'], self.model._collected_trainable_weights)
+        weight_transfer.set_weight_freeze(self.model, self.start, self.end, False)
+        self.assertEqual(5, len(self.model._collected_trainable_weights))
+
+    def test_train_functions_are_reused(self):
+        weight_transfer.set_weight_freeze(self.model, self.start, self.end, True)
+        frozen_function = self.model.train_function
+        weight_transfer.set_weight_freeze(self.model, self.start, self.end, False)
+        trainable_function = self.model.train_function
+        self.assertIsNot(frozen_function, trainable_function)
+        for i in range(3):
+            weight_transfer.set_weight_freeze(self.model, self.start, self.end, True)
+            self.assertIs(frozen_function, self.model.train_function)
+            self.assertEqual(['dense/kernel', 'output/kernel'], self.model._collected_trainable_weights)
+            weight_transfer.set_weight_freeze(self.model, self.start, self.end, False)
+            self.assertIs(trainable_function, self.model.train_function)
+        self.assertEqual(2, self.model.built_functions)
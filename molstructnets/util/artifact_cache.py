@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+import h5py
+import numpy
+
+from util import file_structure, file_util, misc, constants, hdf5_util
+
+# Digests of files that have already been computed by this process, keyed by path, size and modification time
+digests = dict()
+# Number of values of a data set that are hashed at once
+block_size = 1000000
+artifact_pattern = re.compile(r'.+_([0-9a-f]{40})\.h5')
+
+
+def get_folder(global_parameters):
+    return file_util.resolve_subpath(global_parameters[constants.GlobalParameters.root], 'artifacts')
+
+
+def get_file(global_parameters, prefix, parameters, inputs):
+    # Path of the artifact that a step computes from the given inputs (name -> digest, see file_digest()) with the
+    # given parameters. It is shared by all experiments, seeds and data set names with the same inputs and changes as
+    # soon as one of the inputs changes.
+    return file_util.resolve_subpath(get_folder(global_parameters),
+                                     prefix + '_' + get_key(parameters, inputs) + '.h5')
+
+
+def get_key(parameters, inputs):
+    key_parameters = dict(parameters)
+    for name, digest in inputs.items():
+        key_parameters['input_' + name] = digest
+    return misc.hash_parameters(key_parameters)
+
+
+def data_set_digest(global_parameters):
+    return file_digest(global_parameters, file_structure.get_data_set_file(global_parameters))
+
+
+def file_digest(global_parameters, path):
+    # Artifacts are named by their key, which already covers their content. Other HDF5 files are hashed by the
+    # content of their data sets and attributes, so that rewriting a file with another layout keeps its digest.
+    path = file_util.resolve_path(path)
+    match = artifact_pattern.fullmatch(file_util.get_filename(path))
+    if match is not None and file_util.get_filename(file_util.get_parent(path)) == 'artifacts':
+        return match.group(1)
+    stat = os.stat(path)
+    memo_key = (path, stat.st_size, stat.st_mtime_ns)
+    if memo_key not in digests:
+        digests[memo_key] = stored_digest(global_parameters, path, stat)
+    return digests[memo_key]
+
+
+def stored_digest(global_parameters, path, stat):
+    # The digest is stored in the artifacts folder under the hash of the absolute path of the file, together with its
+    # size and modification time, so other processes (e.g. experiments of a batch) do not have to read the file again.
+    # It is recomputed once the file changes. The folder of the file itself is never written to, and if the artifacts
+    # folder cannot be written either the digest is only computed.
+    folder = file_util.resolve_subpath(get_folder(global_parameters), 'digests')
+    try:
+        file_util.make_folders(folder, True)
+    except OSError:
+        return content_digest(path)
+    if not os.access(folder, os.W_OK):
+        return content_digest(path)
+    record_path = file_util.resolve_subpath(folder, hashlib.sha1(path.encode('utf-8')).hexdigest() + '.json')
+    with file_util.FileLock(record_path):
+        if file_util.file_exists(record_path):
+            with open(record_path, 'r') as file:
+                stored = json.load(file)
+            if stored['path'] == path and stored['size'] == stat.st_size and stored['mtime_ns'] == stat.st_mtime_ns:
+                return stored['digest']
+        digest = content_digest(path)
+        file_descriptor, temp_path = tempfile.mkstemp(prefix='.' + file_util.get_filename(record_path) + '_',
+                                                      dir=folder)
+        with os.fdopen(file_descriptor, 'w') as file:
+            json.dump({'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': digest}, file)
+        os.replace(temp_path, record_path)
+    return digest
+
+
+def content_digest(path):
+    hash_ = hashlib.sha1()
+    with h5py.File(path, 'r') as file_h5:
+        hash_attributes(hash_, file_h5)
+        names = list()
+        file_h5.visit(names.append)
+        for name in sorted(names):
+            object_ = file_h5[name]
+            hash_.update(name.encode('utf-8'))
+            hash_attributes(hash_, object_)
+            if isinstance(object_, h5py.Dataset):
+                hash_.update(str(object_.shape).encode('utf-8'))
+                if object_.shape is None or len(object_.shape) == 0:
+                    hash_.update(str(object_[()]).encode('utf-8'))
+                    continue
+                for start in range(0, object_.shape[0], block_size):
+                    hash_values(hash_, object_[start:start + block_size])
+    return hash_.hexdigest()
+
+
+def hash_attributes(hash_, object_):
+    for name in sorted(object_.attrs.keys()):
+        hash_.update(name.encode('utf-8'))
+        value = object_.attrs[name]
+        if isinstance(value, numpy.ndarray):
+            hash_values(hash_, value)
+        else:
+            hash_.update(str(value).encode('utf-8'))
+
+
+def hash_values(hash_, array):
+    if array.dtype.kind in ('O', 'S', 'U'):
+        # Strings are hashed independent of their width, so variable and fixed length strings are equal
+        hash_.update(b'\n'.join(hdf5_util.to_bytes(value) for value in array.ravel()))
+    else:
+        hash_.update(array.dtype.str.encode('utf-8'))
+        hash_.update(numpy.ascontiguousarray(array).tobytes())
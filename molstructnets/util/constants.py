@@ -14,3 +14,4 @@ class GlobalParameters:
     shared_network = 'shared_network'
     transfer_data_sets = 'transfer_data_sets'
     feature_files = 'feature_files'
+    encoded_symbols = 'encoded_symbols'
@@ -1,6 +1,7 @@
 import h5py
 from keras import models
 
+from steps.preprocessing.shared.tensor2d import tensor_2d_preprocessor
 from util import file_util, file_structure, constants
 
 
@@ -29,6 +30,15 @@ def validate_preprocessed_specs(global_parameters):
     validate_hdf5_file(path)
 
 
+def validate_one_hot_symbols(global_parameters):
+    path = global_parameters[constants.GlobalParameters.preprocessed_data]
+    with h5py.File(path, 'r') as preprocessed_h5:
+        symbol_encoding = preprocessed_h5.attrs.get(file_structure.PreprocessedTensor2D.symbol_encoding,
+                                                    tensor_2d_preprocessor.SymbolEncodings.one_hot)
+        if symbol_encoding != tensor_2d_preprocessor.SymbolEncodings.one_hot:
+            raise ValueError('Preprocessed data in ' + path + ' does not use one-hot encoded symbols')
+
+
 def validate_prediction(global_parameters):
     path = file_structure.get_prediction_file(global_parameters)
     validate_hdf5_file(path, file_structure.Predictions.prediction)
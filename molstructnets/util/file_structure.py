@@ -57,6 +57,31 @@ class PreprocessedTensor2D:
     normalization_max = 'normalization_max'
     normalization_mean = 'normalization_mean'
     normalization_std = 'normalization_std'
+    symbol_encoding = 'symbol_encoding'
+
+
+class MoleculeCoordinates:
+    data_set_hash = 'data_set_hash'
+    atom_offsets = 'atom_offsets'
+    coordinates = 'coordinates'
+    atomic_numbers = 'atomic_numbers'
+    bond_offsets = 'bond_offsets'
+    bonds = 'bonds'
+
+
+class MoleculeStore:
+    data_set_hash = 'data_set_hash'
+    offsets = 'offsets'
+    molecules = 'molecules'
+
+
+class AugmentationCache:
+    variants = 'variants'
+    batch_size = 'batch_size'
+    shape = 'shape'
+    batch_offsets = 'batch_offsets'
+    indices = 'indices'
+    values = 'values'
 
 
 class SaliencyMapSubstructures:
@@ -1,3 +1,4 @@
+import fcntl
 import os
 import shutil
 import tempfile
@@ -31,8 +32,8 @@ def make_folders(file_path, including_this=False):
     if including_this:
         file_path += path.sep
     folder_path = path.dirname(file_path)
-    if not path.exists(folder_path):
-        os.makedirs(folder_path)
+    # Other processes may create the same folders at the same time
+    os.makedirs(folder_path, exist_ok=True)
 
 
 def list_files(folder_path):
@@ -51,13 +52,24 @@ def get_temporary_file_path(prefix=None):
 
 
 def move_file(source, destination, safe=True):
+    # The file is copied next to the destination and then renamed, so other processes never see a partially written
+    # destination
     make_folders(destination)
-    remove_file(destination)
-    if safe:
-        shutil.copy(source, destination)
-        remove_file(source)
-    else:
-        shutil.move(source, destination)
+    destination = resolve_path(destination)
+    file_descriptor, temp_path = tempfile.mkstemp(prefix='.' + get_filename(destination) + '_',
+                                                  dir=path.dirname(destination))
+    os.close(file_descriptor)
+    try:
+        if safe:
+            shutil.copy(source, temp_path)
+            remove_file(source)
+        else:
+            shutil.move(source, temp_path)
+        if path.isdir(destination):
+            shutil.rmtree(destination)
+        os.replace(temp_path, destination)
+    finally:
+        remove_file(temp_path)
 
 
 def is_folder(file_path):
@@ -85,3 +97,25 @@ def read_file(file_path):
     with open(file_path, 'r') as file:
         string = file.read()
     return string
+
+
+class FileLock:
+
+    # Exclusive lock for creating the file at the given path, held on a lock file next to it. Processes that would
+    # write the same file wait for each other, so only the first one writes it and the others find it afterwards. The
+    # lock file is left in place, removing it would let a waiting process lock a file that no longer exists.
+
+    def __init__(self, file_path):
+        self._path = resolve_path(file_path) + '.lock'
+        self._file = None
+
+    def __enter__(self):
+        make_folders(self._path)
+        self._file = open(self._path, 'a')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
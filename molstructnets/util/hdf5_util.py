@@ -1,4 +1,5 @@
 import h5py
+import numpy
 
 from util import file_util
 
@@ -55,3 +56,77 @@ def create_dataset(file, name, shape, dtype='float32', chunks=True):
 
 def create_dataset_from_data(file, name, data, dtype=None, chunks=True):
     return file.create_dataset(name, data=data, dtype=dtype, chunks=chunks, compression='gzip')
+
+
+def memory_map(path, name):
+    # Memory maps a contiguous, uncompressed data set (data sets without storage are returned as zeros)
+    with h5py.File(file_util.resolve_path(path), 'r') as file:
+        data_set = file[name]
+        offset = data_set.id.get_offset()
+        if offset is None:
+            return numpy.zeros(data_set.shape, dtype=data_set.dtype)
+        return numpy.memmap(file_util.resolve_path(path), dtype=data_set.dtype, mode='r', offset=offset,
+                            shape=data_set.shape)
+
+
+def is_contiguous(data_set):
+    # Contiguous, uncompressed and of fixed width, i.e. the data set can be memory mapped
+    return data_set.chunks is None and data_set.compression is None and h5py.check_vlen_dtype(data_set.dtype) is None
+
+
+def load_data_set(path, name):
+    # Returns a read only memory map of the data set if it is contiguous (see make_contiguous), otherwise the data set
+    # is read. Processes that memory map the same file share one copy in the page cache.
+    with h5py.File(file_util.resolve_path(path), 'r') as file:
+        data_set = file[name]
+        if not is_contiguous(data_set) or data_set.id.get_offset() is None:
+            return data_set[:]
+    return memory_map(path, name)
+
+
+def make_contiguous(path, *names, block_size=1000000):
+    # Rewrites the given data sets (all if none are given) of the file contiguous and uncompressed. Variable length
+    # strings are stored as fixed width bytes of the longest string. Returns the names of the rewritten data sets.
+    path = file_util.resolve_path(path)
+    rewritten = list()
+    with h5py.File(path, 'r') as file:
+        for name in file.keys():
+            data_set = file[name]
+            if isinstance(data_set, h5py.Dataset) and (len(names) == 0 or name in names) and data_set.shape != () \
+                    and not is_contiguous(data_set):
+                rewritten.append(name)
+    if len(rewritten) == 0:
+        return rewritten
+    temp_path = file_util.get_temporary_file_path('contiguous')
+    with h5py.File(path, 'r') as source, h5py.File(temp_path, 'w') as target:
+        for key, value in source.attrs.items():
+            target.attrs[key] = value
+        for name in source.keys():
+            if name not in rewritten:
+                source.copy(source[name], target, name=name)
+                continue
+            data_set = source[name]
+            dtype = data_set.dtype
+            if h5py.check_vlen_dtype(dtype) is not None:
+                width = 1
+                for start in range(0, len(data_set), block_size):
+                    block = data_set[start:start + block_size].reshape(-1)
+                    width = max([width] + [len(to_bytes(value)) for value in block])
+                dtype = numpy.dtype('S' + str(width))
+            copy = target.create_dataset(name, data_set.shape, dtype=dtype)
+            for key, value in data_set.attrs.items():
+                copy.attrs[key] = value
+            for start in range(0, len(data_set), block_size):
+                block = data_set[start:start + block_size]
+                if block.dtype == object:
+                    block = numpy.array([to_bytes(value) for value in block.reshape(-1)], dtype=dtype)\
+                        .reshape(block.shape)
+                copy[start:start + block_size] = block
+    file_util.move_file(temp_path, path)
+    return rewritten
+
+
+def to_bytes(value):
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return value
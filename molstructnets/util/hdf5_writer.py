@@ -0,0 +1,110 @@
+import math
+import queue
+
+import numpy
+
+from util import thread_pool
+
+# Target size of the chunks of data sets written with a Hdf5Writer
+default_chunk_bytes = 1024 ** 2
+
+
+class Hdf5Writer:
+
+    # Writes blocks of rows into a data set in a background thread. Blocks are handed over through a bounded queue and
+    # collected until whole chunks can be written at once, so the caller does not wait for compression or the disk
+    # unless it is more than queue_size blocks ahead. Blocks are expected in order of their rows, a block that does not
+    # follow the previous one causes the collected rows to be written first. An error of the background thread is
+    # raised by the next call of write() or close().
+
+    def __init__(self, data_set, queue_size=10, write_chunks=4):
+        self._data_set = data_set
+        self._queue = queue.Queue(queue_size)
+        chunk_rows = 1
+        if data_set.chunks is not None:
+            chunk_rows = data_set.chunks[0]
+        self._chunk_rows = chunk_rows
+        self._write_rows = chunk_rows * write_chunks
+        self._error = None
+        self._pool = thread_pool.ThreadPool(1)
+        self._pool.submit(self._run)
+
+    def write(self, start, block):
+        # The block is written to the rows starting at start, it must not be changed afterwards
+        self._put((start, block))
+
+    def close(self):
+        # Blocks until everything is written
+        try:
+            self._put(None)
+        finally:
+            self._pool.wait()
+            self._pool.close()
+        self._check_error()
+
+    def _put(self, item):
+        # Waits for space in the queue as long as the background thread is still writing
+        while True:
+            self._check_error()
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _run(self):
+        try:
+            self._write_blocks()
+        except Exception as e:
+            self._error = e
+
+    def _write_blocks(self):
+        start = 0
+        blocks = list()
+        rows = 0
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            block_start, block = item
+            if rows > 0 and block_start != start + rows:
+                self._flush(start, blocks, start + rows)
+                blocks = list()
+                rows = 0
+            if rows == 0:
+                start = block_start
+            blocks.append(block)
+            rows += len(block)
+            # Write up to the last chunk boundary, the rest waits for the following blocks
+            end = (start + rows) - (start + rows) % self._chunk_rows
+            if end - start >= self._write_rows:
+                blocks = self._flush(start, blocks, end)
+                rows -= end - start
+                start = end
+        if rows > 0:
+            self._flush(start, blocks, start + rows)
+
+    def _flush(self, start, blocks, end):
+        # Writes the rows from start to end and returns the blocks of the remaining rows
+        data = numpy.concatenate(blocks) if len(blocks) > 1 else blocks[0]
+        self._data_set[start:end] = data[:end - start]
+        if end - start < len(data):
+            return [data[end - start:]]
+        return list()
+
+
+def chunk_shape(shape, dtype, chunk_bytes=default_chunk_bytes):
+    # Chunk shape for a data set of the given shape with as many whole rows as fit into chunk_bytes
+    row_bytes = int(numpy.prod(shape[1:])) * numpy.dtype(dtype).itemsize
+    rows = min(shape[0], int(math.floor(chunk_bytes / max(1, row_bytes))))
+    return (max(1, rows),) + tuple(shape[1:])
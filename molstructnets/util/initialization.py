@@ -6,6 +6,7 @@ import sys
 import random
 import numpy
 import json
+import math
 
 silent_loading = True
 seed = 1
@@ -19,6 +20,15 @@ def initialize(args=None):
         if os.path.isfile(cuda_devices_file):
             with open(cuda_devices_file, 'r') as value_file:
                 os.environ['CUDA_VISIBLE_DEVICES'] = value_file.read().replace('\n', '')
+    memory_budget_ = None
+    host_memory_budget = None
+    if hasattr(args, 'memory_budget') and args.memory_budget is not None:
+        memory_budget_ = args.memory_budget * math.pow(1024, 3)
+    if hasattr(args, 'host_memory_budget') and args.host_memory_budget is not None:
+        host_memory_budget = args.host_memory_budget * math.pow(1024, 3)
+    if memory_budget_ is not None or host_memory_budget is not None:
+        from util import memory_budget
+        memory_budget.configure(memory_budget_, host_memory_budget)
     global seed
     os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
     os.environ['PYTHONHASHSEED'] = '0'
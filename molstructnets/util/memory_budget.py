@@ -0,0 +1,141 @@
+import contextlib
+import fcntl
+import json
+import math
+import os
+import tempfile
+import threading
+
+import psutil
+
+from util import logger
+
+# Memory that is never handed out, in bytes
+buffer = 2 * math.pow(1024, 3)
+default_fraction = 1 / 2
+default_host_ledger = os.path.join(tempfile.gettempdir(), 'molstructnets_memory_budget.json')
+
+
+class MemoryBudget:
+
+    # Hands out memory allowances to the consumers of a process (e.g. the batch queues of training and evaluation),
+    # which size their queues and blocks accordingly. The process budget is a fixed number of bytes or a fraction of
+    # the memory available when it is first used. With a host budget all processes on the host that use the same
+    # ledger file share it. The ledger stores the allowances of each process and is locked while it is updated.
+
+    def __init__(self, total=None, host_total=None, host_ledger=default_host_ledger, fraction=default_fraction):
+        self._total = total
+        self._fraction = fraction
+        self._host_total = host_total
+        self._host_ledger = host_ledger
+        self._allowances = dict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def request(self, name, maximum, minimum=0):
+        # Returns an Allowance of up to maximum bytes. At least minimum bytes are granted even if this exceeds the
+        # budget, which is logged as a warning.
+        # The host ledger stays locked from reading the free memory until the grant is written, so processes that
+        # request memory at the same time can not both be granted the same bytes
+        with self._lock, self._open_host_ledger() as ledger:
+            free = self.get_total() - sum(self._allowances.values())
+            if ledger is not None:
+                free = min(free, self._host_free(ledger))
+            granted = int(max(minimum, min(maximum, free)))
+            if granted > free:
+                logger.log(name + ' exceeds the memory budget by ' + str(round((granted - free) / 1024 ** 2)) + ' MB',
+                           logger.LogLevel.WARNING)
+            id_ = self._next_id
+            self._next_id += 1
+            self._allowances[id_] = granted
+            self._update_host_ledger(ledger)
+        logger.log(name + ': ' + str(round(granted / 1024 ** 2)) + ' MB memory budget', logger.LogLevel.VERBOSE)
+        return Allowance(self, id_, granted)
+
+    def release(self, id_):
+        with self._lock, self._open_host_ledger() as ledger:
+            if id_ in self._allowances:
+                del self._allowances[id_]
+                self._update_host_ledger(ledger)
+
+    def get_total(self):
+        if self._total is None:
+            self._total = max(0, (psutil.virtual_memory().available - buffer) * self._fraction)
+        return self._total
+
+    def _open_host_ledger(self):
+        # The locked host ledger, or None without a host budget
+        if self._host_total is None:
+            return contextlib.nullcontext()
+        return Ledger(self._host_ledger)
+
+    def _host_free(self, ledger):
+        used = sum(bytes_ for pid, bytes_ in ledger.allowances.items() if pid != os.getpid())
+        return self._host_total - used - sum(self._allowances.values())
+
+    def _update_host_ledger(self, ledger):
+        if ledger is not None:
+            if len(self._allowances) > 0:
+                ledger.allowances[os.getpid()] = sum(self._allowances.values())
+            else:
+                ledger.allowances.pop(os.getpid(), None)
+            ledger.changed = True
+
+
+class Allowance:
+
+    def __init__(self, budget, id_, bytes_):
+        self._budget = budget
+        self._id = id_
+        self.bytes = bytes_
+
+    def count(self, item_bytes):
+        # Number of items of the given size that fit into the allowance
+        return int(self.bytes // max(1, item_bytes))
+
+    def release(self):
+        self._budget.release(self._id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class Ledger:
+
+    # Locked access to the host ledger, entries of processes that no longer exist are dropped
+
+    def __init__(self, path):
+        self._path = path
+        self.allowances = None
+        self.changed = False
+
+    def __enter__(self):
+        self._file = open(self._path, 'a+')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        self._file.seek(0)
+        content = self._file.read()
+        allowances = json.loads(content) if len(content) > 0 else dict()
+        self.allowances = {int(pid): bytes_ for pid, bytes_ in allowances.items() if psutil.pid_exists(int(pid))}
+        self.changed = len(self.allowances) != len(allowances)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.changed and exc_type is None:
+            self._file.seek(0)
+            self._file.truncate()
+            json.dump({str(pid): bytes_ for pid, bytes_ in self.allowances.items()}, self._file)
+            self._file.flush()
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+
+instance = MemoryBudget()
+
+
+def configure(total=None, host_total=None, host_ledger=default_host_ledger):
+    # Replaces the budget of this process, total and host_total are in bytes
+    global instance
+    instance = MemoryBudget(total, host_total, host_ledger)
@@ -14,6 +14,20 @@ def hash_parameters(parameters):
     return hashlib.sha1(str(parameters).encode()).hexdigest()
 
 
+def hash_array(array):
+    # The bytes of object arrays (e.g. variable length strings) are pointers, see artifact_cache for their content
+    if array.dtype.kind == 'O':
+        raise ValueError('Object arrays can not be hashed by their bytes')
+    return hashlib.sha1(numpy.ascontiguousarray(array).tobytes()).hexdigest()
+
+
+def epoch_random(seed, epoch):
+    # Random state of an epoch (or iteration), so shuffles only depend on the seed and the epoch number and any epoch
+    # can be reproduced without replaying the previous ones. Both are passed separately, a sum would give consecutive
+    # seeds the same orders shifted by one epoch.
+    return numpy.random.RandomState([seed % 2 ** 32, epoch % 2 ** 32])
+
+
 def copy_dict_from_keys(dict_, keys):
     new_dict = {}
     for key in keys:
@@ -6,8 +6,14 @@ import sys
 import signal
 from util import manager
 
-default_number_processes = os.cpu_count()
+# The cores this process may run on (a batch of experiments pins every experiment to its own cores)
+if hasattr(os, 'sched_getaffinity'):
+    default_number_processes = len(os.sched_getaffinity(0))
+else:
+    default_number_processes = os.cpu_count()
 open_process_pools = list()
+# Objects created by WorkerObject.get() in this process
+worker_objects = dict()
 
 
 class ProcessPool:
@@ -24,6 +30,13 @@ class ProcessPool:
         self.futures.append(self.pool.apply_async(run_function, args, kwargs, error_callback=on_error))
         return self.futures[-1]
 
+    def submit_async(self, function_, *args, callback_=None, **kwargs):
+        # Like submit, but the result is only available through the returned future or callback_ (which is called in
+        # a thread of this process), wait() and get_results() ignore it
+        pid = os.getpid()
+        args = tuple([function_, pid] + list(args))
+        return self.pool.apply_async(run_function, args, kwargs, callback=callback_, error_callback=on_error)
+
     def wait(self):
         for i in range(len(self.futures)):
             self.futures[i].wait()
@@ -50,6 +63,22 @@ class ProcessPool:
         self.close()
 
 
+class WorkerObject:
+
+    # Reference to an object that is created only once in each worker process that uses it. Only the constructor
+    # and its arguments are pickled (they should be small, e.g. file paths), so tasks can pass it around cheaply.
+
+    def __init__(self, constructor, *args):
+        self._constructor = constructor
+        self._args = args
+
+    def get(self):
+        key = (self._constructor.__module__, self._constructor.__name__) + self._args
+        if key not in worker_objects:
+            worker_objects[key] = self._constructor(*self._args)
+        return worker_objects[key]
+
+
 def close_all_pools():
     for process_pool in open_process_pools:
         process_pool.close()
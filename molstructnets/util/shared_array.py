@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy
+import psutil
+
+shared_memory_folder = '/dev/shm'
+# Files are named prefix<pid>_..., so files of processes that have been killed can be removed later
+prefix = 'shared_array_'
+# Folders that have already been cleaned up by this process
+cleaned_folders = set()
+
+
+class SharedArray:
+
+    # Array in a memory mapped file that worker processes can write into directly. The file is placed in shared
+    # memory if there is enough space. Only the path, shape and dtype are pickled, so passing it to a task is cheap.
+    # The file is removed by release(), or when the creating instance is garbage collected or the process exits
+    # without release() (e.g. a batch that is dropped after an exception). Files of killed processes are removed by
+    # the next process that creates an array.
+
+    def __init__(self, shape, dtype='float32'):
+        self._shape = tuple(shape)
+        self._dtype = numpy.dtype(dtype)
+        size = int(numpy.prod(self._shape)) * self._dtype.itemsize
+        folder = tempfile.gettempdir()
+        if os.path.isdir(shared_memory_folder) and shutil.disk_usage(shared_memory_folder).free > 2 * size:
+            folder = shared_memory_folder
+        if folder not in cleaned_folders:
+            remove_orphans(folder)
+            cleaned_folders.add(folder)
+        file_descriptor, self._path = tempfile.mkstemp(prefix=prefix + str(os.getpid()) + '_', dir=folder)
+        self._finalizer = weakref.finalize(self, remove_file, self._path)
+        # The file is sparse and reads as zeros until written
+        os.ftruncate(file_descriptor, max(size, 1))
+        os.close(file_descriptor)
+        self._array = None
+
+    @property
+    def array(self):
+        if self._array is None:
+            self._array = numpy.memmap(self._path, dtype=self._dtype, mode='r+', shape=self._shape)
+        return self._array
+
+    def release(self):
+        # Removes the file, arrays that have already been mapped stay valid until they are garbage collected
+        array = self.array
+        if self._finalizer is not None:
+            self._finalizer()
+        else:
+            remove_file(self._path)
+        return array
+
+    def __getstate__(self):
+        return self._path, self._shape, self._dtype.str
+
+    def __setstate__(self, state):
+        self._path, self._shape, dtype = state
+        self._dtype = numpy.dtype(dtype)
+        self._array = None
+        # Only the creating instance removes the file
+        self._finalizer = None
+
+
+def remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def remove_orphans(folder):
+    # Removes the files of processes that no longer exist
+    for name in os.listdir(folder):
+        if not name.startswith(prefix):
+            continue
+        pid = name[len(prefix):].split('_')[0]
+        if pid.isdigit() and not psutil.pid_exists(int(pid)):
+            try:
+                os.remove(os.path.join(folder, name))
+            except OSError:
+                pass